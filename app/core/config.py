@@ -1,5 +1,17 @@
+from pydantic import BaseModel, field_validator
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, List, Optional
+
+class LLMBackendSettings(BaseModel):
+    """One OpenAI-compatible backend of the LLM pool; unset fields use the global settings"""
+    
+    name: str
+    api_key: Optional[str] = None  # OPENAI_API_KEY
+    base_url: Optional[str] = None  # OPENAI_BASE_URL
+    model: Optional[str] = None  # AI_MODEL
+    max_concurrent_requests: Optional[int] = None  # AI_MAX_CONCURRENT_REQUESTS
+    requests_per_minute: Optional[int] = None  # AI_REQUESTS_PER_MINUTE, 0 disables the limit
+    tokens_per_minute: Optional[int] = None  # AI_TOKENS_PER_MINUTE, 0 disables the limit
 
 class Settings(BaseSettings):
     """Application settings"""
@@ -13,6 +25,17 @@ class Settings(BaseSettings):
     
     # OpenAI Configuration
     OPENAI_API_KEY: str = ""
+    OPENAI_BASE_URL: str = ""  # OpenAI-compatible endpoint, e.g. scripts/fake_llm_server.py; empty uses OpenAI
+    AI_MODEL: str = "gpt-4o-mini"
+    
+    # LLM Backend Pool Settings
+    # JSON list of backends (keys and/or endpoints), e.g.
+    # [{"name": "key-a"}, {"name": "key-b", "api_key": "sk-..."}, {"name": "local", "base_url": "http://localhost:8011/v1"}]
+    # Empty uses a single backend built from the OpenAI settings above
+    AI_BACKENDS: List[LLMBackendSettings] = []
+    AI_HTTP_MAX_CONNECTIONS: int = 100  # connection pool shared by every backend
+    AI_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    AI_HTTP_KEEPALIVE_EXPIRY: float = 30.0  # seconds an idle connection is kept open
     
     # Application Settings
     CSV_STORAGE_PATH: str = "./data"
@@ -20,8 +43,124 @@ class Settings(BaseSettings):
     API_PORT: int = 8000
     
     # Processing Settings
-    EMAIL_CHECK_INTERVAL: int = 300  # seconds
+    EMAIL_CHECK_INTERVAL: int = 300  # seconds, polling fallback for servers without IDLE
     MAX_FILE_SIZE_MB: int = 50
+    CSV_CHUNK_SIZE: int = 1000  # rows read and enriched at a time
+    CSV_ENGINE: str = "pandas"  # input reader: pandas, pyarrow (the arrow extra) or auto (pyarrow when installed)
+    CSV_ENCODING: str = ""  # input encoding; empty sniffs it (UTF-8 with or without BOM, else cp1252/Latin-1)
+    CSV_DELIMITER: str = ""  # input separator; empty sniffs it from the header (, ; tab or |)
+    CSV_SNIFF_BYTES: int = 65536  # bytes read to sniff the encoding and separator
+    
+    # Email Monitor Settings
+    EMAIL_IDLE_TIMEOUT: int = 540  # seconds in IDLE before it is renewed (servers drop it after ~10-30 min)
+    EMAIL_RECONNECT_MAX_DELAY: int = 300  # cap for the reconnect backoff, seconds
+    EMAIL_UPLOAD_WORKERS: int = 4  # attachments sent to the API concurrently
+    EMAIL_QUEUE_SIZE: int = 50  # saved attachments waiting for upload before fetching pauses
+    EMAIL_JOB_PRIORITY: str = "bulk"  # priority of jobs submitted by the email monitor
+    # Sender address -> supplier whose catalog its CSVs are diffed against; other senders are not diffed
+    EMAIL_SUPPLIERS: Dict[str, str] = {}
+    EMAIL_FULL_CATALOG: bool = False  # CSVs of EMAIL_SUPPLIERS senders are whole catalogs (missing items are removed)
+    
+    # Job Settings
+    JOB_WORKERS: int = 2  # files processed in parallel by the job API
+    JOB_RETENTION_HOURS: int = 24  # finished jobs are forgotten after this
+    JOB_POLL_INTERVAL: int = 5  # seconds between status checks by the email monitor
+    JOB_TIMEOUT: int = 6 * 3600  # seconds the email monitor waits for a job
+    # Share of LLM calls each priority gets while files compete (weighted fair queuing);
+    # queued jobs also start in priority order
+    JOB_PRIORITY_WEIGHTS: Dict[str, float] = {"urgent": 8, "normal": 2, "bulk": 1}
+    JOB_DEFAULT_PRIORITY: str = "normal"  # uploads that do not ask for a priority
+    
+    # Enrichment Scheduler Settings
+    AI_MAX_CONCURRENT_REQUESTS: int = 8  # in-flight LLM calls per backend
+    AI_REQUESTS_PER_MINUTE: int = 500  # per backend, 0 disables the limit
+    AI_TOKENS_PER_MINUTE: int = 200000  # per backend, 0 disables the limit
+    AI_BATCH_SIZE: int = 8  # products per LLM call, 1 disables batching
+    AI_BATCH_MAX_INPUT_CHARS: int = 2000  # product text per batched prompt
+    AI_REQUEST_TIMEOUT: int = 120  # seconds per LLM HTTP attempt, 0 waits forever
+    AI_OUTPUT_TOKENS_PER_PRODUCT: int = 300  # completion budget per product (short fields; description 2 is built locally)
+    
+    # LLM Retry Settings
+    AI_MAX_RETRIES: int = 5  # retries of a call after 429, timeout, connection or 5xx errors
+    AI_RETRY_BASE_DELAY: float = 1.0  # seconds, doubled per retry with jitter; Retry-After wins if longer
+    AI_RETRY_MAX_DELAY: float = 60.0
+    AI_MIN_CONCURRENT_REQUESTS: int = 1  # floor of the adaptive concurrency, halved on throttling
+    AI_CIRCUIT_FAILURE_THRESHOLD: int = 5  # consecutive failures before LLM calls pause
+    AI_CIRCUIT_COOLDOWN: int = 30  # seconds paused before a probe call, doubled while it keeps failing
+    AI_CIRCUIT_MAX_COOLDOWN: int = 300
+    
+    # Sharding Settings
+    SHARD_ROWS: int = 0  # jobs with more rows are split into shards of this size; 0 disables sharding
+    # Worker processes. With sharding on, every LLM backend's budget is split evenly across
+    # them and the API process (1/(SHARD_WORKERS + 1) each), so the totals hold; shard LLM
+    # calls are queued in their worker, so JOB_PRIORITY_WEIGHTS do not weigh sharded jobs
+    # against the API process's jobs
+    SHARD_WORKERS: int = 2
+    SHARD_MAX_ATTEMPTS: int = 3  # tries per shard before the job fails (finished shards are kept)
+    SHARD_LEASE_SECONDS: int = 120  # a shard claim not renewed for this long is taken over
+    SHARD_HELPER_ENABLED: bool = False  # also enrich shards of files submitted to other replicas sharing CSV_STORAGE_PATH
+    
+    # Rule Engine Settings
+    RULE_ENGINE_ENABLED: bool = True
+    RULE_ENGINE_MIN_CONFIDENCE: float = 0.8  # below this the row goes to the LLM
+    
+    # Checkpoint Settings
+    CHECKPOINT_ENABLED: bool = True
+    CHECKPOINT_RETENTION_HOURS: int = 72  # journals untouched for longer are removed
+    
+    # Duplicate File Settings
+    DEDUP_ENABLED: bool = True  # resent files return the existing enriched output
+    
+    # Catalog Diff Settings
+    CATALOG_DIFF_ENABLED: bool = True  # uploads with a supplier only enrich parts new or changed since its last catalog
+    
+    # Enrichment Cache Settings
+    CACHE_ENABLED: bool = True
+    CACHE_TTL_DAYS: int = 90  # 0 keeps entries forever
+    CACHE_MAX_ENTRIES: int = 200000  # 0 disables size-based eviction
+    
+    # Similarity Index Settings
+    SIMILARITY_ENABLED: bool = True  # in-memory character n-gram index of enriched parts, loaded from the cache
+    SIMILARITY_MAX_ENTRIES: int = 50000  # parts kept in memory, least recently enriched dropped first
+    # Cosine from which a near-duplicate's category, NCM and dimensions are reused; it must also
+    # share the first description word and reference family, kits never are
+    SIMILARITY_REUSE_THRESHOLD: float = 0.9
+    SIMILARITY_EXAMPLE_MIN_SCORE: float = 0.3  # nearest parts from this score are sent as examples in the prompt
+    SIMILARITY_MAX_EXAMPLES: int = 5  # examples per LLM call, 0 disables them
+    
+    @field_validator("AI_BACKENDS")
+    @classmethod
+    def _unique_backend_names(cls, backends: List[LLMBackendSettings]) -> List[LLMBackendSettings]:
+        names = [backend.name for backend in backends]
+        if len(set(names)) != len(names):
+            raise ValueError(f"AI_BACKENDS names must be unique, got {names}")
+        return backends
+    
+    @field_validator("JOB_PRIORITY_WEIGHTS")
+    @classmethod
+    def _positive_priority_weights(cls, weights: Dict[str, float]) -> Dict[str, float]:
+        if not weights or any(weight <= 0 for weight in weights.values()):
+            raise ValueError(f"JOB_PRIORITY_WEIGHTS must be positive, got {weights}")
+        return weights
+    
+    def llm_backends(self) -> List[LLMBackendSettings]:
+        """Configured LLM backends with every unset field taken from the global settings"""
+        defaults = {
+            "api_key": self.OPENAI_API_KEY,
+            "base_url": self.OPENAI_BASE_URL,
+            "model": self.AI_MODEL,
+            "max_concurrent_requests": self.AI_MAX_CONCURRENT_REQUESTS,
+            "requests_per_minute": self.AI_REQUESTS_PER_MINUTE,
+            "tokens_per_minute": self.AI_TOKENS_PER_MINUTE,
+        }
+        backends = self.AI_BACKENDS or [LLMBackendSettings(name="default")]
+        return [
+            backend.model_copy(update={
+                field: value for field, value in defaults.items()
+                if getattr(backend, field) is None
+            })
+            for backend in backends
+        ]
     
     class Config:
         env_file = ".env"
@@ -1,10 +1,26 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+import asyncio
+import json
 import os
+import uuid
 from pathlib import Path
+from typing import Optional
 from loguru import logger
 from app.core.config import settings
+from app.models.csv_models import ProcessingStatus
 from app.services.csv_processor import CSVProcessor
+from app.services.job_manager import JobManager
+from app.services.metrics import (
+    CONTENT_TYPE,
+    JOB_QUEUE_DEPTH,
+    LLM_CIRCUIT_OPEN,
+    LLM_CONCURRENCY_LIMIT,
+    LLM_IN_FLIGHT,
+    render as render_metrics
+)
+from app.services.sharding import ShardPool, llm_share
+from app.services.upload_storage import FileTooLargeError, exceeds_upload_limit, save_upload
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -13,8 +29,40 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Initialize CSV processor
-csv_processor = CSVProcessor()
+# Initialize CSV processor; shard worker processes take part of the LLM budget
+csv_processor = CSVProcessor(llm_share=llm_share(settings.SHARD_WORKERS) if settings.SHARD_ROWS > 0 else 1.0)
+
+# Worker processes for jobs too large for one event loop
+shard_pool = None
+if settings.SHARD_ROWS > 0:
+    shard_pool = ShardPool(
+        csv_processor,
+        workers=settings.SHARD_WORKERS,
+        shard_rows=settings.SHARD_ROWS,
+        max_attempts=settings.SHARD_MAX_ATTEMPTS,
+        lease_seconds=settings.SHARD_LEASE_SECONDS,
+        helper=settings.SHARD_HELPER_ENABLED
+    )
+
+# Initialize background job queue
+job_manager = JobManager(
+    csv_processor,
+    workers=settings.JOB_WORKERS,
+    retention_hours=settings.JOB_RETENTION_HOURS,
+    shard_pool=shard_pool
+)
+
+# Gauges read at scrape time
+JOB_QUEUE_DEPTH.set_function(lambda: job_manager.queue_depth)
+LLM_IN_FLIGHT.set_function(lambda: {
+    (backend.name,): backend.concurrency.in_flight for backend in csv_processor.scheduler.backends
+})
+LLM_CONCURRENCY_LIMIT.set_function(lambda: {
+    (backend.name,): int(backend.concurrency.limit) for backend in csv_processor.scheduler.backends
+})
+LLM_CIRCUIT_OPEN.set_function(lambda: {
+    (backend.name,): int(backend.circuit_open) for backend in csv_processor.scheduler.backends
+})
 
 @app.on_event("startup")
 async def startup_event():
@@ -23,6 +71,62 @@ async def startup_event():
     # Ensure data directories exist
     Path(settings.CSV_STORAGE_PATH).mkdir(parents=True, exist_ok=True)
     Path("logs").mkdir(exist_ok=True)
+    job_manager.start()
+    if shard_pool is not None:
+        shard_pool.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers on shutdown"""
+    await job_manager.stop()
+    if shard_pool is not None:
+        await shard_pool.stop()
+
+# Endpoints receiving a CSV upload, checked against MAX_FILE_SIZE_MB before the body is read
+UPLOAD_PATHS = {"/process-csv", "/process-csv/stream", "/jobs"}
+
+@app.middleware("http")
+async def reject_large_uploads(request: Request, call_next):
+    """
+    Answer 413 from the declared Content-Length, before the body is received
+
+    The form is parsed (and the upload spooled) before a handler runs, so
+    this is the only point an oversized upload can be refused early; uploads
+    without Content-Length are still cut off by save_upload.
+    """
+    max_bytes = settings.MAX_FILE_SIZE_MB * 1024 * 1024
+    if (
+        request.method == "POST"
+        and request.url.path in UPLOAD_PATHS
+        and exceeds_upload_limit(request.headers.get("content-length"), max_bytes)
+    ):
+        logger.warning(f"Rejected upload to {request.url.path}: Content-Length {request.headers['content-length']}")
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"File exceeds the maximum size of {settings.MAX_FILE_SIZE_MB} MB"}
+        )
+    return await call_next(request)
+
+def upload_path(filename: str, upload_id: Optional[str] = None) -> Path:
+    """Input path of an upload; the id keeps concurrent uploads of the same file name apart"""
+    return Path(settings.CSV_STORAGE_PATH) / f"input_{upload_id or uuid.uuid4().hex}_{filename}"
+
+async def store_upload(file: UploadFile, input_path: Path) -> str:
+    """Stream an uploaded file to disk and return its content hash; 413 when over MAX_FILE_SIZE_MB"""
+    try:
+        size, content_hash = await save_upload(file, input_path, settings.MAX_FILE_SIZE_MB * 1024 * 1024)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    
+    logger.info(f"Saved upload {file.filename} ({size} bytes)")
+    return content_hash
+
+def check_priority(priority: Optional[str]) -> str:
+    """Resolve a requested priority, rejecting unknown ones with 400"""
+    try:
+        return csv_processor.resolve_priority(priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/")
 async def root():
@@ -34,25 +138,48 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "csv-automation"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Stage timings, row sources, LLM tokens and errors in the Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
+
 @app.post("/process-csv")
-async def process_csv(file: UploadFile = File(...)):
-    """Process CSV file with AI enrichment"""
+async def process_csv(
+    file: UploadFile = File(...),
+    force: bool = False,
+    priority: Optional[str] = None,
+    supplier: Optional[str] = None,
+    full_catalog: bool = False
+):
+    """
+    Process CSV file with AI enrichment (force=true re-enriches a file already processed)
+    
+    priority (urgent, normal, bulk by default) sets the file's share of LLM
+    calls while other files are being processed.
+    
+    supplier diffs the file against that supplier's last catalog: only new
+    parts and parts whose description changed are enriched, the others reuse
+    their previous row with the new stock and prices. Uploads only update the
+    items they list unless full_catalog=true: the file is then the supplier's
+    whole catalog and the items it no longer lists are removed.
+    """
     try:
         # Validate file
         if not file.filename.endswith('.csv'):
             raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+        priority = check_priority(priority)
         
         # Save uploaded file
-        input_path = Path(settings.CSV_STORAGE_PATH) / f"input_{file.filename}"
-        
-        with open(input_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        input_path = upload_path(file.filename)
+        content_hash = await store_upload(file, input_path)
         
         logger.info(f"Processing CSV file: {file.filename}")
         
         # Process CSV with AI
-        output_path = await csv_processor.process_file(input_path)
+        output_path = await csv_processor.process_file(
+            input_path, content_hash=content_hash, force=force, priority=priority, supplier=supplier,
+            full_catalog=full_catalog
+        )
         
         # Return processed file
         return FileResponse(
@@ -61,10 +188,209 @@ async def process_csv(file: UploadFile = File(...)):
             media_type="text/csv"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing CSV: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
+@app.post("/process-csv/stream")
+async def process_csv_stream(
+    file: UploadFile = File(...),
+    format: str = "csv",
+    force: bool = False,
+    priority: Optional[str] = None,
+    supplier: Optional[str] = None,
+    full_catalog: bool = False
+):
+    """
+    Process CSV file with AI enrichment, streaming enriched rows as they finish
+    
+    format=csv streams the enriched CSV (same columns and ';' format as
+    /process-csv). format=ndjson streams JSON events: one "row" event per
+    enriched CSV line, periodic "progress" events and a final "done" event.
+    A file already processed streams its existing output unless force=true.
+    priority, supplier and full_catalog work as in /process-csv; items
+    removed from the supplier's catalog are only logged.
+    """
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    priority = check_priority(priority)
+    
+    try:
+        # Save uploaded file
+        input_path = upload_path(file.filename)
+        content_hash = await store_upload(file, input_path)
+        # Both read the disk: keep them off the event loop
+        total_rows = await asyncio.to_thread(csv_processor.count_rows, input_path)
+        processed = None if force else await asyncio.to_thread(csv_processor.find_processed, content_hash)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error saving CSV: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+    
+    if processed:
+        logger.info(f"{file.filename} was already processed, streaming {processed['output_path']}")
+    else:
+        logger.info(f"Streaming processing of CSV file: {file.filename}")
+    
+    async def enriched_rows():
+        if processed:
+            for enriched_data in csv_processor.read_output_rows(processed["output_path"]):
+                yield enriched_data
+        else:
+            async for enriched_data in csv_processor.iter_enriched_rows(
+                input_path, content_hash, priority, supplier, force, full_catalog
+            ):
+                yield enriched_data
+    
+    async def csv_lines():
+        yield csv_processor.format_header()
+        async for enriched_data in enriched_rows():
+            yield csv_processor.format_row(enriched_data)
+    
+    async def ndjson_events():
+        def event(payload: dict) -> str:
+            return json.dumps(payload, ensure_ascii=False) + "\n"
+        
+        processed_rows = 0
+        yield event({"event": "header", "line": csv_processor.format_header(), "total_rows": total_rows})
+        try:
+            async for enriched_data in enriched_rows():
+                processed_rows += 1
+                yield event({"event": "row", "row": processed_rows, "line": csv_processor.format_row(enriched_data)})
+                if processed_rows % 100 == 0:
+                    yield event({"event": "progress", "processed_rows": processed_rows, "total_rows": total_rows})
+            yield event({"event": "done", "processed_rows": processed_rows, "total_rows": total_rows})
+        except Exception as e:
+            logger.error(f"Error streaming CSV: {str(e)}")
+            yield event({"event": "error", "processed_rows": processed_rows, "message": str(e)})
+    
+    if format == "ndjson":
+        return StreamingResponse(ndjson_events(), media_type="application/x-ndjson")
+    
+    return StreamingResponse(
+        csv_lines(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="enriched_{file.filename}"'}
+    )
+
+@app.post("/jobs", response_model=ProcessingStatus, status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    force: bool = False,
+    priority: Optional[str] = None,
+    supplier: Optional[str] = None,
+    full_catalog: bool = False,
+    email_received_at: Optional[float] = Header(None, alias="X-Email-Received-At")
+):
+    """
+    Queue a CSV file for AI enrichment and return its job id right away
+    
+    Queued jobs start in priority order and running jobs share LLM calls
+    by priority weight, so an urgent upload is not stuck behind bulk loads.
+    supplier and full_catalog work as in /process-csv; the items removed
+    from a full catalog are listed by /jobs/{job_id}/removed.
+    The email monitor submits with EMAIL_JOB_PRIORITY (and, for senders in
+    EMAIL_SUPPLIERS, their supplier and EMAIL_FULL_CATALOG), and sends
+    X-Email-Received-At (Unix time the email arrived) so the email-to-output
+    latency shows up in /metrics.
+    """
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+    priority = check_priority(priority)
+    
+    try:
+        # Job id in the file name keeps concurrent uploads of the same file apart
+        job_id = job_manager.new_job_id()
+        input_path = upload_path(file.filename, job_id)
+        content_hash = await store_upload(file, input_path)
+        
+        job = await job_manager.submit(
+            input_path,
+            file.filename,
+            job_id=job_id,
+            content_hash=content_hash,
+            force=force,
+            received_at=email_received_at,
+            priority=priority,
+            supplier=supplier,
+            full_catalog=full_catalog
+        )
+        return job.to_status()
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error creating job: {str(e)}")
+
+@app.get("/jobs/{job_id}", response_model=ProcessingStatus)
+async def get_job(job_id: str):
+    """Processing status of a job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_status()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Download the enriched CSV of a completed job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=409, detail=job.message)
+    if job.status != "completed" or job.output_path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    return FileResponse(
+        path=job.output_path,
+        filename=f"enriched_{job.filename}",
+        media_type="text/csv"
+    )
+
+@app.get("/jobs/{job_id}/report")
+async def get_job_report(job_id: str):
+    """Download the per-row report of a completed job: source of each row and why it fell back"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "completed" or job.output_path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    report_path = csv_processor.report_path(job.output_path)
+    if not report_path.is_file():
+        raise HTTPException(status_code=404, detail="Report not found")
+    
+    return FileResponse(
+        path=report_path,
+        filename=report_path.name,
+        media_type="text/csv"
+    )
+
+@app.get("/jobs/{job_id}/removed")
+async def get_job_removed(job_id: str):
+    """Download the items of the supplier's previous catalog that a completed full catalog job no longer lists"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "completed" or job.output_path is None:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    removed_path = csv_processor.removed_path(job.output_path)
+    if not removed_path.is_file():
+        raise HTTPException(status_code=404, detail="No catalog diff for this job")
+    
+    return FileResponse(
+        path=removed_path,
+        filename=removed_path.name,
+        media_type="text/csv"
+    )
+
 @app.get("/files")
 async def list_files():
     """List available files in storage"""
@@ -76,6 +402,88 @@ async def list_files():
         logger.error(f"Error listing files: {str(e)}")
         raise HTTPException(status_code=500, detail="Error listing files")
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Enrichment cache size and hit/miss counters"""
+    cache = csv_processor.ai_agent.cache
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.delete("/cache")
+async def invalidate_cache(referencia: Optional[str] = None):
+    """Invalidate cached enrichments for one part reference, or all of them"""
+    cache = csv_processor.ai_agent.cache
+    if cache is None:
+        raise HTTPException(status_code=404, detail="Enrichment cache is disabled")
+    
+    try:
+        removed = cache.invalidate(referencia)
+        return {"removed": removed, "referencia": referencia}
+    except Exception as e:
+        logger.error(f"Error invalidating cache: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error invalidating cache")
+
+@app.get("/processed-files")
+async def list_processed_files():
+    """Inputs already enriched, by content hash, and the outputs reused for duplicates"""
+    if csv_processor.processed_files is None:
+        return {"enabled": False, "files": []}
+    return {"enabled": True, "files": csv_processor.processed_files.list_entries()}
+
+@app.delete("/processed-files")
+async def forget_processed_files(content_hash: Optional[str] = None):
+    """Forget one processed input (or all of them) so its next upload is enriched again"""
+    if csv_processor.processed_files is None:
+        raise HTTPException(status_code=404, detail="Duplicate detection is disabled")
+    
+    try:
+        removed = csv_processor.processed_files.remove(content_hash)
+        return {"removed": removed, "content_hash": content_hash}
+    except Exception as e:
+        logger.error(f"Error removing processed files: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error removing processed files")
+
+@app.get("/catalogs")
+async def list_catalogs():
+    """Supplier catalogs that new uploads are diffed against"""
+    if csv_processor.catalogs is None:
+        return {"enabled": False, "suppliers": []}
+    return {"enabled": True, "suppliers": csv_processor.catalogs.list_suppliers()}
+
+@app.delete("/catalogs")
+async def forget_catalogs(supplier: Optional[str] = None):
+    """Forget one supplier's catalog (or all of them) so its next upload is enriched in full"""
+    if csv_processor.catalogs is None:
+        raise HTTPException(status_code=404, detail="Catalog diff is disabled")
+    
+    try:
+        removed = csv_processor.catalogs.remove(supplier)
+        return {"removed": removed, "supplier": supplier}
+    except Exception as e:
+        logger.error(f"Error removing catalogs: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error removing catalogs")
+
+@app.get("/checkpoints")
+async def list_checkpoints():
+    """Journaled runs that can be resumed"""
+    if csv_processor.checkpoints is None:
+        return {"enabled": False, "runs": []}
+    return {"enabled": True, "runs": csv_processor.checkpoints.list_runs()}
+
+@app.delete("/checkpoints")
+async def cleanup_checkpoints(older_than_hours: Optional[float] = None):
+    """Remove checkpoints not touched for the given hours (default CHECKPOINT_RETENTION_HOURS)"""
+    if csv_processor.checkpoints is None:
+        raise HTTPException(status_code=404, detail="Checkpoints are disabled")
+    
+    try:
+        removed = csv_processor.checkpoints.cleanup(older_than_hours)
+        return {"removed": removed}
+    except Exception as e:
+        logger.error(f"Error cleaning up checkpoints: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error cleaning up checkpoints")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=settings.API_PORT) 
\ No newline at end of file
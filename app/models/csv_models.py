@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field, validator
-from typing import Optional
+from typing import Any, Dict, Optional
 from decimal import Decimal
+from app.services.preprocessing import clean_price
 
 class CSVInputRow(BaseModel):
     """Model for input CSV row data"""
@@ -14,16 +15,8 @@ class CSVInputRow(BaseModel):
     
     @validator('preco_venda', 'preco_custo')
     def validate_price(cls, v):
-        """Validate price format"""
-        if not v:
-            return "0.00"
-        # Clean price string
-        cleaned = str(v).replace('R$', '').replace(' ', '').replace(',', '.')
-        try:
-            float(cleaned)
-            return cleaned
-        except ValueError:
-            return "0.00"
+        """Validate price format (same cleaning as the processing pipeline)"""
+        return clean_price(v)
 
 class CSVOutputRow(BaseModel):
     """Model for output CSV row data"""
@@ -63,11 +56,21 @@ class CSVOutputRow(BaseModel):
 
 class ProcessingStatus(BaseModel):
     """Model for processing status"""
+    job_id: Optional[str] = Field(None, description="ID do job de processamento")
     status: str = Field(..., description="Status do processamento")
     message: str = Field(..., description="Mensagem de status")
     processed_rows: Optional[int] = Field(None, description="Número de linhas processadas")
     total_rows: Optional[int] = Field(None, description="Total de linhas")
     output_file: Optional[str] = Field(None, description="Caminho do arquivo de saída")
+    priority: Optional[str] = Field(None, description="Prioridade do job (chave de JOB_PRIORITY_WEIGHTS)")
+    supplier: Optional[str] = Field(None, description="Fornecedor cujo catálogo anterior é comparado com o arquivo")
+    full_catalog: bool = Field(False, description="O arquivo é o catálogo completo do fornecedor (itens ausentes são removidos)")
+
+class EnrichmentResult(BaseModel):
+    """Model for the outcome of enriching one product"""
+    data: Dict[str, Any] = Field(..., description="Linha de saída enriquecida")
+    source: str = Field(..., description="Origem dos dados: unchanged, patched, rules, cache, similar, llm, dedup, resumed ou fallback")
+    reason: Optional[str] = Field(None, description="Motivo quando a origem é fallback")
 
 class EmailProcessingRequest(BaseModel):
     """Model for email processing request"""
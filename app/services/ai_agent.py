@@ -1,42 +1,244 @@
 from langchain_openai import ChatOpenAI
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 from loguru import logger
-from app.core.config import settings
+from app.core.config import LLMBackendSettings, settings
+from app.models.csv_models import EnrichmentResult
+from app.services.enrichment_cache import EnrichmentCache
+from app.services.metrics import JSON_PARSE_SECONDS, LLM_CALL_SECONDS, LLM_HTTP_ERRORS, LLM_TOKENS, SIMILARITY_LOOKUP_SECONDS
+from app.services.preprocessing import DERIVED_FIELDS, PRICE_FIELDS, clean_price, strip_reference
+from app.services.rule_engine import PartRuleEngine
+from app.services.similarity_index import SimilarityIndex
 from datetime import datetime
+from pathlib import Path
+import asyncio
+import httpx
 import json
+import openai
 import re
 
 
+# Bump whenever the prompts change so cached enrichments are not reused
+PROMPT_VERSION = "4"
+
+# Rough characters-per-token ratio used for rate limit budgeting
+CHARS_PER_TOKEN = 4
+
+# Typical completion size of one enriched product, used for rate limit budgeting
+EXPECTED_COMPLETION_TOKENS = 160
+
+# Largest completion the model can return in one call
+MODEL_MAX_OUTPUT_TOKENS = 16384
+
+# Fields every enriched product returned by the model must contain
+AI_FIELDS = (
+    "nome_categoria",
+    "peso",
+    "altura",
+    "comprimento",
+    "largura",
+    "ncm",
+    "aplicacao",
+    "descricao_tecnica",
+    "descricao_ncm",
+)
+
+# Fields filled into the description 2 template (assembled locally, not by the model)
+DESCRIPTION_2_FIELDS = (
+    "peso",
+    "altura",
+    "comprimento",
+    "largura",
+    "ncm",
+    "descricao_ncm",
+    "aplicacao",
+    "descricao_tecnica",
+)
+
+# Fields reused from a near-duplicate part and shown in prompt examples
+SIMILAR_FIELDS = (
+    "nome_categoria",
+    "ncm",
+    "descricao_ncm",
+    "peso",
+    "altura",
+    "comprimento",
+    "largura",
+)
+
+# Approximate size of one prompt example, used for rate limit budgeting
+EXAMPLE_CHARS = 220
+
+# Product fields sent to the model (single and batched prompts); stock, prices and
+# EAN do not describe the part and are only copied to the output
+LLM_INPUT_FIELDS = ("sku", "referencia", "descricao")
+
+# Transient provider errors, retried by the scheduler instead of falling back right away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # includes timeouts
+    openai.InternalServerError,
+)
+
+# Placeholder rewritten when description 2 is reused for another row; the SKU
+# label is replaced by the other row's exact SKU, which may be empty
+DATE_LABEL = re.compile(r"Data: \S+")
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Count the prompt and completion tokens the API reports for each call of one backend"""
+    
+    run_inline = True
+    
+    def __init__(self, backend: str):
+        self.backend = backend
+    
+    def on_llm_end(self, response: LLMResult, **kwargs: Any):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        LLM_TOKENS.labels(type="prompt", backend=self.backend).inc(usage.get("prompt_tokens", 0))
+        LLM_TOKENS.labels(type="completion", backend=self.backend).inc(usage.get("completion_tokens", 0))
+
+
+class MetricsTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport counting 429 answers and timeouts, including attempts the client retries"""
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            response = await super().handle_async_request(request)
+        except httpx.TimeoutException:
+            LLM_HTTP_ERRORS.labels(reason="timeout").inc()
+            raise
+        if response.status_code == 429:
+            LLM_HTTP_ERRORS.labels(reason="rate_limited").inc()
+        return response
+
+
+class LLMBackend:
+    """One backend of the LLM pool: its chat model and the chains bound to it"""
+    
+    def __init__(self, name: str, llm: ChatOpenAI, chain, batch_chain):
+        self.name = name
+        self.llm = llm
+        self.chain = chain
+        self.batch_chain = batch_chain
+
 
 class AIProductEnrichmentAgent:
     """AI Agent for automotive parts data enrichment using LangChain"""
     
     def __init__(self):
-        self.llm = ChatOpenAI(
-            openai_api_key=settings.OPENAI_API_KEY,
-            model_name="gpt-4o-mini",
-            temperature=0.1,
-            max_tokens=4000
+        # Output budget per product; batched calls get it once per product
+        self.max_tokens = settings.AI_OUTPUT_TOKENS_PER_PRODUCT
+        self.request_timeout = settings.AI_REQUEST_TIMEOUT or None
+        # Keep-alive connections shared by every backend; requests go through
+        # MetricsTransport so 429s and timeouts are counted
+        self.http_client = httpx.AsyncClient(
+            transport=MetricsTransport(limits=httpx.Limits(
+                max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.AI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.AI_HTTP_KEEPALIVE_EXPIRY
+            )),
+            timeout=self.request_timeout
         )
         
         # Set up the output parser
         self.parser = StrOutputParser()
         
-        # Create the prompt template
+        # Create the prompt templates
         self.prompt = self._create_prompt_template()
+        self.batch_prompt = self._create_batch_prompt_template()
+        
+        # Largest batch whose output budget still fits in one completion
+        self.max_batch_size = max(1, min(
+            settings.AI_BATCH_SIZE,
+            MODEL_MAX_OUTPUT_TOKENS // self.max_tokens
+        ))
+        
+        # Create the LLM backends and their processing chains, in AI_BACKENDS order
+        self.backends: Dict[str, LLMBackend] = {}
+        for backend_settings in settings.llm_backends():
+            backend = self._create_backend(backend_settings)
+            self.backends[backend.name] = backend
         
-        # Create the processing chain
-        self.chain = self._create_processing_chain()
+        # Prompt sizes without product fields, used for token estimates
+        self._prompt_overhead_chars = self._template_chars(self.prompt)
+        self._batch_prompt_overhead_chars = self._template_chars(self.batch_prompt)
+        
+        # Deterministic classifier for well-known part families
+        self.rule_engine = None
+        if settings.RULE_ENGINE_ENABLED:
+            self.rule_engine = PartRuleEngine(min_confidence=settings.RULE_ENGINE_MIN_CONFIDENCE)
+        
+        # Persistent cache of AI fields keyed by part reference
+        self.cache = None
+        if settings.CACHE_ENABLED:
+            self.cache = EnrichmentCache(
+                db_path=Path(settings.CSV_STORAGE_PATH) / "enrichment_cache.sqlite3",
+                prompt_version=PROMPT_VERSION,
+                ttl_days=settings.CACHE_TTL_DAYS,
+                max_entries=settings.CACHE_MAX_ENTRIES
+            )
+        
+        # Character n-gram index of enriched parts, for near-duplicate descriptions
+        self.similar = None
+        if settings.SIMILARITY_ENABLED:
+            self.similar = SimilarityIndex(max_entries=settings.SIMILARITY_MAX_ENTRIES)
+            if self.cache is not None:
+                # Oldest first, so the least recently used parts are the first dropped
+                for referencia, descricao, ai_data in reversed(self.cache.recent(settings.SIMILARITY_MAX_ENTRIES)):
+                    self.similar.add(
+                        descricao, {field: ai_data[field] for field in SIMILAR_FIELDS if field in ai_data}, referencia
+                    )
+                logger.info(f"Similarity index loaded with {len(self.similar)} parts")
     
-    def _create_prompt_template(self) -> ChatPromptTemplate:
-        """Create the prompt template for data enrichment"""
+    def _create_backend(self, backend_settings: LLMBackendSettings) -> LLMBackend:
+        """Create the chat model and processing chains of one backend"""
+        # Retries are left to the scheduler (max_retries=0) so it can route them to another backend
+        async_client = openai.AsyncOpenAI(
+            api_key=backend_settings.api_key,
+            base_url=backend_settings.base_url or None,
+            timeout=self.request_timeout,
+            max_retries=0,
+            http_client=self.http_client
+        )
+        llm = ChatOpenAI(
+            openai_api_key=backend_settings.api_key,
+            openai_api_base=backend_settings.base_url or None,
+            model_name=backend_settings.model,
+            temperature=0.1,
+            max_tokens=self.max_tokens,
+            request_timeout=self.request_timeout,
+            max_retries=0,
+            async_client=async_client.chat.completions,
+            callbacks=[TokenUsageCallback(backend_settings.name)]
+        )
         
-        current_date = datetime.now().strftime('%Y-%m-%d')
+        return LLMBackend(
+            name=backend_settings.name,
+            llm=llm,
+            chain=self._create_processing_chain(self.prompt, llm),
+            batch_chain=self._create_processing_chain(
+                self.batch_prompt,
+                llm.bind(max_tokens=self.max_tokens * self.max_batch_size)
+            )
+        )
+    
+    def _backend(self, name: Optional[str]) -> LLMBackend:
+        """Backend chosen by the scheduler, or the first configured one"""
+        if name is None:
+            return next(iter(self.backends.values()))
+        return self.backends[name]
+    
+    def _create_system_message(self) -> str:
+        """Create the system message shared by single and batched prompts"""
         
-        system_message = f"""
+        return """
         Você é um especialista em peças automotivas Honda. Siga EXATAMENTE as regras de negócio abaixo:
 
         REGRAS DE ENRIQUECIMENTO:
@@ -52,28 +254,34 @@ class AIProductEnrichmentAgent:
            - Espelhos: 7009.10.00
            - Engrenagens: 8483.40.10
            - Peças plásticas: 3926.90.90
-
-        TEMPLATE DESCRIÇÃO ADICIONAL 2 (uma linha única):
-        "Descrição do Produto: [descrição limpa] Aplicação (Compatibilidade de Modelos e Ano): [modelos Honda] Descrição Técnica: [especificações] Marca: Honda Garantia: 3 meses Data: {current_date} Conteúdo da Embalagem: 1 UND de [produto] Dimensões em cm (Altura x Comprimento x Largura): [A]x[C]x[L] Peso (kg): [peso] Código SKU: [sku] Código do Fabricante/Referência: [ref] NCM: [ncm] Descrição NCM: [desc_ncm] Op: LK"
+        5. Aplicação: modelos Honda compatíveis e anos (ex: CG 160 Titan/Fan/Start 2016-2024)
+        6. Descrição técnica: especificações principais da peça em uma frase curta
+        7. Descrição NCM: descrição oficial resumida do NCM escolhido
 
         IMPORTANTE: 
         - Retorne APENAS JSON válido
-        - Descrição adicional 2 deve ser UMA LINHA única
+        - Textos curtos, em UMA LINHA, sem quebras
         - Use categorias específicas, não genéricas
         - Dimensões e peso devem ser realistas para o tipo de peça
         """
+    
+    @staticmethod
+    def _template_chars(prompt: ChatPromptTemplate) -> int:
+        """Count the characters of a prompt template without its variables"""
+        return sum(len(message.prompt.template) for message in prompt.messages)
+    
+    def _create_prompt_template(self) -> ChatPromptTemplate:
+        """Create the prompt template for data enrichment"""
+        
+        system_message = self._create_system_message()
         
         human_message = """
         Enriqueça os seguintes dados de peça automotiva Honda:
 
         Referência: {referencia}
         Descrição: {descricao}
-        Quantidade Estoque: {quantidade}
-        Preço de Venda: {preco_venda}
-        Preço de Custo: {preco_custo}
         SKU: {sku}
-        EAN: {ean}
-
+        {exemplos}
         Retorne um JSON válido com esta estrutura exata:
         {{
             "nome_categoria": "categoria específica (ex: Peças de Freio Moto, Fixação Moto, Parafusos Moto)",
@@ -82,12 +290,13 @@ class AIProductEnrichmentAgent:
             "comprimento": "comprimento em cm", 
             "largura": "largura em cm",
             "ncm": "código NCM apropriado",
-            "descricao_adicional_2": "template completo em UMA LINHA SEM quebras - substitua \\n por espaços"
+            "aplicacao": "modelos Honda compatíveis e anos",
+            "descricao_tecnica": "especificações técnicas em uma frase curta",
+            "descricao_ncm": "descrição resumida do NCM"
         }}
         
         IMPORTANTE: 
-        - A descrição_adicional_2 deve estar em UMA LINHA ÚNICA
-        - Substitua todas as quebras de linha por espaços
+        - Textos curtos em UMA LINHA, sem quebras
         - Use categorias específicas baseadas no tipo de peça
         """
         
@@ -96,51 +305,441 @@ class AIProductEnrichmentAgent:
             ("human", human_message)
         ])
     
-    def _create_processing_chain(self):
+    def _create_batch_prompt_template(self) -> ChatPromptTemplate:
+        """Create the prompt template for enriching several products in one call"""
+        
+        system_message = self._create_system_message()
+        
+        human_message = """
+        Enriqueça as seguintes peças automotivas Honda (lista JSON, um objeto por peça):
+
+        {produtos}
+        {exemplos}
+        Retorne um array JSON válido com um objeto por peça, na mesma ordem, com esta estrutura exata:
+        [
+            {{
+                "sku": "SKU da peça exatamente como informado",
+                "nome_categoria": "categoria específica (ex: Peças de Freio Moto, Fixação Moto, Parafusos Moto)",
+                "peso": "peso estimado em kg",
+                "altura": "altura em cm",
+                "comprimento": "comprimento em cm", 
+                "largura": "largura em cm",
+                "ncm": "código NCM apropriado",
+                "aplicacao": "modelos Honda compatíveis e anos",
+                "descricao_tecnica": "especificações técnicas em uma frase curta",
+                "descricao_ncm": "descrição resumida do NCM"
+            }}
+        ]
+        
+        IMPORTANTE: 
+        - Inclua TODAS as peças da lista, identificadas pelo SKU
+        - Textos curtos em UMA LINHA, sem quebras
+        - Use categorias específicas baseadas no tipo de peça
+        """
+        
+        return ChatPromptTemplate.from_messages([
+            ("system", system_message),
+            ("human", human_message)
+        ])
+    
+    def _create_processing_chain(self, prompt: ChatPromptTemplate, llm):
         """Create the LangChain processing chain"""
         return (
             RunnablePassthrough()
-            | self.prompt
-            | self.llm
+            | prompt
+            | llm
             | self.parser
         )
     
-    async def enrich_product_data(self, product_data: Dict[str, str]) -> Dict[str, Any]:
+    def estimate_tokens(self, product_data: Dict[str, str]) -> int:
+        """Estimate prompt + completion tokens of one enrichment call"""
+        product_chars = sum(len(value) for value in self._llm_input(product_data).values())
+        prompt_tokens = (self._prompt_overhead_chars + product_chars + self._example_chars()) // CHARS_PER_TOKEN
+        return prompt_tokens + EXPECTED_COMPLETION_TOKENS
+    
+    def estimate_batch_tokens(self, products: List[Dict[str, str]]) -> int:
+        """Estimate prompt + completion tokens of one batched enrichment call"""
+        if len(products) == 1:
+            return self.estimate_tokens(products[0])
+        
+        product_chars = sum(len(self._batch_product_json(product)) for product in products)
+        prompt_tokens = (self._batch_prompt_overhead_chars + product_chars + self._example_chars()) // CHARS_PER_TOKEN
+        return prompt_tokens + EXPECTED_COMPLETION_TOKENS * len(products)
+    
+    def _example_chars(self) -> int:
+        """Upper bound of the prompt examples added to one call"""
+        if self.similar is None:
+            return 0
+        return settings.SIMILARITY_MAX_EXAMPLES * EXAMPLE_CHARS
+    
+    def plan_batches(self, products: List[Dict[str, str]]) -> List[List[int]]:
+        """
+        Group products into batches for batched enrichment
+        
+        Batches close when they reach the maximum batch size or when the
+        product text exceeds AI_BATCH_MAX_INPUT_CHARS, so rows with long
+        descriptions get smaller batches. Products sharing a SKU never share
+        a batch because results are matched back by SKU.
+        
+        Returns:
+            List of batches, each a list of indexes into `products`
+        """
+        batches = []
+        current = []
+        current_chars = 0
+        current_skus = set()
+        
+        for index, product in enumerate(products):
+            product_chars = len(self._batch_product_json(product))
+            sku = str(product.get("sku", "")).strip()
+            
+            if current and (
+                len(current) >= self.max_batch_size
+                or current_chars + product_chars > settings.AI_BATCH_MAX_INPUT_CHARS
+                or sku in current_skus
+            ):
+                batches.append(current)
+                current, current_chars, current_skus = [], 0, set()
+            
+            current.append(index)
+            current_chars += product_chars
+            current_skus.add(sku)
+        
+        if current:
+            batches.append(current)
+        
+        return batches
+    
+    async def enrich_products_batch(
+        self,
+        products: List[Dict[str, str]],
+        backend: Optional[str] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Enrich several products with a single AI call
+        
+        Args:
+            products: List of product dictionaries (same keys as enrich_product_data)
+            backend: Name of the LLM backend to call, the first configured one by default
+        
+        Returns:
+            Enriched data per product, in input order. Products the model
+            dropped or returned incomplete are None so the caller can retry
+            them on their own.
+        
+        Raises:
+            RETRYABLE_ERRORS: transient provider errors, so the call can be retried
+        
+        The cache is not consulted here; callers are expected to resolve
+        cached products with enrich_many_from_cache before batching.
+        """
+        if len(products) == 1:
+            result = await self.enrich_product(products[0], use_cache=False, backend=backend)
+            return [result.data]
+        
+        try:
+            logger.info(f"Enriching batch of {len(products)} products")
+            
+            cleaned_products = [self._clean_input_data(product) for product in products]
+            produtos = "[\n" + ",\n".join(
+                self._batch_product_json(product) for product in cleaned_products
+            ) + "\n]"
+            
+            # Process with AI
+            llm_backend = self._backend(backend)
+            # Index lookups are CPU-bound: keep them off the event loop
+            exemplos = await asyncio.to_thread(self._similar_examples, cleaned_products)
+            with LLM_CALL_SECONDS.labels(kind="batch", backend=llm_backend.name).time():
+                result = await llm_backend.batch_chain.ainvoke({"produtos": produtos, "exemplos": exemplos})
+            
+            # Parse AI response and match items back by SKU
+            items_by_sku = {}
+            for item in self._parse_ai_batch_response(result):
+                if isinstance(item, dict) and "sku" in item:
+                    items_by_sku[str(item["sku"]).strip()] = item
+            
+            results = []
+            for cleaned_data in cleaned_products:
+                ai_data = items_by_sku.get(cleaned_data.get("sku", ""))
+                if ai_data is None or not self._is_complete(ai_data):
+                    logger.warning(f"Batch response missing or incomplete for SKU: {cleaned_data.get('sku', 'Unknown')}")
+                    results.append(None)
+                    continue
+                self._store_enrichment(cleaned_data, ai_data)
+                results.append(self._convert_to_csv_format(ai_data, cleaned_data))
+            
+            logger.info(f"Batch enriched {sum(1 for r in results if r)}/{len(products)} products")
+            return results
+            
+        except RETRYABLE_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Error enriching product batch: {str(e)}")
+            return [None] * len(products)
+    
+    def _llm_input(self, product: Dict[str, str]) -> Dict[str, str]:
+        """The product fields sent to the model"""
+        return {field: str(product.get(field, "")).strip() for field in LLM_INPUT_FIELDS}
+    
+    def _batch_product_json(self, product: Dict[str, str]) -> str:
+        """Serialize the product fields sent in batched prompts"""
+        return json.dumps(self._llm_input(product), ensure_ascii=False)
+    
+    def _is_complete(self, ai_data: Dict[str, Any]) -> bool:
+        """Check that an item returned by the model has every enrichment field"""
+        return all(ai_data.get(field) not in (None, "") for field in AI_FIELDS)
+    
+    def enrich_from_rules(self, product_data: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Return enriched data from the rule engine, or None if the part is not confidently known"""
+        if self.rule_engine is None:
+            return None
+        
+        cleaned_data = self._clean_input_data(product_data)
+        rule = self.rule_engine.enrich(cleaned_data.get("referencia", ""), cleaned_data.get("descricao", ""))
+        if rule is None:
+            return None
+        
+        # Rules have no application; description 2 keeps the generic one
+        ai_data = {field: rule[field] for field in AI_FIELDS if field in rule}
+        
+        return self._convert_to_csv_format(ai_data, cleaned_data)
+    
+    def enrich_from_cache(self, product_data: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Return enriched data from the persistent cache, or None on a miss"""
+        if self.cache is None:
+            return None
+        
+        cleaned_data = self._clean_input_data(product_data)
+        ai_data = self.cache.get(cleaned_data.get("referencia", ""), cleaned_data.get("descricao", ""))
+        if ai_data is None:
+            return None
+        
+        return self._convert_to_csv_format(ai_data, cleaned_data)
+    
+    def enrich_many_from_cache(self, products: List[Dict[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Enriched data of many products from the persistent cache, None on a miss
+        
+        One query per few hundred products instead of one per product; the
+        lookups block, so async callers run them in a thread.
+        """
+        if self.cache is None:
+            return [None] * len(products)
+        
+        cleaned = [self._clean_input_data(product_data) for product_data in products]
+        cached = self.cache.get_many([
+            (cleaned_data.get("referencia", ""), cleaned_data.get("descricao", "")) for cleaned_data in cleaned
+        ])
+        return [
+            None if ai_data is None else self._convert_to_csv_format(ai_data, cleaned_data)
+            for ai_data, cleaned_data in zip(cached, cleaned)
+        ]
+    
+    def enrich_from_similar(self, product_data: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Return enriched data copied from a near-duplicate part, or None
+        
+        Category, NCM, weight and dimensions of the most similar indexed part
+        are reused when it scores at least SIMILARITY_REUSE_THRESHOLD and names
+        the same part (same first word and reference family, not a kit); like
+        rules, description 2 keeps the generic application and technical text.
+        Lookups are CPU-bound, so async callers run them in a thread.
+        """
+        if self.similar is None:
+            return None
+        
+        cleaned_data = self._clean_input_data(product_data)
+        with SIMILARITY_LOOKUP_SECONDS.labels(kind="reuse").time():
+            match = self.similar.reusable(
+                cleaned_data.get("descricao", ""), cleaned_data.get("referencia", ""), settings.SIMILARITY_REUSE_THRESHOLD
+            )
+        if match is None:
+            return None
+        
+        return self._convert_to_csv_format(match[1].fields, cleaned_data)
+    
+    def _similar_examples(self, products: List[Dict[str, str]]) -> str:
+        """Prompt block with the enriched parts nearest to the products, or an empty string"""
+        if self.similar is None or settings.SIMILARITY_MAX_EXAMPLES <= 0:
+            return ""
+        
+        # Best score per example across the products
+        examples = {}
+        with SIMILARITY_LOOKUP_SECONDS.labels(kind="examples").time():
+            for product in products:
+                for score, part in self.similar.nearest(
+                    product.get("descricao", ""), settings.SIMILARITY_MAX_EXAMPLES, settings.SIMILARITY_EXAMPLE_MIN_SCORE
+                ):
+                    if score > examples.get(part.text, (0.0, None))[0]:
+                        examples[part.text] = (score, part)
+        if not examples:
+            return ""
+        
+        nearest = sorted(examples.values(), key=lambda item: item[0], reverse=True)[:settings.SIMILARITY_MAX_EXAMPLES]
+        lines = [
+            json.dumps({"descricao": part.text, **part.fields}, ensure_ascii=False)
+            for _, part in nearest
+        ]
+        return (
+            "\nPeças semelhantes já classificadas (use como referência de categoria, NCM, peso e dimensões):\n"
+            + "\n".join(lines) + "\n"
+        )
+    
+    def part_key(self, product_data: Dict[str, str]) -> str:
+        """Identity of a part within a file: normalized reference and description"""
+        return "|".join(
+            EnrichmentCache.normalize(str(product_data.get(field) or "").strip())
+            for field in ("referencia", "descricao")
+        )
+    
+    def enrich_from_part(self, product_data: Dict[str, str], part_row: Dict[str, Any]) -> Dict[str, Any]:
+        """Enriched data for a product, copying the AI fields of another row of the same part"""
+        cleaned_data = self._clean_input_data(product_data)
+        ai_data = {
+            "nome_categoria": part_row["Nome da categoria"],
+            "peso": part_row["Peso"],
+            "altura": part_row["Altura"],
+            "comprimento": part_row["Comprimento"],
+            "largura": part_row["Largura"],
+            "ncm": part_row["NCM"],
+            # Assembled for the other row's SKU
+            "descricao_adicional_2": self._rebase_description_2(
+                part_row["Descrição adicional 2 (BR)"], cleaned_data, part_row.get("SKU", "")
+            )
+        }
+        
+        return self._convert_to_csv_format(ai_data, cleaned_data)
+    
+    def rebase_row(self, product_data: Dict[str, str], row: Dict[str, Any]) -> Dict[str, Any]:
+        """A stored output row of the same item, with the product's SKU and description 2 rebased to it and today"""
+        cleaned_data = self._clean_input_data(product_data)
+        rebased = dict(row)
+        rebased["SKU"] = cleaned_data.get("sku", "")
+        rebased["Descrição adicional 2 (BR)"] = self._rebase_description_2(
+            row.get("Descrição adicional 2 (BR)", ""), cleaned_data, row.get("SKU", "")
+        )
+        return rebased
+    
+    def _store_enrichment(self, cleaned_data: Dict[str, str], ai_data: Dict[str, Any]):
+        """Store complete AI fields in the similarity index and the persistent cache"""
+        if not self._is_complete(ai_data):
+            return
+        
+        if self.similar is not None:
+            self.similar.add(
+                cleaned_data.get("descricao", ""),
+                {field: ai_data[field] for field in SIMILAR_FIELDS},
+                cleaned_data.get("referencia", "")
+            )
+        
+        if self.cache is None:
+            return
+        
+        try:
+            self.cache.set(
+                cleaned_data.get("referencia", ""),
+                cleaned_data.get("descricao", ""),
+                {field: ai_data[field] for field in AI_FIELDS}
+            )
+        except Exception as e:
+            logger.warning(f"Failed to write enrichment cache: {str(e)}")
+    
+    def _rebase_description_2(self, description: str, original_data: Dict, previous_sku: str) -> str:
+        """Point a description 2 assembled for the row with previous_sku at the current SKU and date"""
+        current_date = datetime.now().strftime('%Y-%m-%d')
+        # As written by _clean_description_2: single spaces, no trailing space for an empty SKU
+        previous_label = f"Código SKU: {WHITESPACE.sub(' ', str(previous_sku or '')).strip()}".rstrip()
+        current_label = f"Código SKU: {WHITESPACE.sub(' ', str(original_data.get('sku') or '')).strip()}".rstrip()
+        description = re.sub(
+            re.escape(previous_label) + r"(?=\s|$)", lambda _: current_label, description, count=1
+        )
+        return DATE_LABEL.sub(lambda _: f"Data: {current_date}", description)
+    
+    async def enrich_product_data(self, product_data: Dict[str, str], use_cache: bool = True) -> Dict[str, Any]:
         """
         Enrich product data using AI
         
         Args:
             product_data: Dictionary with keys: referencia, descricao, quantidade, 
                          preco_venda, preco_custo, sku, ean
+            use_cache: Look the part up in the persistent cache and similarity index before calling the model
         
         Returns:
             Dictionary with enriched product data
         """
+        result = await self.enrich_product(product_data, use_cache=use_cache)
+        return result.data
+    
+    async def enrich_product(
+        self,
+        product_data: Dict[str, str],
+        use_cache: bool = True,
+        backend: Optional[str] = None
+    ) -> EnrichmentResult:
+        """
+        Enrich product data and report where the enrichment came from
+        
+        Transient provider errors (RETRYABLE_ERRORS) are raised so the caller
+        can retry; any other failure returns fallback data with its reason.
+        `backend` names the LLM backend to call, the first configured one by default.
+        """
         try:
             logger.info(f"Enriching product data for SKU: {product_data.get('sku', 'Unknown')}")
             
+            # Well-known part families never need the model
+            rule_data = self.enrich_from_rules(product_data)
+            if rule_data is not None:
+                return EnrichmentResult(data=rule_data, source="rules")
+            
+            if use_cache:
+                cached_data = await asyncio.to_thread(self.enrich_from_cache, product_data)
+                if cached_data is not None:
+                    return EnrichmentResult(data=cached_data, source="cache")
+                
+                similar_data = await asyncio.to_thread(self.enrich_from_similar, product_data)
+                if similar_data is not None:
+                    return EnrichmentResult(data=similar_data, source="similar")
+            
             # Clean and prepare input data
             cleaned_data = self._clean_input_data(product_data)
             
             # Process with AI
-            result = await self.chain.ainvoke(cleaned_data)
+            llm_backend = self._backend(backend)
+            exemplos = await asyncio.to_thread(self._similar_examples, [cleaned_data])
+            with LLM_CALL_SECONDS.labels(kind="single", backend=llm_backend.name).time():
+                result = await llm_backend.chain.ainvoke({**self._llm_input(cleaned_data), "exemplos": exemplos})
             
             # Parse AI response
             ai_data = self._parse_ai_response(result)
+            self._store_enrichment(cleaned_data, ai_data)
             
             # Convert to final CSV format
             csv_data = self._convert_to_csv_format(ai_data, cleaned_data)
             
+            if not self._is_complete(ai_data):
+                # Missing fields were filled with defaults by _convert_to_csv_format
+                return EnrichmentResult(data=csv_data, source="fallback", reason="Incomplete AI response")
+            
             logger.info(f"Successfully enriched data for SKU: {cleaned_data.get('sku', 'Unknown')}")
-            return csv_data
+            return EnrichmentResult(data=csv_data, source="llm")
             
+        except RETRYABLE_ERRORS:
+            raise
         except Exception as e:
             logger.error(f"Error enriching product data: {str(e)}")
             # Return fallback data
-            return self._create_fallback_data(product_data)
+            return EnrichmentResult(
+                data=self._create_fallback_data(product_data),
+                source="fallback",
+                reason=str(e)
+            )
     
     def _clean_input_data(self, data: Dict[str, str]) -> Dict[str, str]:
         """Clean and validate input data"""
+        if all(field in data for field in DERIVED_FIELDS):
+            # Already cleaned column-wise by prepare_products
+            return data
+        
         cleaned = {}
         
         for key, value in data.items():
@@ -150,7 +749,7 @@ class AIProductEnrichmentAgent:
                 cleaned[key] = str(value).strip()
         
         # Clean price formats
-        for price_field in ['preco_venda', 'preco_custo']:
+        for price_field in PRICE_FIELDS:
             if price_field in cleaned:
                 cleaned[price_field] = self._clean_price(cleaned[price_field])
         
@@ -158,32 +757,27 @@ class AIProductEnrichmentAgent:
     
     def _clean_price(self, price_str: str) -> str:
         """Clean price string to decimal format"""
-        if not price_str:
-            return "0.00"
-        
-        # Remove R$, spaces, and convert comma to dot
-        cleaned = price_str.replace('R$', '').replace(' ', '').replace(',', '.')
+        return clean_price(price_str)
+    
+    def _strip_markdown(self, response: str) -> str:
+        """Remove markdown code fences around a JSON response"""
+        cleaned_response = response.strip()
+        if cleaned_response.startswith('```json'):
+            cleaned_response = cleaned_response[7:]
+        if cleaned_response.endswith('```'):
+            cleaned_response = cleaned_response[:-3]
         
-        try:
-            float_price = float(cleaned)
-            return f"{float_price:.2f}"
-        except ValueError:
-            return "0.00"
+        return cleaned_response.strip()
     
     def _parse_ai_response(self, response: str) -> Dict[str, Any]:
         """Parse AI response and extract JSON data"""
         try:
-            # Clean response - remove markdown formatting if present
-            cleaned_response = response.strip()
-            if cleaned_response.startswith('```json'):
-                cleaned_response = cleaned_response[7:]
-            if cleaned_response.endswith('```'):
-                cleaned_response = cleaned_response[:-3]
-            
-            cleaned_response = cleaned_response.strip()
-            
-            # Parse JSON
-            parsed_data = json.loads(cleaned_response)
+            with JSON_PARSE_SECONDS.labels(kind="single").time():
+                # Clean response - remove markdown formatting if present
+                cleaned_response = self._strip_markdown(response)
+                
+                # Parse JSON
+                parsed_data = json.loads(cleaned_response)
             return parsed_data
             
         except (json.JSONDecodeError, Exception) as e:
@@ -191,26 +785,60 @@ class AIProductEnrichmentAgent:
             logger.debug(f"Raw response: {response}")
             return {}
     
+    def _parse_ai_batch_response(self, response: str) -> List[Any]:
+        """Parse a batched AI response into a list of product items"""
+        try:
+            with JSON_PARSE_SECONDS.labels(kind="batch").time():
+                parsed_data = json.loads(self._strip_markdown(response))
+            
+            # Accept {"produtos": [...]} style wrappers around the array
+            if isinstance(parsed_data, dict):
+                arrays = [value for value in parsed_data.values() if isinstance(value, list)]
+                parsed_data = arrays[0] if arrays else [parsed_data]
+            
+            return parsed_data if isinstance(parsed_data, list) else []
+            
+        except (json.JSONDecodeError, Exception) as e:
+            logger.warning(f"Failed to parse batched AI response as JSON: {str(e)}")
+            logger.debug(f"Raw response: {response}")
+            return []
+    
     def _convert_to_csv_format(self, enriched_data: Dict, original_data: Dict) -> Dict[str, Any]:
         """Convert enriched data to CSV format with all required fields"""
         
+        # original_data is cleaned (prices normalized); prepared products also carry the derived fields
+        nome_produto = original_data.get("nome_produto")
+        if nome_produto is None:
+            nome_produto = self._create_product_name(original_data.get('descricao', ''))[:60]
+        descricao_br = original_data.get("descricao_br")
+        if descricao_br is None:
+            descricao_br = f"{original_data.get('descricao', '')} SKU: LK {original_data.get('sku', '')}"
+        
+        # Description 2 is assembled from the template; the model only returns its variable fields
+        descricao_adicional_2 = enriched_data.get("descricao_adicional_2")
+        if descricao_adicional_2 is None:
+            descricao_adicional_2 = self._build_description_2(
+                original_data,
+                **{field: str(enriched_data[field]) for field in DESCRIPTION_2_FIELDS if enriched_data.get(field)}
+            )
+        
         # Base data combining original + AI enrichment
         csv_data = {
             "ID_produto": original_data.get("sku", ""),
             "ID_OEM": original_data.get("referencia", ""),
-            "Nome do Produto (BR)": self._create_product_name(original_data.get('descricao', ''))[:60],
+            "Nome do Produto (BR)": nome_produto,
             "ID do Fabricante": original_data.get("referencia", ""),
             "Quantidade (Padrão)": original_data.get("quantidade", ""),
             "EAN": original_data.get("ean", ""),
             "SKU": original_data.get("sku", ""),
             "Nome da categoria": enriched_data.get("nome_categoria", "Peças Automotivas"),
-            "Preço (Padrão (BRL))": self._clean_price(original_data.get("preco_venda", "0")),
-            "Preço de Compra": self._clean_price(original_data.get("preco_custo", "0")),
-            "Custo (médio)": self._clean_price(original_data.get("preco_custo", "0")),
+            "Preço (Padrão (BRL))": original_data.get("preco_venda", "0.00"),
+            "Preço de Compra": original_data.get("preco_custo", "0.00"),
+            "Custo (médio)": original_data.get("preco_custo", "0.00"),
             "Peso": enriched_data.get("peso", "0.10"),
-            "Descrição (BR)": f"{original_data.get('descricao', '')} SKU: LK {original_data.get('sku', '')}",
+            "Descrição (BR)": descricao_br,
             "Descrição adicional 1 (BR)": "incluir texto",
-            "Descrição adicional 2 (BR)": self._clean_description_2(enriched_data.get("descricao_adicional_2", self._create_default_description_2(original_data))),
+            "Descrição adicional 2 (BR)": self._clean_description_2(descricao_adicional_2),
             "Nome do fabricante": "Honda",
             "Altura": enriched_data.get("altura", "5.0"),
             "Comprimento": enriched_data.get("comprimento", "10.0"),
@@ -238,38 +866,48 @@ class AIProductEnrichmentAgent:
     
     def _create_default_description_2(self, original_data: Dict) -> str:
         """Create default description 2 template in single line"""
+        return self._build_description_2(original_data)
+    
+    def _build_description_2(
+        self,
+        original_data: Dict,
+        peso: str = "0.10",
+        altura: str = "5.0",
+        comprimento: str = "10.0",
+        largura: str = "5.0",
+        ncm: str = "8714.19.00",
+        descricao_ncm: str = "Partes e acessórios de motocicletas",
+        aplicacao: str = "Modelos Honda compatíveis",
+        descricao_tecnica: str = "Peça original Honda de alta qualidade"
+    ) -> str:
+        """Fill the description 2 template in a single line"""
         current_date = datetime.now().strftime('%Y-%m-%d')
         
         # Create template following EXACT business rules format
-        desc_clean = self._extract_product_description(original_data.get('descricao', ''))
+        desc_clean = original_data.get("descricao_produto")
+        if desc_clean is None:
+            desc_clean = self._extract_product_description(original_data.get('descricao', ''))
         
         template = f"Descrição do Produto: {desc_clean} " \
-                  f"Aplicação (Compatibilidade de Modelos e Ano): Modelos Honda compatíveis " \
-                  f"Descrição Técnica: Peça original Honda de alta qualidade " \
+                  f"Aplicação (Compatibilidade de Modelos e Ano): {aplicacao} " \
+                  f"Descrição Técnica: {descricao_tecnica} " \
                   f"Marca: Honda " \
                   f"Garantia: 3 meses " \
                   f"Data: {current_date} " \
                   f"Conteúdo da Embalagem: 1 UND de {desc_clean} " \
-                  f"Dimensões em cm (Altura x Comprimento x Largura): 5.0x10.0x5.0 " \
-                  f"Peso (kg): 0.10 " \
+                  f"Dimensões em cm (Altura x Comprimento x Largura): {altura}x{comprimento}x{largura} " \
+                  f"Peso (kg): {peso} " \
                   f"Código SKU: {original_data.get('sku', '')} " \
                   f"Código do Fabricante/Referência: {original_data.get('referencia', '')} " \
-                  f"NCM: 8714.19.00 " \
-                  f"Descrição NCM: Partes e acessórios de motocicletas " \
+                  f"NCM: {ncm} " \
+                  f"Descrição NCM: {descricao_ncm} " \
                   f"Op: LK"
         
         return template
     
     def _extract_product_description(self, description: str) -> str:
         """Extract clean product description removing reference numbers"""
-        import re
-        
-        # Remove reference number if description starts with it
-        match = re.match(r'^[\d\w]+\s+(.+)$', description)
-        if match:
-            return match.group(1)
-        
-        return description
+        return strip_reference(description)
     
     def _clean_description_2(self, description: str) -> str:
         """Clean description 2 to ensure single line"""
@@ -280,22 +918,15 @@ class AIProductEnrichmentAgent:
         cleaned = description.replace('\n', ' ').replace('\r', ' ')
         
         # Replace multiple spaces with single space
-        import re
-        cleaned = re.sub(r'\s+', ' ', cleaned)
+        cleaned = WHITESPACE.sub(' ', cleaned)
         
         # Strip leading/trailing spaces
         return cleaned.strip()
     
     def _create_product_name(self, description: str) -> str:
         """Create product name following business rules"""
-        # Remove reference number from description if present
-        desc_clean = description
-        
         # Extract the actual product description (remove reference if it starts with numbers)
-        import re
-        match = re.match(r'^[\d\w]+\s+(.+)$', desc_clean)
-        if match:
-            desc_clean = match.group(1)
+        desc_clean = strip_reference(description)
         
         # Format: Product description + "Honda Genuíno"
         return f"{desc_clean} Honda Genuíno"
@@ -304,6 +935,11 @@ class AIProductEnrichmentAgent:
         """Create fallback data when AI processing fails"""
         logger.warning(f"Creating fallback data for SKU: {original_data.get('sku', 'Unknown')}")
         
+        original_data = self._clean_input_data(original_data)
+        descricao_br = original_data.get("descricao_br")
+        if descricao_br is None:
+            descricao_br = f"{original_data.get('descricao', '')} SKU: LK {original_data.get('sku', '')}"
+        
         return {
             "ID_produto": original_data.get("sku", ""),
             "ID_OEM": original_data.get("referencia", ""),
@@ -313,11 +949,11 @@ class AIProductEnrichmentAgent:
             "EAN": original_data.get("ean", ""),
             "SKU": original_data.get("sku", ""),
             "Nome da categoria": "Peças Automotivas",
-            "Preço (Padrão (BRL))": self._clean_price(original_data.get("preco_venda", "0")),
-            "Preço de Compra": self._clean_price(original_data.get("preco_custo", "0")),
-            "Custo (médio)": self._clean_price(original_data.get("preco_custo", "0")),
+            "Preço (Padrão (BRL))": original_data.get("preco_venda", "0.00"),
+            "Preço de Compra": original_data.get("preco_custo", "0.00"),
+            "Custo (médio)": original_data.get("preco_custo", "0.00"),
             "Peso": "0.10",
-            "Descrição (BR)": f"{original_data.get('descricao', '')} SKU: LK {original_data.get('sku', '')}",
+            "Descrição (BR)": descricao_br,
             "Descrição adicional 1 (BR)": "incluir texto",
             "Descrição adicional 2 (BR)": self._create_default_description_2(original_data),
             "Nome do fabricante": "Honda",
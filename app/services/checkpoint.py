@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+from loguru import logger
+
+
+class CheckpointJournal:
+    """
+    SQLite journal of enriched rows per input file, used to resume interrupted runs
+
+    Runs are keyed by the input content and the prompt version, so rows
+    enriched with an older prompt are never resumed. A completed run keeps
+    only its summary: its rows are deleted, so processing the file again
+    enriches it again.
+    """
+
+    def __init__(self, db_path: Path, retention_hours: int, prompt_version: str):
+        self.db_path = Path(db_path)
+        self.retention_hours = retention_hours
+        self.prompt_version = prompt_version
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint_runs (
+                file_key TEXT PRIMARY KEY,
+                input_name TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                completed_at REAL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint_rows (
+                file_key TEXT NOT NULL,
+                row_index INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (file_key, row_index)
+            )
+        """)
+        self._conn.commit()
+
+    def file_key(self, content_hash: str) -> str:
+        """Journal key of an input content under the current prompt version"""
+        return f"{content_hash}:{self.prompt_version}"
+
+    def start_run(self, file_key: str, input_name: str, restart: bool = False) -> int:
+        """
+        Register a run for a file and return how many rows are already journaled
+
+        With `restart`, rows journaled by an earlier run are dropped and the
+        file is enriched from scratch.
+        """
+        now = time.time()
+
+        with self._lock:
+            if restart:
+                self._conn.execute("DELETE FROM checkpoint_rows WHERE file_key = ?", (file_key,))
+            self._conn.execute(
+                "INSERT INTO checkpoint_runs (file_key, input_name, started_at, updated_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(file_key) DO UPDATE SET input_name = excluded.input_name, "
+                "updated_at = excluded.updated_at, completed_at = NULL",
+                (file_key, input_name, now, now)
+            )
+            self._conn.commit()
+            done = self._conn.execute(
+                "SELECT COUNT(*) FROM checkpoint_rows WHERE file_key = ?", (file_key,)
+            ).fetchone()[0]
+
+        if done:
+            logger.info(f"Resuming {input_name}: {done} rows already journaled")
+        return done
+
+    def load(self, file_key: str, first_row: int, row_count: int) -> Dict[int, Dict[str, Any]]:
+        """Return journaled rows with index in [first_row, first_row + row_count)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_index, data FROM checkpoint_rows "
+                "WHERE file_key = ? AND row_index >= ? AND row_index < ?",
+                (file_key, first_row, first_row + row_count)
+            ).fetchall()
+
+        return {row_index: json.loads(data) for row_index, data in rows}
+
+    def record(self, file_key: str, rows: List[Tuple[int, Dict[str, Any]]]):
+        """Journal completed rows as (row_index, enriched_data) pairs"""
+        if not rows:
+            return
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO checkpoint_rows (file_key, row_index, data) VALUES (?, ?, ?)",
+                [(file_key, row_index, json.dumps(data, ensure_ascii=False)) for row_index, data in rows]
+            )
+            self._conn.execute(
+                "UPDATE checkpoint_runs SET updated_at = ? WHERE file_key = ?", (time.time(), file_key)
+            )
+            self._conn.commit()
+
+    def complete(self, file_key: str):
+        """Mark a run as completed and drop its rows, which only served to resume it"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE checkpoint_runs SET completed_at = ?, updated_at = ? WHERE file_key = ?",
+                (now, now, file_key)
+            )
+            self._conn.execute("DELETE FROM checkpoint_rows WHERE file_key = ?", (file_key,))
+            self._conn.commit()
+
+    def cleanup(self, older_than_hours: Optional[float] = None) -> int:
+        """Delete runs (and their rows) not touched for the given number of hours"""
+        hours = self.retention_hours if older_than_hours is None else older_than_hours
+        cutoff = time.time() - hours * 3600
+
+        with self._lock:
+            keys = [
+                row[0] for row in self._conn.execute(
+                    "SELECT file_key FROM checkpoint_runs WHERE updated_at < ?", (cutoff,)
+                ).fetchall()
+            ]
+            for file_key in keys:
+                self._conn.execute("DELETE FROM checkpoint_rows WHERE file_key = ?", (file_key,))
+                self._conn.execute("DELETE FROM checkpoint_runs WHERE file_key = ?", (file_key,))
+            self._conn.commit()
+
+        if keys:
+            logger.info(f"Removed {len(keys)} old checkpoints")
+        return len(keys)
+
+    def list_runs(self) -> List[Dict[str, Any]]:
+        """Summary of journaled runs"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.file_key, r.input_name, r.started_at, r.updated_at, r.completed_at, "
+                "(SELECT COUNT(*) FROM checkpoint_rows c WHERE c.file_key = r.file_key) "
+                "FROM checkpoint_runs r ORDER BY r.updated_at DESC"
+            ).fetchall()
+
+        return [
+            {
+                "file_key": file_key,
+                "input_name": input_name,
+                "started_at": started_at,
+                "updated_at": updated_at,
+                "completed_at": completed_at,
+                "journaled_rows": journaled_rows
+            }
+            for file_key, input_name, started_at, updated_at, completed_at, journaled_rows in rows
+        ]
@@ -1,43 +1,305 @@
 import pandas as pd
 import asyncio
+import csv
+import io
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import AsyncIterator, Callable, Dict, Any, Iterator, List, Optional, TextIO, Tuple
 from loguru import logger
 from app.core.config import settings
-from app.services.ai_agent import AIProductEnrichmentAgent
+from app.models.csv_models import CSVOutputRow, EnrichmentResult
+from app.services.ai_agent import AIProductEnrichmentAgent, PROMPT_VERSION, RETRYABLE_ERRORS
+from app.services.checkpoint import CheckpointJournal
+from app.services.file_index import ProcessedFileIndex
+from app.services.ingestion import read_chunks, sniff_dialect
+from app.services.metrics import CSV_READ_SECONDS, CSV_WRITE_SECONDS, ROWS
+from app.services.preprocessing import prepare_products
+from app.services.scheduler import Backend, CircuitBreaker, EnrichmentScheduler, Flow
+from app.services.supplier_catalog import SupplierCatalog, patch_row
+from app.services.upload_storage import hash_file
 from datetime import datetime
 
+# Output CSV header, in BaseBlinker column order
+OUTPUT_COLUMNS = [field.alias for field in CSVOutputRow.model_fields.values()]
+
+# Sidecar report: how each output row was enriched, and why it fell back
+REPORT_COLUMNS = ["row", "SKU", "source", "reason"]
+
+# Sidecar of supplier uploads: items of the previous catalog missing from this one
+REMOVED_COLUMNS = ["SKU", "Referencia", "Descricao"]
+
+# Flush the output and report progress every N rows
+PROGRESS_INTERVAL = 100
+
+# Enriched parts kept per file for copying to later rows of the same part
+PART_MEMO_SIZE = 10000
+
+class FileRun:
+    """State shared by the chunks of one process_file call"""
+    
+    def __init__(
+        self,
+        input_path: Path,
+        file_key: Optional[str],
+        flow: Flow,
+        supplier: Optional[str] = None,
+        catalog_run: Optional[str] = None
+    ):
+        self.input_path = input_path
+        self.file_key = file_key
+        # This file's share of the LLM backends among concurrent runs
+        self.flow = flow
+        # Supplier whose previous catalog the rows are diffed against, and this upload's run id
+        self.supplier = supplier
+        self.catalog_run = catalog_run
+        self.path_counts = {
+            "resumed": 0, "unchanged": 0, "patched": 0, "rules": 0, "cache": 0, "similar": 0,
+            "llm": 0, "dedup": 0, "fallback": 0
+        }
+        # Parts already sent to the LLM in this file, and the rows enriched for them
+        self.part_keys = set()
+        self.part_rows: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    
+    def add(self, source: str, rows: int = 1):
+        """Count rows enriched through one path"""
+        self.path_counts[source] += rows
+        ROWS.labels(source=source).inc(rows)
+    
+    def count(self, result: EnrichmentResult):
+        self.add(result.source)
+    
+    def remember_part(self, part_key: str, enriched_data: Dict[str, Any]):
+        """Keep an LLM-enriched row so later rows of the same part can copy it"""
+        if part_key not in self.part_keys:
+            return
+        self.part_rows[part_key] = enriched_data
+        self.part_rows.move_to_end(part_key)
+        if len(self.part_rows) > PART_MEMO_SIZE:
+            self.part_rows.popitem(last=False)
+
+class ChunkWork:
+    """One input chunk being enriched: locally resolved rows plus in-flight LLM batches"""
+    
+    def __init__(
+        self,
+        products: List[Dict[str, str]],
+        results: List[Optional[EnrichmentResult]],
+        batches: List[List[int]],
+        tasks: List[asyncio.Task],
+        first_row: int,
+        repeats: Dict[int, Tuple[str, Dict[str, str]]],
+        first_positions: Dict[str, int]
+    ):
+        self.products = products
+        self.results = results
+        self.tasks = tasks
+        self.first_row = first_row
+        # Row position -> (part key, input data) for rows copying an earlier row of the same part
+        self.repeats = repeats
+        # Part key -> position of the part's first row, for parts first seen in this chunk
+        self.first_positions = first_positions
+        # Parts enriched again for their repeats after their first row fell back
+        self.retried_parts = set()
+        # Row position -> (batch task, index of the row inside the batch)
+        self.batch_of = {
+            position: (task, index)
+            for batch, task in zip(batches, tasks)
+            for index, position in enumerate(batch)
+        }
+    
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
 class CSVProcessor:
     """CSV processing service with AI enrichment using LangChain"""
     
-    def __init__(self):
+    def __init__(self, llm_share: float = 1.0):
+        """
+        Args:
+            llm_share: Fraction of each LLM backend's concurrency and rate
+                budget this processor may use (shard worker processes split them)
+        """
         self.ai_agent = AIProductEnrichmentAgent()
+        # One rate budget, adaptive concurrency and circuit per LLM backend
+        self.scheduler = EnrichmentScheduler(
+            backends=[
+                Backend(
+                    name=backend.name,
+                    max_concurrency=max(1, int(backend.max_concurrent_requests * llm_share)),
+                    requests_per_minute=self._share(backend.requests_per_minute, llm_share),
+                    tokens_per_minute=self._share(backend.tokens_per_minute, llm_share),
+                    min_concurrency=settings.AI_MIN_CONCURRENT_REQUESTS,
+                    circuit_breaker=CircuitBreaker(
+                        failure_threshold=settings.AI_CIRCUIT_FAILURE_THRESHOLD,
+                        cooldown=settings.AI_CIRCUIT_COOLDOWN,
+                        max_cooldown=settings.AI_CIRCUIT_MAX_COOLDOWN,
+                        name=backend.name
+                    )
+                )
+                for backend in settings.llm_backends()
+            ],
+            retryable=RETRYABLE_ERRORS,
+            max_retries=settings.AI_MAX_RETRIES,
+            retry_base_delay=settings.AI_RETRY_BASE_DELAY,
+            retry_max_delay=settings.AI_RETRY_MAX_DELAY
+        )
+        
+        # Journal of LLM-enriched rows so interrupted runs can resume
+        self.checkpoints = None
+        if settings.CHECKPOINT_ENABLED:
+            self.checkpoints = CheckpointJournal(
+                db_path=Path(settings.CSV_STORAGE_PATH) / "checkpoints.sqlite3",
+                retention_hours=settings.CHECKPOINT_RETENTION_HOURS,
+                prompt_version=PROMPT_VERSION
+            )
+            self.checkpoints.cleanup()
+        
+        # Outputs of already processed inputs, so resent files are not enriched again
+        self.processed_files = None
+        if settings.DEDUP_ENABLED:
+            self.processed_files = ProcessedFileIndex(
+                db_path=Path(settings.CSV_STORAGE_PATH) / "processed_files.sqlite3",
+                prompt_version=PROMPT_VERSION
+            )
+        
+        # Last processed catalog of each supplier, so uploads only enrich new or changed parts
+        self.catalogs = None
+        # One upload at a time per supplier catalog (see hold_catalog)
+        self._catalog_locks: Dict[str, asyncio.Lock] = {}
+        self._catalog_waiters: Dict[str, int] = {}
+        if settings.CATALOG_DIFF_ENABLED:
+            self.catalogs = SupplierCatalog(
+                db_path=Path(settings.CSV_STORAGE_PATH) / "supplier_catalogs.sqlite3",
+                prompt_version=PROMPT_VERSION
+            )
     
-
+    @staticmethod
+    def _share(limit: int, share: float) -> int:
+        """Part of a rate limit, keeping 0 (no limit) as is"""
+        return max(1, int(limit * share)) if limit > 0 else 0
     
-    async def process_file(self, input_path: Path) -> Path:
-        """Process CSV file with AI enrichment"""
+    def find_processed(self, content_hash: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Index entry of an input that was already enriched, or None"""
+        if self.processed_files is None or not content_hash:
+            return None
+        return self.processed_files.get(content_hash)
+    
+    async def process_file(
+        self,
+        input_path: Path,
+        progress_callback: Optional[Callable[[int], None]] = None,
+        content_hash: Optional[str] = None,
+        force: bool = False,
+        priority: Optional[str] = None,
+        supplier: Optional[str] = None,
+        catalog_run: Optional[str] = None,
+        full_catalog: bool = False
+    ) -> Path:
+        """
+        Process CSV file with AI enrichment
+        
+        Enriched rows are appended to the output as soon as they are ready,
+        so memory stays flat regardless of the file size. Rows are written to
+        `enriched_<name>.part` and the file is renamed once the run completes;
+        after a crash the partial file keeps every row already written.
+        
+        Next to the output, `enriched_<name>.report.csv` records the source
+        of each output row (rules, cache, similar, llm, dedup, resumed,
+        unchanged, patched or fallback) and, for fallbacks, the reason.
+        
+        An input whose content was already enriched returns the existing
+        output right away, unless `force` is set. Outputs with fallback rows
+        are not reused, so a resend after an LLM outage is enriched again.
+        
+        With a supplier, the upload is diffed against that supplier's last
+        catalog (see iter_enrichment_results). A full catalog upload also
+        writes the items it no longer lists to `enriched_<name>.removed.csv`.
+        
+        Args:
+            input_path: Input CSV file
+            progress_callback: Called with the number of rows written so far
+            content_hash: Normalized content hash of the input, if the caller already computed it
+            force: Enrich again even if the same content was processed before,
+                also ignoring rows journaled by an interrupted run
+            priority: Key of JOB_PRIORITY_WEIGHTS, JOB_DEFAULT_PRIORITY if omitted
+            supplier: Supplier the file comes from, for catalog diffing
+            catalog_run: Catalog run id shared by the shards of one file; the
+                caller then holds the catalog and reports the removed items
+            full_catalog: The file lists the supplier's whole catalog, so
+                items missing from it were removed (otherwise it only
+                updates the items it lists)
+        """
         try:
+            if self.processed_files is not None:
+                content_hash = content_hash or await asyncio.to_thread(hash_file, input_path)
+                
+                processed = None if force else self.find_processed(content_hash)
+                if processed:
+                    logger.info(
+                        f"{input_path.name} was already processed as {processed['input_name']}, "
+                        f"reusing {processed['output_path']}"
+                    )
+                    if progress_callback:
+                        progress_callback(processed["row_count"])
+                    return processed["output_path"]
+            
             logger.info(f"Starting processing of file: {input_path}")
             
-            # Read input CSV
-            df = pd.read_csv(input_path)
-            logger.info(f"Loaded {len(df)} rows from CSV")
+            output_path = input_path.parent / f"enriched_{input_path.name}"
+            partial_path = output_path.with_name(f"{output_path.name}.part")
+            report_path = self.report_path(output_path)
+            partial_report_path = report_path.with_name(f"{report_path.name}.part")
+            written_rows = 0
+            fallback_rows = 0
+            
+            # A shard's run belongs to the whole file, whose pool reports the removed items
+            finish_catalog = catalog_run is None
+            catalog_run = catalog_run or self.new_catalog_run()
             
-            # Process each row
-            enriched_rows = []
-            for index, row in df.iterrows():
-                logger.info(f"Processing row {index + 1}/{len(df)}")
-                enriched_data = await self._enrich_row(row)
-                if enriched_data:
-                    enriched_rows.append(enriched_data)
+            # Uploads of the same supplier run one after the other (shard runs are held by their pool)
+            async with self.hold_catalog(supplier if finish_catalog else None):
+                with open(partial_path, "w", encoding="utf-8", newline="") as output_file, \
+                        open(partial_report_path, "w", encoding="utf-8", newline="") as report_file:
+                    writer = self._create_output_writer(output_file)
+                    report_writer = csv.writer(report_file, delimiter=';', lineterminator='\n')
+                    report_writer.writerow(REPORT_COLUMNS)
+                    
+                    async for result in self.iter_enrichment_results(
+                        input_path, content_hash, priority, supplier, catalog_run, force
+                    ):
+                        with CSV_WRITE_SECONDS.time():
+                            writer.writerow(result.data)
+                        written_rows += 1
+                        fallback_rows += result.source == "fallback"
+                        report_writer.writerow([written_rows, result.data.get("SKU", ""), result.source, result.reason or ""])
+                        
+                        if written_rows % PROGRESS_INTERVAL == 0:
+                            output_file.flush()
+                            if progress_callback:
+                                progress_callback(written_rows)
+                    
+                    output_file.flush()
+                    if progress_callback:
+                        progress_callback(written_rows)
+                
+                if not written_rows:
+                    raise ValueError("No enriched data to write")
                 
-                # Small delay to avoid rate limiting
-                await asyncio.sleep(0.5)
+                partial_path.replace(output_path)
+                partial_report_path.replace(report_path)
+                logger.info(f"Successfully created enriched CSV: {output_path}")
+                
+                if supplier and self.catalogs is not None and finish_catalog and full_catalog:
+                    await asyncio.to_thread(self.finish_catalog, supplier, catalog_run, output_path)
             
-            # Create output CSV
-            output_path = self._create_output_csv(enriched_rows, input_path)
-            logger.info(f"Successfully created enriched CSV: {output_path}")
+            if self.processed_files is not None and not fallback_rows:
+                self.processed_files.record(content_hash, input_path.name, output_path, written_rows)
+            elif fallback_rows:
+                logger.info(f"{input_path.name} has {fallback_rows} fallback rows, not reused for resends")
             
             return output_path
             
@@ -45,69 +307,560 @@ class CSVProcessor:
             logger.error(f"Error processing file {input_path}: {str(e)}")
             raise
     
-    async def _enrich_row(self, row: pd.Series) -> Dict[str, Any]:
-        """Enrich a single row of data using AI"""
-        try:
-            # Prepare input data
-            input_data = {
-                "referencia": str(row.get('Referencia', '')),
-                "descricao": str(row.get('Descricao', '')),
-                "quantidade": str(row.get('Quantidade Estoque', '')),
-                "preco_venda": str(row.get('Preço de Venda', '')),
-                "preco_custo": str(row.get('Preço de Custo', '')),
-                "sku": str(row.get('SKU', '')),
-                "ean": str(row.get('EAN', ''))
-            }
+    async def iter_enriched_rows(
+        self,
+        input_path: Path,
+        content_hash: Optional[str] = None,
+        priority: Optional[str] = None,
+        supplier: Optional[str] = None,
+        force: bool = False,
+        full_catalog: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Enrich a CSV file and yield output rows in input order as soon as they are ready"""
+        async for result in self.iter_enrichment_results(
+            input_path, content_hash, priority, supplier, force=force, full_catalog=full_catalog
+        ):
+            yield result.data
+    
+    async def iter_enrichment_results(
+        self,
+        input_path: Path,
+        content_hash: Optional[str] = None,
+        priority: Optional[str] = None,
+        supplier: Optional[str] = None,
+        catalog_run: Optional[str] = None,
+        force: bool = False,
+        full_catalog: bool = False
+    ) -> AsyncIterator[EnrichmentResult]:
+        """
+        Enrich a CSV file and yield each row's result (data, source, reason) in input order
+        
+        The input is read in chunks of CSV_CHUNK_SIZE rows; the next chunk is
+        already being enriched while the current one is consumed. Rows enriched
+        by the LLM are journaled per input content and prompt version until the
+        run completes, so a restarted or resubmitted run of an interrupted file
+        only enriches the unfinished rows; `force` starts it over instead.
+        
+        The LLM calls of concurrent runs share the scheduler's fair queue,
+        weighted by each run's priority.
+        
+        With a supplier, rows whose SKU and reference were in the supplier's
+        last catalog with the same description reuse their previous output
+        row, with stock, EAN and prices patched in (source unchanged or
+        patched); only new or changed parts are enriched. The rows are
+        recorded as the supplier's current items; a full catalog upload then
+        also drops the items it no longer lists. Uploads of one supplier are
+        enriched one at a time, so one cannot drop the items another just saw.
+        
+        Args:
+            input_path: Input CSV file
+            content_hash: Normalized content hash of the input, if the caller already computed it
+            priority: Key of JOB_PRIORITY_WEIGHTS, JOB_DEFAULT_PRIORITY if omitted
+            supplier: Supplier the file comes from, for catalog diffing
+            catalog_run: Catalog run id of the caller, which then also holds
+                the catalog and reports the removed items; otherwise they are
+                only logged
+            force: Ignore rows journaled by an interrupted run of the same content
+            full_catalog: The file lists the supplier's whole catalog (see process_file)
+        """
+        priority = self.resolve_priority(priority)
+        flow = Flow(input_path.name, settings.JOB_PRIORITY_WEIGHTS[priority], priority)
+        supplier = supplier if self.catalogs is not None else None
+        finish_catalog = bool(supplier) and catalog_run is None
+        run = FileRun(input_path, None, flow, supplier or None, catalog_run or self.new_catalog_run())
+        if self.checkpoints is not None:
+            content_hash = content_hash or await asyncio.to_thread(hash_file, input_path)
+            run.file_key = self.checkpoints.file_key(content_hash)
+            await asyncio.to_thread(self.checkpoints.start_run, run.file_key, input_path.name, force)
+        
+        async with self.hold_catalog(supplier if finish_catalog else None):
+            current = None
+            following = None
+            first_row = 0
+            try:
+                for products in self._read_chunks(input_path):
+                    following = await self._start_chunk(products, first_row, run)
+                    first_row += len(products)
+                    
+                    if current is not None:
+                        async for result in self._iter_chunk_rows(current, run):
+                            yield result
+                    current, following = following, None
+                
+                if current is not None:
+                    async for result in self._iter_chunk_rows(current, run):
+                        yield result
+            finally:
+                for work in (current, following):
+                    if work is not None:
+                        work.cancel()
+            
+            if run.file_key is not None:
+                await asyncio.to_thread(self.checkpoints.complete, run.file_key)
             
-            # Process with AI agent
-            enriched_data = await self.ai_agent.enrich_product_data(input_data)
+            if finish_catalog and full_catalog:
+                await asyncio.to_thread(self.finish_catalog, supplier, run.catalog_run)
+        
+        paths = " ".join(f"{source}={count}" for source, count in run.path_counts.items())
+        logger.info(f"Enrichment paths for {input_path.name}: {paths} (total {first_row})")
+        
+        model_rows = run.path_counts["llm"] + run.path_counts["dedup"] + run.path_counts["fallback"]
+        if model_rows:
+            logger.info(
+                f"Row dedup for {input_path.name}: {run.path_counts['dedup']} of {model_rows} rows "
+                f"copied from a repeated part ({run.path_counts['dedup'] / model_rows:.1%})"
+            )
+    
+    def _read_chunks(self, input_path: Path) -> Iterator[List[Dict[str, str]]]:
+        """Read the input in chunks of CSV_CHUNK_SIZE prepared products, timing each read"""
+        reader = read_chunks(input_path, settings.CSV_CHUNK_SIZE)
+        while True:
+            started = time.perf_counter()
+            chunk = next(reader, None)
+            if chunk is None:
+                return
+            products = prepare_products(chunk)
+            CSV_READ_SECONDS.observe(time.perf_counter() - started)
+            yield products
+    
+    def resolve_priority(self, priority: Optional[str]) -> str:
+        """Validate a requested priority, JOB_DEFAULT_PRIORITY if omitted"""
+        priority = priority or settings.JOB_DEFAULT_PRIORITY
+        if priority not in settings.JOB_PRIORITY_WEIGHTS:
+            raise ValueError(
+                f"Unknown priority '{priority}', expected one of: {', '.join(settings.JOB_PRIORITY_WEIGHTS)}"
+            )
+        return priority
+    
+    def report_path(self, output_path: Path) -> Path:
+        """Sidecar report written next to an enriched output"""
+        return output_path.with_name(f"{output_path.stem}.report.csv")
+    
+    def removed_path(self, output_path: Path) -> Path:
+        """Sidecar listing the catalog items a supplier upload no longer lists"""
+        return output_path.with_name(f"{output_path.stem}.removed.csv")
+    
+    @staticmethod
+    def new_catalog_run() -> str:
+        return uuid.uuid4().hex
+    
+    @asynccontextmanager
+    async def hold_catalog(self, supplier: Optional[str]) -> AsyncIterator[None]:
+        """
+        Work on a supplier's catalog exclusively, from the first recorded row to finish_catalog
+        
+        Otherwise a full catalog upload finishing while another upload of the
+        same supplier runs would drop the items that one recorded so far.
+        """
+        if not supplier or self.catalogs is None:
+            yield
+            return
+        
+        key = SupplierCatalog.normalize_supplier(supplier)
+        lock = self._catalog_locks.setdefault(key, asyncio.Lock())
+        self._catalog_waiters[key] = self._catalog_waiters.get(key, 0) + 1
+        try:
+            if lock.locked():
+                logger.info(f"Waiting for the running upload of supplier {supplier}")
+            async with lock:
+                yield
+        finally:
+            self._catalog_waiters[key] -= 1
+            if not self._catalog_waiters[key]:
+                del self._catalog_waiters[key]
+                del self._catalog_locks[key]
+    
+    def finish_catalog(self, supplier: str, catalog_run: str, output_path: Optional[Path] = None) -> List[Dict[str, str]]:
+        """Make a completed upload the supplier's catalog and report the items it dropped"""
+        removed = self.catalogs.finish(supplier, catalog_run)
+        logger.info(f"Catalog of {supplier}: {len(removed)} items removed since the previous upload")
+        
+        if output_path is not None:
+            removed_path = self.removed_path(output_path)
+            partial_path = removed_path.with_name(f"{removed_path.name}.part")
+            with open(partial_path, "w", encoding="utf-8", newline="") as removed_file:
+                writer = csv.writer(removed_file, delimiter=';', lineterminator='\n')
+                writer.writerow(REMOVED_COLUMNS)
+                for item in removed:
+                    writer.writerow([item["sku"], item["referencia"], item["descricao"]])
+            partial_path.replace(removed_path)
+        
+        return removed
+    
+    def count_rows(self, input_path: Path) -> int:
+        """
+        Count the data rows of an input CSV without loading it
+        
+        Rows are counted by the reader that enriches them, so blank lines and
+        descriptions spanning lines count as they will be processed.
+        """
+        dialect = sniff_dialect(input_path)
+        if not dialect.header:
+            return 0
+        return sum(len(chunk) for chunk in read_chunks(input_path, settings.CSV_CHUNK_SIZE, dialect))
+    
+    async def _start_chunk(self, products: List[Dict[str, str]], first_row: int, run: FileRun) -> ChunkWork:
+        """Resolve rows that need no LLM call and start the LLM batches of one chunk"""
+        # Journal, catalog, cache and similarity lookups block: one thread per chunk
+        resolved = await asyncio.to_thread(self._resolve_chunk, products, first_row, run)
+        
+        results: List[Optional[EnrichmentResult]] = [None] * len(products)
+        pending = []
+        for position, (enriched_data, source) in enumerate(resolved):
+            if enriched_data is None:
+                pending.append(position)
+                continue
+            run.add(source)
+            results[position] = EnrichmentResult(data=enriched_data, source=source)
+        
+        # A part repeated in the file (other SKU or stock line) is enriched once;
+        # its later rows copy the AI fields when they are written
+        unique = []
+        repeats = {}
+        first_positions = {}
+        for position in pending:
+            part_key = self.ai_agent.part_key(products[position])
+            if part_key in run.part_keys:
+                repeats[position] = (part_key, products[position])
+            else:
+                run.part_keys.add(part_key)
+                first_positions[part_key] = position
+                unique.append(position)
+        
+        # Group the remaining rows into batched LLM calls
+        pending_batches = self.ai_agent.plan_batches([products[position] for position in unique])
+        batches = [[unique[index] for index in batch] for batch in pending_batches]
+        logger.info(
+            f"Planned {len(batches)} LLM calls for {len(unique)} rows, {len(repeats)} repeated parts "
+            f"(rows {first_row + 1}-{first_row + len(products)})"
+        )
+        
+        # Process batches concurrently; results are placed back by row position
+        tasks = [
+            asyncio.create_task(self._schedule_batch(batch, products, first_row, run))
+            for batch in batches
+        ]
+        return ChunkWork(products, results, batches, tasks, first_row, repeats, first_positions)
+    
+    def _resolve_chunk(
+        self,
+        products: List[Dict[str, str]],
+        first_row: int,
+        run: FileRun
+    ) -> List[Tuple[Optional[Dict[str, Any]], str]]:
+        """
+        Enriched data and source of each row of a chunk that needs no LLM call, (None, "") for the others
+        
+        Rows finished by an interrupted run, unchanged catalog items,
+        well-known part families, parts enriched in earlier runs and
+        near-duplicates of enriched parts never reach the LLM. The journal,
+        catalog and cache are read in a few queries for the whole chunk; runs
+        in a worker thread, off the event loop.
+        """
+        resolved: List[Tuple[Optional[Dict[str, Any]], str]] = [(None, "")] * len(products)
+        
+        journaled = {}
+        if run.file_key is not None:
+            journaled = self.checkpoints.load(run.file_key, first_row, len(products))
+        
+        catalog_items = {}
+        if run.supplier:
+            catalog_items = self.catalogs.lookup(run.supplier, [SupplierCatalog.item_key(product) for product in products])
+        
+        uncached = []
+        for position, product in enumerate(products):
+            source = "resumed"
+            enriched_data = journaled.get(first_row + position)
+            if enriched_data is None and catalog_items:
+                enriched_data, source = self._diff_catalog_item(product, catalog_items)
+            if enriched_data is None:
+                source = "rules"
+                enriched_data = self.ai_agent.enrich_from_rules(product)
+            if enriched_data is None:
+                uncached.append(position)
+                continue
+            resolved[position] = (enriched_data, source)
+        
+        candidates = uncached
+        if uncached and self.ai_agent.cache is not None:
+            cached = self.ai_agent.enrich_many_from_cache([products[position] for position in uncached])
+            candidates = []
+            for position, enriched_data in zip(uncached, cached):
+                if enriched_data is None:
+                    candidates.append(position)
+                    continue
+                resolved[position] = (enriched_data, "cache")
+        
+        if self.ai_agent.similar is not None:
+            for position in candidates:
+                enriched_data = self.ai_agent.enrich_from_similar(products[position])
+                if enriched_data is not None:
+                    resolved[position] = (enriched_data, "similar")
+        
+        return resolved
+    
+    def _diff_catalog_item(
+        self,
+        product: Dict[str, str],
+        catalog_items: Dict[str, Tuple[str, Dict[str, Any]]]
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        """Previous output row of an item whose part did not change, with this upload's stock and prices"""
+        item = catalog_items.get(SupplierCatalog.item_key(product))
+        if item is None or item[0] != self.ai_agent.part_key(product):
+            # New item, or its description changed: enrich it again
+            return None, ""
+        
+        enriched_data, changed = patch_row(self.ai_agent.rebase_row(product, item[1]), product)
+        return enriched_data, "patched" if changed else "unchanged"
+    
+    async def _iter_chunk_rows(self, work: ChunkWork, run: FileRun) -> AsyncIterator[EnrichmentResult]:
+        """Yield the rows of a chunk in order, waiting only for the batch of the next row"""
+        catalog_items = []
+        for position in range(len(work.results)):
+            if position in work.repeats and position not in work.batch_of:
+                # The first row of the part comes earlier in the file, so it is already done
+                part_key, input_data = work.repeats[position]
+                if part_key not in run.part_rows and part_key not in work.retried_parts:
+                    # It fell back (or left the memo): enrich such parts once, batched
+                    self._retry_repeats(work, position, run)
+                if position not in work.batch_of:
+                    work.results[position] = self._copy_part(work.first_row + position, part_key, input_data, run)
+            if position in work.batch_of:
+                task, index = work.batch_of[position]
+                work.results[position] = (await task)[index]
             
-            return enriched_data
+            result = work.results[position]
+            # Release the row once consumed
+            work.results[position] = None
+            if run.supplier:
+                # Fallback rows are kept as seen but enriched again on the next upload
+                product = work.products[position]
+                enriched = result.data if result and result.source != "fallback" else None
+                catalog_items.append((product, self.ai_agent.part_key(product), enriched))
+            if result and result.data:
+                yield result
+        
+        await asyncio.to_thread(self._record_catalog, run, catalog_items)
+    
+    async def _schedule_batch(self, batch: List[int], products: List[Dict[str, str]], first_row: int, run: FileRun) -> List[EnrichmentResult]:
+        """Enrich a batch of rows in one LLM call, retrying dropped rows on their own"""
+        if len(batch) == 1:
+            return [await self._schedule_row(first_row + batch[0], products[batch[0]], run)]
+        
+        batch_products = [products[position] for position in batch]
+        tokens = self.ai_agent.estimate_batch_tokens(batch_products)
+        
+        async def enrich(backend: str):
+            logger.info(f"Processing rows {first_row + batch[0] + 1}-{first_row + batch[-1] + 1} on {backend}")
+            return await self.ai_agent.enrich_products_batch(batch_products, backend=backend)
+        
+        try:
+            batch_data = await self.scheduler.run(enrich, tokens=tokens, flow=run.flow)
+        except Exception as e:
+            # Retries exhausted: retrying each row would only hit the same provider error
+            logger.error(f"Error enriching rows {first_row + batch[0] + 1}-{first_row + batch[-1] + 1}: {str(e)}")
+            results = [self._fallback_result(product, e) for product in batch_products]
+            for result in results:
+                run.count(result)
+            return results
+        
+        completed = [
+            (first_row + position, enriched_data)
+            for position, enriched_data in zip(batch, batch_data)
+            if enriched_data is not None
+        ]
+        run.add("llm", len(completed))
+        self._journal(run, completed)
+        
+        results: List[Optional[EnrichmentResult]] = []
+        for position, enriched_data in zip(batch, batch_data):
+            if enriched_data is None:
+                results.append(None)
+                continue
+            run.remember_part(self.ai_agent.part_key(products[position]), enriched_data)
+            results.append(EnrichmentResult(data=enriched_data, source="llm"))
+        
+        # Rows the model dropped or mangled are retried individually
+        retries = [
+            (index, position) for index, position in enumerate(batch)
+            if results[index] is None
+        ]
+        if retries:
+            retried = await asyncio.gather(*[
+                self._schedule_row(first_row + position, products[position], run)
+                for _, position in retries
+            ])
+            for (index, _), result in zip(retries, retried):
+                results[index] = result
+        
+        return results
+    
+    async def _schedule_row(self, row_index: int, input_data: Dict[str, str], run: FileRun) -> EnrichmentResult:
+        """Wait for a scheduler slot and enrich a single row"""
+        tokens = self.ai_agent.estimate_tokens(input_data)
+        
+        async def enrich(backend: str):
+            logger.info(f"Processing row {row_index + 1} on {backend}")
+            return await self._enrich_row(input_data, backend)
+        
+        try:
+            result = await self.scheduler.run(enrich, tokens=tokens, flow=run.flow)
+        except Exception as e:
+            logger.error(f"Error enriching row {row_index + 1}: {str(e)}")
+            result = self._fallback_result(input_data, e)
+        run.count(result)
+        
+        # Fallback rows are not journaled so a resumed run tries them again
+        if result.source == "llm":
+            self._journal(run, [(row_index, result.data)])
+            run.remember_part(self.ai_agent.part_key(input_data), result.data)
+        
+        return result
+    
+    def _retry_repeats(self, work: ChunkWork, position: int, run: FileRun):
+        """
+        Start batched LLM calls for the repeated parts of a chunk that have no enriched row to copy
+        
+        From `position` on, the first repeat of each part whose first row is
+        already done but fell back is enriched again, in batches planned like
+        the chunk's own; later repeats copy it or, if it fell back again, fall
+        back without another call.
+        """
+        leaders = {}
+        for later in range(position, len(work.products)):
+            repeat = work.repeats.get(later)
+            if repeat is None or later in work.batch_of:
+                continue
+            part_key = repeat[0]
+            if part_key in run.part_rows or part_key in work.retried_parts or part_key in leaders:
+                continue
+            if work.first_positions.get(part_key, -1) >= position:
+                # Its first row is still ahead in this chunk
+                continue
+            leaders[part_key] = later
+        work.retried_parts.update(leaders)
+        
+        positions = list(leaders.values())
+        planned = self.ai_agent.plan_batches([work.products[later] for later in positions])
+        logger.info(f"Retrying {len(positions)} repeated parts whose first row fell back in {len(planned)} LLM calls")
+        for batch in planned:
+            batch_positions = [positions[index] for index in batch]
+            task = asyncio.create_task(self._schedule_batch(batch_positions, work.products, work.first_row, run))
+            work.tasks.append(task)
+            for index, later in enumerate(batch_positions):
+                work.batch_of[later] = (task, index)
+    
+    def _copy_part(self, row_index: int, part_key: str, input_data: Dict[str, str], run: FileRun) -> EnrichmentResult:
+        """Enrich a repeated part from its earlier row, keeping this row's SKU, EAN, prices and stock"""
+        part_row = run.part_rows.get(part_key)
+        if part_row is None:
+            # The part was already enriched again for this chunk and still fell back
+            result = EnrichmentResult(
+                data=self._create_fallback_data(input_data),
+                source="fallback",
+                reason="Repeated part whose enrichment fell back"
+            )
+            run.count(result)
+            return result
+        
+        run.part_rows.move_to_end(part_key)
+        enriched_data = self.ai_agent.enrich_from_part(input_data, part_row)
+        run.add("dedup")
+        self._journal(run, [(row_index, enriched_data)])
+        return EnrichmentResult(data=enriched_data, source="dedup")
+    
+    def _fallback_result(self, input_data: Dict[str, str], error: Exception) -> EnrichmentResult:
+        """Fallback row for an LLM call that still failed after the scheduler's retries"""
+        return EnrichmentResult(
+            data=self._create_fallback_data(input_data),
+            source="fallback",
+            reason=f"{type(error).__name__} after {self.scheduler.max_retries} retries: {str(error)}"
+        )
+    
+    def _record_catalog(self, run: FileRun, items: List[tuple]):
+        """Store the rows of a chunk in the supplier's catalog"""
+        if not run.supplier or not items:
+            return
+        # Not best effort like the journal: an unrecorded row would be reported as removed
+        self.catalogs.record(run.supplier, run.catalog_run, items)
+    
+    def _journal(self, run: FileRun, rows: List[tuple]):
+        """Record completed rows in the checkpoint journal"""
+        if run.file_key is None or not rows:
+            return
+        try:
+            self.checkpoints.record(run.file_key, rows)
+        except Exception as e:
+            logger.warning(f"Failed to write checkpoint: {str(e)}")
+    
+    def _row_to_input_data(self, row: pd.Series) -> Dict[str, str]:
+        """Map an input CSV row to the AI agent input fields"""
+        return {
+            "referencia": str(row.get('Referencia', '')),
+            "descricao": str(row.get('Descricao', '')),
+            "quantidade": str(row.get('Quantidade Estoque', '')),
+            "preco_venda": str(row.get('Preço de Venda', '')),
+            "preco_custo": str(row.get('Preço de Custo', '')),
+            "sku": str(row.get('SKU', '')),
+            "ean": str(row.get('EAN', ''))
+        }
+    
+    async def _enrich_row(self, input_data: Dict[str, str], backend: Optional[str] = None) -> EnrichmentResult:
+        """Enrich a single row of data using AI"""
+        try:
+            # Process with AI agent (cache was already checked for this row)
+            return await self.ai_agent.enrich_product(input_data, use_cache=False, backend=backend)
             
+        except RETRYABLE_ERRORS:
+            # Retried by the scheduler
+            raise
         except Exception as e:
             logger.error(f"Error enriching row: {str(e)}")
             # Return fallback data
-            return self._create_fallback_data(row)
-    
-
+            return EnrichmentResult(
+                data=self._create_fallback_data(input_data),
+                source="fallback",
+                reason=str(e)
+            )
     
     def _create_fallback_data(self, row_data) -> Dict[str, Any]:
         """Create fallback data when AI processing fails"""
         if isinstance(row_data, pd.Series):
-            original_data = {
-                "referencia": str(row_data.get('Referencia', '')),
-                "descricao": str(row_data.get('Descricao', '')),
-                "quantidade": str(row_data.get('Quantidade Estoque', '')),
-                "preco_venda": str(row_data.get('Preço de Venda', '')),
-                "preco_custo": str(row_data.get('Preço de Custo', '')),
-                "sku": str(row_data.get('SKU', '')),
-                "ean": str(row_data.get('EAN', ''))
-            }
+            original_data = self._row_to_input_data(row_data)
         else:
             original_data = row_data
         
         # Use AI agent fallback method
         return self.ai_agent._create_fallback_data(original_data)
     
-    def _create_output_csv(self, enriched_rows: List[Dict], input_path: Path) -> Path:
-        """Create output CSV file with enriched data"""
-        if not enriched_rows:
-            raise ValueError("No enriched data to write")
-        
-        # Create DataFrame
-        df = pd.DataFrame(enriched_rows)
-        
-        # Define output path
-        output_path = input_path.parent / f"enriched_{input_path.name}"
-        
-        # Write CSV with proper formatting - no quotes on headers, minimal quoting
-        df.to_csv(
-            output_path,
-            sep=';',
-            index=False,
-            encoding='utf-8',
-            quoting=0,  # No quoting
-            lineterminator='\n'  # Ensure proper line endings
+    def _create_output_writer(self, output_file: TextIO, write_header: bool = True) -> csv.DictWriter:
+        """Create the output CSV writer and write the header"""
+        # Same format as before: ';' separator, minimal quoting, '\n' line endings
+        writer = csv.DictWriter(
+            output_file,
+            fieldnames=OUTPUT_COLUMNS,
+            delimiter=';',
+            quoting=csv.QUOTE_MINIMAL,
+            lineterminator='\n',
+            extrasaction='ignore'
         )
-        
-        return output_path
\ No newline at end of file
+        if write_header:
+            writer.writeheader()
+        return writer
+    
+    def format_header(self) -> str:
+        """Output CSV header line, as written by process_file"""
+        buffer = io.StringIO()
+        self._create_output_writer(buffer)
+        return buffer.getvalue()
+    
+    def format_row(self, enriched_data: Dict[str, Any]) -> str:
+        """Format one enriched row as an output CSV line, as written by process_file"""
+        buffer = io.StringIO()
+        self._create_output_writer(buffer, write_header=False).writerow(enriched_data)
+        return buffer.getvalue()
+    
+    def read_output_rows(self, output_path: Path) -> Iterator[Dict[str, Any]]:
+        """Read back the enriched rows of an output written by process_file"""
+        with open(output_path, "r", encoding="utf-8", newline="") as output_file:
+            yield from csv.DictReader(output_file, delimiter=';')
@@ -1,14 +1,68 @@
-import imaplib
-import email
-import os
+import binascii
+import json
+import quopri
+import random
 import time
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+from imapclient import IMAPClient, SEEN
+from imapclient.response_types import BodyData
 from loguru import logger
 from app.core.config import settings
 import httpx
 import asyncio
 
+# Mailbox watched for supplier emails
+MAILBOX = "INBOX"
+
+# Socket timeout for IMAP commands (IDLE waits use EMAIL_IDLE_TIMEOUT instead)
+IMAP_SOCKET_TIMEOUT = 60
+
+# First reconnect delay in seconds; doubled after each consecutive failure
+RECONNECT_BASE_DELAY = 5
+
+# Encoded bytes requested per partial FETCH when downloading an attachment
+ATTACHMENT_FETCH_SIZE = 1024 * 1024
+
+class AttachmentDecoder:
+    """Incremental decoder for a MIME part body in its transfer encoding"""
+    
+    def __init__(self, encoding: str):
+        self.encoding = encoding.lower()
+        self._pending = b""
+    
+    def decode(self, data: bytes) -> bytes:
+        """Decode a chunk, holding back bytes that may continue in the next one"""
+        if self.encoding == "base64":
+            # Only whole 4-character groups can be decoded
+            data = self._pending + b"".join(data.split())
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            return binascii.a2b_base64(data[:usable])
+        
+        if self.encoding == "quoted-printable":
+            # Soft line breaks and =XX escapes never span a line end
+            data = self._pending + data
+            cut = data.rfind(b"\n") + 1
+            self._pending = data[cut:]
+            return quopri.decodestring(data[:cut])
+        
+        return data
+    
+    def flush(self) -> bytes:
+        """Decode whatever is left after the last chunk"""
+        pending, self._pending = self._pending, b""
+        if not pending:
+            return b""
+        if self.encoding == "base64":
+            return binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))
+        if self.encoding == "quoted-printable":
+            return quopri.decodestring(pending)
+        return pending
+
 class EmailMonitor:
     """Email monitoring service for CSV attachments"""
     
@@ -21,149 +75,457 @@ class EmailMonitor:
         self.storage_path = Path(settings.CSV_STORAGE_PATH)
         self.api_url = f"http://csv-processor:{settings.API_PORT}"
         
+        # Persistent connection and the position reached in the mailbox
+        self.client: Optional[IMAPClient] = None
+        self.supports_idle = False
+        self.state_path = self.storage_path / "email_state.json"
+        self.uidvalidity: Optional[int] = None
+        self.last_uid = 0
+        self.baseline_uid = 0
+        
+        # Saved attachments (with their email's arrival time and sender address) waiting
+        # for upload, and the HTTP client shared by the upload workers
+        self.upload_queue: Optional["asyncio.Queue[Tuple[Path, Optional[float], Optional[str]]]"] = None
+        self.http_client: Optional[httpx.AsyncClient] = None
+        
         # Ensure storage directory exists
         self.storage_path.mkdir(parents=True, exist_ok=True)
     
+    @property
+    def account(self) -> str:
+        return f"{self.username}@{self.host}"
+    
     async def start_monitoring(self):
-        """Start monitoring emails for CSV attachments"""
+        """Keep a persistent IMAP connection and process new emails as they arrive"""
         logger.info("Starting email monitoring service")
         
+        workers = max(1, settings.EMAIL_UPLOAD_WORKERS)
+        self.upload_queue = asyncio.Queue(maxsize=settings.EMAIL_QUEUE_SIZE)
+        self.http_client = httpx.AsyncClient(
+            timeout=60,
+            limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+        )
+        worker_tasks = [asyncio.create_task(self.upload_worker(index)) for index in range(workers)]
+        logger.info(f"Started {workers} upload workers")
+        
+        try:
+            await self.monitor_mailbox()
+        finally:
+            for task in worker_tasks:
+                task.cancel()
+            await asyncio.gather(*worker_tasks, return_exceptions=True)
+            await self.http_client.aclose()
+    
+    async def monitor_mailbox(self):
+        """Connection loop: IMAP calls run in a worker thread, reconnecting with backoff"""
+        failures = 0
+        
         while True:
             try:
+                await asyncio.to_thread(self.connect)
                 await self.check_for_new_emails()
-                logger.info(f"Sleeping for {settings.EMAIL_CHECK_INTERVAL} seconds")
-                await asyncio.sleep(settings.EMAIL_CHECK_INTERVAL)
+                failures = 0
+                await self.watch_mailbox()
                 
             except Exception as e:
-                logger.error(f"Error in email monitoring: {str(e)}")
-                await asyncio.sleep(60)  # Wait before retrying
+                failures += 1
+                delay = self.reconnect_delay(failures)
+                logger.error(f"Error in email monitoring: {str(e)}; reconnecting in {delay:.0f}s")
+                await asyncio.to_thread(self.disconnect)
+                await asyncio.sleep(delay)
     
-    async def check_for_new_emails(self):
-        """Check for new emails with CSV attachments"""
+    async def upload_worker(self, index: int):
+        """Send queued CSV files to the processing API, one at a time per worker"""
+        while True:
+            file_path, received_at, supplier = await self.upload_queue.get()
+            try:
+                await self.process_csv_via_api(file_path, received_at, supplier)
+            finally:
+                self.upload_queue.task_done()
+    
+    @staticmethod
+    def reconnect_delay(failures: int) -> float:
+        """Exponential backoff with jitter, capped at EMAIL_RECONNECT_MAX_DELAY"""
+        delay = min(settings.EMAIL_RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+    
+    def connect(self):
+        """Open the IMAP connection, select the inbox and restore the UID position"""
+        client = IMAPClient(self.host, port=self.port, ssl=self.use_ssl, timeout=IMAP_SOCKET_TIMEOUT)
+        client.login(self.username, self.password)
+        folder = client.select_folder(MAILBOX)
+        
+        self.client = client
+        self.supports_idle = client.has_capability("IDLE")
+        self.uidvalidity = folder[b"UIDVALIDITY"]
+        self.baseline_uid = folder.get(b"UIDNEXT", 1) - 1
+        
+        state = self.load_state()
+        if state.get("account") == self.account and state.get("uidvalidity") == self.uidvalidity:
+            self.last_uid = state["last_uid"]
+        else:
+            if state:
+                logger.warning("Mailbox UIDVALIDITY changed, starting over from unread emails")
+            self.last_uid = 0
+        
+        mode = "IDLE" if self.supports_idle else f"polling every {settings.EMAIL_CHECK_INTERVAL}s"
+        logger.info(f"Connected to email server ({mode}, last UID {self.last_uid})")
+    
+    def disconnect(self):
+        """Close the IMAP connection, ignoring errors from a dead socket"""
+        if self.client is None:
+            return
         try:
-            # Connect to email server
-            if self.use_ssl:
-                mail = imaplib.IMAP4_SSL(self.host, self.port)
+            self.client.logout()
+        except Exception:
+            pass
+        self.client = None
+    
+    def load_state(self) -> Dict[str, Any]:
+        """UIDVALIDITY and last processed UID saved by a previous run"""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable email state: {str(e)}")
+            return {}
+    
+    def save_state(self):
+        """Persist the UID position so a restart only fetches newer emails"""
+        state = {"account": self.account, "uidvalidity": self.uidvalidity, "last_uid": self.last_uid}
+        temp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        temp_path.replace(self.state_path)
+    
+    async def watch_mailbox(self):
+        """Wait for mailbox changes (IDLE, or polling without it) and process new emails"""
+        while True:
+            if self.supports_idle:
+                responses = await asyncio.to_thread(self.wait_for_changes)
+                if responses:
+                    logger.debug(f"IDLE responses: {responses}")
             else:
-                mail = imaplib.IMAP4(self.host, self.port)
-            
-            # Login
-            mail.login(self.username, self.password)
-            logger.info("Connected to email server")
-            
-            # Select inbox
-            mail.select('inbox')
-            
-            # Search for unread emails
-            status, messages = mail.search(None, 'UNSEEN')
-            
-            if status == 'OK':
-                message_ids = messages[0].split()
-                logger.info(f"Found {len(message_ids)} unread emails")
-                
-                for msg_id in message_ids:
-                    await self.process_email(mail, msg_id)
-            
-            # Close connection
-            mail.close()
-            mail.logout()
+                await asyncio.sleep(settings.EMAIL_CHECK_INTERVAL)
             
-        except Exception as e:
-            logger.error(f"Error checking emails: {str(e)}")
+            # Also runs after an IDLE timeout, catching anything the server did not push
+            await self.check_for_new_emails()
     
-    async def process_email(self, mail: imaplib.IMAP4_SSL, msg_id: bytes):
-        """Process individual email for CSV attachments"""
+    def wait_for_changes(self) -> List[Any]:
+        """Block in IDLE until the server reports changes or EMAIL_IDLE_TIMEOUT expires"""
+        self.client.idle()
         try:
-            # Fetch email
-            status, msg_data = mail.fetch(msg_id, '(RFC822)')
-            
-            if status != 'OK':
-                return
+            return self.client.idle_check(timeout=settings.EMAIL_IDLE_TIMEOUT)
+        finally:
+            self.client.idle_done()
+    
+    async def check_for_new_emails(self):
+        """Process emails that arrived after the last processed UID"""
+        first_run = not self.last_uid
+        uids = await asyncio.to_thread(self.find_new_uids)
+        if uids:
+            logger.info(f"Found {len(uids)} new emails")
+        
+        for uid in uids:
+            await self.process_email(uid)
+            self.last_uid = max(self.last_uid, uid)
+            if not first_run:
+                self.save_state()
+        
+        if first_run:
+            # Unread emails are done (and flagged read); from now on only
+            # UIDs newer than the mailbox had when it was selected are fetched
+            self.last_uid = max(self.last_uid, self.baseline_uid)
+            if self.last_uid:
+                self.save_state()
+    
+    def find_new_uids(self) -> List[int]:
+        """UIDs to process: unread emails on the first run, newer UIDs afterwards"""
+        if not self.last_uid:
+            return sorted(self.client.search(["UNSEEN"]))
+        
+        # "N:*" always matches the newest message, even when its UID is below N
+        uids = self.client.search(["UID", f"{self.last_uid + 1}:*"])
+        return sorted(uid for uid in uids if uid > self.last_uid)
+    
+    async def process_email(self, uid: int):
+        """Download an email's CSV attachments and queue them for processing"""
+        csv_files = await asyncio.to_thread(self.fetch_csv_attachments, uid)
+        
+        # Waits when the queue is full, so a burst of emails cannot pile up unbounded
+        for attachment in csv_files:
+            await self.upload_queue.put(attachment)
+        
+        if csv_files:
+            logger.info(f"Queued {len(csv_files)} CSV files (queue depth {self.upload_queue.qsize()})")
+    
+    def fetch_csv_attachments(self, uid: int) -> List[Tuple[Path, Optional[float], Optional[str]]]:
+        """
+        Save an email's CSV attachments to storage_path, downloading only the CSV parts
+        
+        Returns:
+            (saved file, Unix time the email arrived, sender address) per CSV attachment
+        """
+        csv_files = []
+        
+        try:
+            # Fetch headers and MIME structure only; the body stays on the server
+            response = self.client.fetch([uid], ["ENVELOPE", "BODYSTRUCTURE", "INTERNALDATE"])
             
-            # Parse email
-            email_body = msg_data[0][1]
-            email_message = email.message_from_bytes(email_body)
+            if uid not in response:
+                return csv_files
             
-            subject = email_message['subject'] or "No Subject"
-            from_address = email_message['from'] or "Unknown Sender"
+            envelope = response[uid][b"ENVELOPE"]
+            internal_date = response[uid].get(b"INTERNALDATE")
+            received_at = internal_date.timestamp() if internal_date else None
+            subject = self._decode_header_value(envelope.subject) or "No Subject"
+            from_address = self._format_sender(envelope)
+            # Only senders registered as suppliers have their uploads diffed against a catalog
+            supplier = self._supplier(envelope)
             
             logger.info(f"Processing email: '{subject}' from {from_address}")
             
             # Look for CSV attachments
-            csv_files = self.extract_csv_attachments(email_message)
+            csv_parts = self.find_csv_parts(response[uid][b"BODYSTRUCTURE"])
             
-            if csv_files:
-                logger.info(f"Found {len(csv_files)} CSV files in email")
+            if csv_parts:
+                logger.info(f"Found {len(csv_parts)} CSV files in email")
                 
-                for csv_file in csv_files:
+                for csv_part in csv_parts:
                     # Save CSV file
-                    file_path = self.storage_path / csv_file['filename']
-                    
-                    with open(file_path, 'wb') as f:
-                        f.write(csv_file['content'])
-                    
+                    file_path = self.download_attachment(uid, csv_part)
                     logger.info(f"Saved CSV file: {file_path}")
-                    
-                    # Process CSV via API
-                    await self.process_csv_via_api(file_path)
+                    csv_files.append((file_path, received_at, supplier))
+            
+            # BODY.PEEK leaves the email unread, so flag it explicitly
+            self.client.add_flags([uid], [SEEN])
             
+        except (IMAPClient.Error, OSError):
+            # Connection problems go to the reconnect loop so the email is retried
+            raise
         except Exception as e:
-            logger.error(f"Error processing email {msg_id}: {str(e)}")
+            logger.error(f"Error processing email {uid}: {str(e)}")
+        
+        return csv_files
     
-    def extract_csv_attachments(self, email_message) -> List[dict]:
-        """Extract CSV attachments from email"""
-        csv_files = []
+    def find_csv_parts(self, structure: BodyData, part_number: str = "") -> List[Dict[str, Any]]:
+        """
+        Walk a BODYSTRUCTURE and return the CSV attachments in it
         
-        try:
-            for part in email_message.walk():
-                content_disposition = str(part.get("Content-Disposition"))
+        Returns:
+            One dict per CSV attachment with its IMAP part number (e.g. "2" or
+            "1.3"), filename, transfer encoding and encoded size
+        """
+        if structure.is_multipart:
+            csv_parts = []
+            for index, child in enumerate(structure[0], start=1):
+                child_number = f"{part_number}.{index}" if part_number else str(index)
+                csv_parts.extend(self.find_csv_parts(child, child_number))
+            return csv_parts
+        
+        part_number = part_number or "1"
+        main_type = structure[0].decode().lower()
+        sub_type = structure[1].decode().lower()
+        
+        if main_type == "message" and sub_type == "rfc822":
+            # Forwarded email: its parts are numbered under this part
+            inner = BodyData.create(structure[8])
+            return self.find_csv_parts(inner, part_number if inner.is_multipart else f"{part_number}.1")
+        
+        # Extension data starts after the line count for text parts
+        disposition_index = 9 if main_type == "text" else 8
+        disposition = structure[disposition_index] if len(structure) > disposition_index else None
+        
+        if not disposition or disposition[0].decode().lower() != "attachment":
+            return []
+        
+        filename = self._part_filename(structure[2], disposition[1])
+        if not filename or not filename.lower().endswith('.csv'):
+            return []
+        
+        logger.info(f"Found CSV attachment: {filename}")
+        return [{
+            "part": part_number,
+            "filename": filename,
+            "encoding": (structure[5] or b"7bit").decode(),
+            "size": structure[6]
+        }]
+    
+    def download_attachment(self, uid: int, csv_part: Dict[str, Any]) -> Path:
+        """Stream one attachment to storage_path with partial BODY.PEEK fetches, decoding as it goes"""
+        # Suppliers resend the same file name: a later email must not overwrite
+        # a file still waiting in the upload queue (nor its enriched_ output)
+        file_path = self.storage_path / f"{uid}_{csv_part['part'].replace('.', '-')}_{csv_part['filename']}"
+        decoder = AttachmentDecoder(csv_part["encoding"])
+        offset = 0
+        
+        with open(file_path, 'wb') as f:
+            while True:
+                section = f"BODY.PEEK[{csv_part['part']}]<{offset}.{ATTACHMENT_FETCH_SIZE}>"
+                response = self.client.fetch([uid], [section])
+                data = next(
+                    (value for key, value in response.get(uid, {}).items() if key.startswith(b"BODY[")),
+                    None
+                )
+                if not data:
+                    break
                 
-                if "attachment" in content_disposition:
-                    filename = part.get_filename()
-                    
-                    if filename and filename.lower().endswith('.csv'):
-                        content = part.get_payload(decode=True)
-                        
-                        if content:
-                            csv_files.append({
-                                'filename': filename,
-                                'content': content
-                            })
-                            logger.info(f"Found CSV attachment: {filename}")
-                        
-        except Exception as e:
-            logger.error(f"Error extracting attachments: {str(e)}")
+                f.write(decoder.decode(data))
+                offset += len(data)
+                if len(data) < ATTACHMENT_FETCH_SIZE:
+                    break
+            
+            f.write(decoder.flush())
         
-        return csv_files
+        return file_path
     
-    async def process_csv_via_api(self, file_path: Path):
-        """Send CSV to processing API"""
+    @staticmethod
+    def _part_filename(params: Optional[tuple], disposition_params: Optional[tuple]) -> Optional[str]:
+        """Attachment filename from the disposition (or Content-Type name) parameters"""
+        values = {}
+        for param_list in (disposition_params, params):
+            if not param_list:
+                continue
+            for key, value in zip(param_list[::2], param_list[1::2]):
+                values.setdefault(key.decode().lower(), value)
+        
+        for key in ("filename*", "filename", "name*", "name"):
+            value = values.get(key)
+            if value is None:
+                continue
+            if key.endswith("*"):
+                # RFC 2231 form: charset'language'percent-encoded-value
+                parts = decode_rfc2231(value.decode("ascii", "replace"))
+                if len(parts) == 3:
+                    filename = unquote(parts[2], encoding=parts[0] or "utf-8", errors="replace")
+                else:
+                    filename = unquote(parts[-1])
+            else:
+                filename = EmailMonitor._decode_header_value(value)
+            # Never let an attachment name escape storage_path
+            return Path(filename).name or None
+        
+        return None
+    
+    @staticmethod
+    def _decode_header_value(value: Optional[bytes]) -> str:
+        """Decode a raw header value that may contain RFC 2047 encoded words"""
+        if not value:
+            return ""
+        text = value.decode("utf-8", "replace")
+        try:
+            return str(make_header(decode_header(text)))
+        except Exception:
+            return text
+    
+    @staticmethod
+    def _sender_address(envelope) -> Optional[str]:
+        """Lower-case 'mailbox@host' of an ENVELOPE's sender, or None"""
+        if not envelope.from_:
+            return None
+        sender = envelope.from_[0]
+        return f"{(sender.mailbox or b'').decode()}@{(sender.host or b'').decode()}".lower()
+    
+    @classmethod
+    def _supplier(cls, envelope) -> Optional[str]:
+        """Supplier of the sender in EMAIL_SUPPLIERS, or None"""
+        address = cls._sender_address(envelope)
+        suppliers = {sender.strip().lower(): supplier for sender, supplier in settings.EMAIL_SUPPLIERS.items()}
+        return suppliers.get(address) if address else None
+    
+    @classmethod
+    def _format_sender(cls, envelope) -> str:
+        """Sender as 'Name <mailbox@host>' from an ENVELOPE"""
+        if not envelope.from_:
+            return "Unknown Sender"
+        sender = envelope.from_[0]
+        address = f"{(sender.mailbox or b'').decode()}@{(sender.host or b'').decode()}"
+        name = cls._decode_header_value(sender.name)
+        return f"{name} <{address}>" if name else address
+    
+    async def process_csv_via_api(
+        self,
+        file_path: Path,
+        received_at: Optional[float] = None,
+        supplier: Optional[str] = None
+    ):
+        """Submit CSV to the processing API as a job and download the result when done"""
         try:
             logger.info(f"Sending {file_path} to processing API")
             
-            async with httpx.AsyncClient() as client:
-                with open(file_path, 'rb') as f:
-                    files = {'file': (file_path.name, f, 'text/csv')}
-                    
-                    response = await client.post(
-                        f"{self.api_url}/process-csv",
-                        files=files,
-                        timeout=300  # 5 minutes timeout
-                    )
+            client = self.http_client
+            
+            with open(file_path, 'rb') as f:
+                files = {'file': (file_path.name, f, 'text/csv')}
                 
-                if response.status_code == 200:
-                    # Save processed file
-                    output_path = file_path.parent / f"enriched_{file_path.name}"
-                    
-                    with open(output_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    logger.info(f"Successfully processed and saved: {output_path}")
-                else:
-                    logger.error(f"API processing failed: {response.status_code} - {response.text}")
+                # Lets the API measure email-to-output latency
+                headers = {"X-Email-Received-At": str(received_at)} if received_at else {}
+                params = {"priority": settings.EMAIL_JOB_PRIORITY}
+                if supplier:
+                    params["supplier"] = supplier
+                    params["full_catalog"] = str(settings.EMAIL_FULL_CATALOG).lower()
+                response = await client.post(
+                    f"{self.api_url}/jobs",
+                    files=files,
+                    headers=headers,
+                    params=params
+                )
+            
+            if response.status_code != 202:
+                logger.error(f"API job submission failed: {response.status_code} - {response.text}")
+                return
+            
+            job_id = response.json()["job_id"]
+            logger.info(f"Submitted {file_path.name} as job {job_id}")
+            
+            # Poll the job until it finishes
+            status = await self.wait_for_job(client, job_id)
+            if status is None:
+                return
+            
+            # Stream the result to disk instead of holding it in memory
+            output_path = file_path.parent / f"enriched_{file_path.name}"
+            
+            async with client.stream("GET", f"{self.api_url}/jobs/{job_id}/result") as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.error(f"API result download failed: {response.status_code} - {response.text}")
+                    return
+                
+                with open(output_path, 'wb') as f:
+                    async for block in response.aiter_bytes():
+                        f.write(block)
+            
+            logger.info(f"Successfully processed and saved: {output_path}")
                     
         except Exception as e:
             logger.error(f"Error processing CSV via API: {str(e)}")
+    
+    async def wait_for_job(self, client: httpx.AsyncClient, job_id: str) -> Optional[dict]:
+        """Poll a job until it completes; returns None if it failed or timed out"""
+        deadline = time.monotonic() + settings.JOB_TIMEOUT
+        
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+            
+            response = await client.get(f"{self.api_url}/jobs/{job_id}")
+            if response.status_code != 200:
+                logger.error(f"Job status check failed: {response.status_code} - {response.text}")
+                return None
+            
+            status = response.json()
+            if status["status"] == "completed":
+                return status
+            if status["status"] == "failed":
+                logger.error(f"Job {job_id} failed: {status['message']}")
+                return None
+            
+            logger.info(f"Job {job_id}: {status['processed_rows']}/{status['total_rows']} rows processed")
+        
+        logger.error(f"Timed out waiting for job {job_id}")
+        return None
 
 async def main():
     """Main function for email monitoring"""
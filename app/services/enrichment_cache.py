@@ -0,0 +1,218 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+from loguru import logger
+
+# Keys per SELECT ... IN, below SQLite's bound parameter limit
+LOOKUP_BATCH = 500
+
+class EnrichmentCache:
+    """On-disk SQLite cache of AI enrichment fields keyed by part reference"""
+
+    # Run a full eviction pass every N writes
+    EVICTION_INTERVAL = 500
+
+    def __init__(self, db_path: Path, prompt_version: str, ttl_days: int, max_entries: int):
+        self.db_path = Path(db_path)
+        self.prompt_version = prompt_version
+        self.ttl_days = ttl_days
+        self.ttl_seconds = ttl_days * 24 * 3600
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS enrichment_cache (
+                key TEXT PRIMARY KEY,
+                referencia TEXT NOT NULL,
+                descricao TEXT NOT NULL DEFAULT '',
+                prompt_version TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(enrichment_cache)")}
+        if "descricao" not in columns:
+            # Caches created before descriptions were stored
+            self._conn.execute("ALTER TABLE enrichment_cache ADD COLUMN descricao TEXT NOT NULL DEFAULT ''")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_enrichment_cache_referencia ON enrichment_cache (referencia)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_enrichment_cache_last_access ON enrichment_cache (last_access)"
+        )
+        self._conn.commit()
+
+        self.evict()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize text for cache keys: no accents, upper case, single spaces"""
+        text = unicodedata.normalize("NFKD", str(text or ""))
+        text = "".join(char for char in text if not unicodedata.combining(char))
+        return re.sub(r"\s+", " ", text).strip().upper()
+
+    def make_key(self, referencia: str, descricao: str) -> str:
+        """Build the cache key from reference, description and prompt version"""
+        raw = f"{self.normalize(referencia)}|{self.normalize(descricao)}|{self.prompt_version}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, referencia: str, descricao: str) -> Optional[Dict[str, Any]]:
+        """Return cached AI fields for a part, or None on a miss"""
+        key = self.make_key(referencia, descricao)
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, created_at FROM enrichment_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or (self.ttl_seconds > 0 and now - row[1] > self.ttl_seconds):
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE enrichment_cache SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def get_many(self, parts: List[Tuple[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        """
+        Cached AI fields of many parts in a few queries
+
+        Args:
+            parts: (reference, description) of each part
+
+        Returns:
+            The AI fields of each part, None on a miss, in the order given
+        """
+        keys = [self.make_key(referencia, descricao) for referencia, descricao in parts]
+        unique_keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+
+        with self._lock:
+            for start in range(0, len(unique_keys), LOOKUP_BATCH):
+                batch = unique_keys[start:start + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, data, created_at FROM enrichment_cache "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, data, created_at in rows:
+                    if self.ttl_seconds <= 0 or now - created_at <= self.ttl_seconds:
+                        found[key] = data
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE enrichment_cache SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._conn.commit()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def set(self, referencia: str, descricao: str, ai_data: Dict[str, Any]):
+        """Store the AI fields of a part"""
+        key = self.make_key(referencia, descricao)
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO enrichment_cache "
+                "(key, referencia, descricao, prompt_version, data, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, self.normalize(referencia), self.normalize(descricao), self.prompt_version,
+                 json.dumps(ai_data, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+            self._writes += 1
+            run_eviction = self._writes % self.EVICTION_INTERVAL == 0
+
+        if run_eviction:
+            self.evict()
+
+    def recent(self, limit: int) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """(reference, description, AI fields) of the most recently used entries of the current prompt version"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT referencia, descricao, data FROM enrichment_cache "
+                "WHERE prompt_version = ? AND descricao != '' ORDER BY last_access DESC LIMIT ?",
+                (self.prompt_version, limit if limit > 0 else -1)
+            ).fetchall()
+
+        return [(referencia, descricao, json.loads(data)) for referencia, descricao, data in rows]
+
+    def evict(self) -> int:
+        """Drop expired entries and trim the cache to max_entries (least recently used first)"""
+        removed = 0
+
+        with self._lock:
+            if self.ttl_seconds > 0:
+                cursor = self._conn.execute(
+                    "DELETE FROM enrichment_cache WHERE created_at < ?",
+                    (time.time() - self.ttl_seconds,)
+                )
+                removed += cursor.rowcount
+
+            if self.max_entries > 0:
+                cursor = self._conn.execute(
+                    "DELETE FROM enrichment_cache WHERE key IN ("
+                    "SELECT key FROM enrichment_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+                removed += cursor.rowcount
+
+            self._conn.commit()
+
+        if removed:
+            logger.info(f"Evicted {removed} enrichment cache entries")
+        return removed
+
+    def invalidate(self, referencia: Optional[str] = None) -> int:
+        """Remove the entries of one part reference, or every entry when no reference is given"""
+        with self._lock:
+            if referencia:
+                cursor = self._conn.execute(
+                    "DELETE FROM enrichment_cache WHERE referencia = ?", (self.normalize(referencia),)
+                )
+            else:
+                cursor = self._conn.execute("DELETE FROM enrichment_cache")
+            self._conn.commit()
+
+        logger.info(f"Invalidated {cursor.rowcount} enrichment cache entries")
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the number of stored entries"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM enrichment_cache").fetchone()[0]
+
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "prompt_version": self.prompt_version,
+            "max_entries": self.max_entries,
+            "ttl_days": self.ttl_days
+        }
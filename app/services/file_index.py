@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+from loguru import logger
+
+
+class ProcessedFileIndex:
+    """SQLite index of enriched outputs keyed by the normalized content hash of their input"""
+
+    def __init__(self, db_path: Path, prompt_version: str):
+        self.db_path = Path(db_path)
+        self.prompt_version = prompt_version
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_files (
+                content_hash TEXT PRIMARY KEY,
+                input_name TEXT NOT NULL,
+                output_path TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                prompt_version TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_hit REAL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_files_output_path ON processed_files (output_path)"
+        )
+        self._conn.commit()
+
+    def get(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the entry for an already processed input, or None
+
+        Entries from another prompt version, or whose output file is gone,
+        are dropped so the input is processed again.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT input_name, output_path, row_count, prompt_version FROM processed_files "
+                "WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            input_name, output_path, row_count, prompt_version = row
+            if prompt_version != self.prompt_version or not Path(output_path).is_file():
+                self._conn.execute("DELETE FROM processed_files WHERE content_hash = ?", (content_hash,))
+                self._conn.commit()
+                return None
+
+            self._conn.execute(
+                "UPDATE processed_files SET last_hit = ?, hits = hits + 1 WHERE content_hash = ?",
+                (time.time(), content_hash)
+            )
+            self._conn.commit()
+
+        return {
+            "content_hash": content_hash,
+            "input_name": input_name,
+            "output_path": Path(output_path),
+            "row_count": row_count
+        }
+
+    def record(self, content_hash: str, input_name: str, output_path: Path, row_count: int):
+        """Register the output of a completed run"""
+        with self._lock:
+            # The output file was overwritten, so entries pointing at it are stale
+            self._conn.execute(
+                "DELETE FROM processed_files WHERE output_path = ? AND content_hash != ?",
+                (str(output_path), content_hash)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO processed_files "
+                "(content_hash, input_name, output_path, row_count, prompt_version, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, input_name, str(output_path), row_count, self.prompt_version, time.time())
+            )
+            self._conn.commit()
+
+    def remove(self, content_hash: Optional[str] = None) -> int:
+        """Forget one input (or all of them) so it is enriched again on the next upload"""
+        with self._lock:
+            if content_hash is None:
+                cursor = self._conn.execute("DELETE FROM processed_files")
+            else:
+                cursor = self._conn.execute(
+                    "DELETE FROM processed_files WHERE content_hash = ?", (content_hash,)
+                )
+            self._conn.commit()
+            removed = cursor.rowcount
+
+        logger.info(f"Removed {removed} processed file entries")
+        return removed
+
+    def list_entries(self) -> List[Dict[str, Any]]:
+        """All indexed inputs, most recent first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash, input_name, output_path, row_count, prompt_version, "
+                "created_at, last_hit, hits FROM processed_files ORDER BY created_at DESC"
+            ).fetchall()
+
+        return [
+            {
+                "content_hash": content_hash,
+                "input_name": input_name,
+                "output_path": output_path,
+                "row_count": row_count,
+                "prompt_version": prompt_version,
+                "created_at": created_at,
+                "last_hit": last_hit,
+                "hits": hits
+            }
+            for content_hash, input_name, output_path, row_count, prompt_version, created_at, last_hit, hits in rows
+        ]
@@ -0,0 +1,214 @@
+import codecs
+import csv
+import io
+from pathlib import Path
+from typing import Iterator, List, Optional
+import pandas as pd
+from loguru import logger
+from app.core.config import settings
+from app.services.preprocessing import INPUT_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional: the pandas reader is used instead
+    pa = None
+    pa_csv = None
+
+# Separators tried when sniffing the header
+DELIMITERS = (",", ";", "\t", "|")
+
+# Tried in order when the sample is not valid UTF-8 (cp1252 is Latin-1 plus
+# the quotes and dashes Windows exports use; Latin-1 decodes any byte)
+FALLBACK_ENCODINGS = ("cp1252", "latin-1")
+
+# Bytes parsed per Arrow block (each block is parsed by its own thread)
+ARROW_BLOCK_SIZE = 1 << 22
+
+
+class InputDialect:
+    """Encoding, separator, header (column names as written) and quoted line breaks of an input CSV"""
+
+    def __init__(self, encoding: str, delimiter: str, header: List[str], quoted_newlines: bool = False):
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.header = header
+        # Whether a quoted value of the sniffed sample spans lines
+        self.quoted_newlines = quoted_newlines
+
+    def __repr__(self) -> str:
+        return (
+            f"InputDialect(encoding={self.encoding!r}, delimiter={self.delimiter!r}, "
+            f"quoted_newlines={self.quoted_newlines!r})"
+        )
+
+
+def sniff_encoding(sample: bytes, complete: bool) -> str:
+    """
+    Encoding of a file from its first bytes
+
+    Args:
+        sample: First bytes of the file
+        complete: Whether the sample is the whole file (otherwise a
+            character cut at the end of the sample is not an error)
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=complete)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            sample.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def sniff_delimiter(header_line: str) -> str:
+    """Separator that splits the header into the most known input columns (then the most columns)"""
+    def score(delimiter: str):
+        columns = [column.strip() for column in next(csv.reader([header_line], delimiter=delimiter), [])]
+        return sum(1 for column in columns if column in INPUT_COLUMNS), len(columns)
+
+    return max(DELIMITERS, key=score)
+
+
+def sniff_quoted_newlines(text: str, delimiter: str) -> bool:
+    """Whether a quoted value of a sample spans lines (a record cut at the end of the sample counts as one)"""
+    try:
+        return any(
+            "\n" in value or "\r" in value
+            for row in csv.reader(io.StringIO(text, newline=""), delimiter=delimiter, strict=True)
+            for value in row
+        )
+    except csv.Error:
+        return True
+
+
+def sniff_dialect(input_path: Path) -> InputDialect:
+    """
+    Sniff the encoding, separator and quoted line breaks of an input CSV from its first CSV_SNIFF_BYTES bytes
+
+    CSV_ENCODING and CSV_DELIMITER, when set, are used as is.
+    """
+    with open(input_path, "rb") as input_file:
+        sample = input_file.read(settings.CSV_SNIFF_BYTES)
+        complete = not input_file.read(1)
+
+    encoding = settings.CSV_ENCODING or sniff_encoding(sample, complete)
+    text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=complete)
+    header_line = text.lstrip("\ufeff").splitlines()[0] if text.strip() else ""
+    delimiter = settings.CSV_DELIMITER or sniff_delimiter(header_line)
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    quoted_newlines = sniff_quoted_newlines(text.lstrip("\ufeff"), delimiter)
+
+    dialect = InputDialect(encoding, delimiter, header, quoted_newlines)
+    logger.debug(f"Sniffed {input_path.name}: {dialect}")
+    return dialect
+
+
+def use_arrow() -> bool:
+    """Whether inputs are parsed with the Arrow reader (CSV_ENGINE, pyarrow installed with the arrow extra)"""
+    if settings.CSV_ENGINE == "pandas":
+        return False
+    if pa_csv is None:
+        if settings.CSV_ENGINE == "pyarrow":
+            logger.warning("CSV_ENGINE=pyarrow but pyarrow is not installed (the arrow extra), reading with pandas")
+        return False
+    return True
+
+
+def read_chunks(input_path: Path, chunk_size: int, dialect: Optional[InputDialect] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read an input CSV in DataFrames of chunk_size rows
+
+    Every column is read as a string (empty cells as ""), so prices,
+    quantities and EANs keep their text instead of being inferred as
+    numbers ("7891234567890.0") and formatted back.
+    """
+    dialect = dialect or sniff_dialect(input_path)
+    reader = _arrow_chunks if use_arrow() else _pandas_chunks
+    for chunk in reader(input_path, chunk_size, dialect):
+        chunk.columns = [str(column).strip() for column in chunk.columns]
+        yield chunk
+
+
+def _pandas_chunks(input_path: Path, chunk_size: int, dialect: InputDialect) -> Iterator[pd.DataFrame]:
+    yield from pd.read_csv(
+        input_path,
+        sep=dialect.delimiter,
+        encoding=dialect.encoding,
+        dtype=str,
+        na_filter=False,
+        chunksize=chunk_size
+    )
+
+
+def _arrow_chunks(input_path: Path, chunk_size: int, dialect: InputDialect) -> Iterator[pd.DataFrame]:
+    """
+    Stream the file through Arrow's multithreaded parser
+
+    Values spanning lines keep Arrow from splitting blocks at any line break,
+    so they are only allowed when the sniffed sample has one. A quoted line
+    break further on makes the parser fail: the file is then read again
+    allowing them, from the first row not yet returned.
+    """
+    rows = 0
+    try:
+        for chunk in _arrow_batches(input_path, chunk_size, dialect, dialect.quoted_newlines):
+            rows += len(chunk)
+            yield chunk
+    except pa.ArrowInvalid as e:
+        if dialect.quoted_newlines:
+            raise
+        logger.info(f"Reading {input_path.name} again allowing line breaks in values after row {rows}: {str(e)}")
+
+        for chunk in _arrow_batches(input_path, chunk_size, dialect, newlines_in_values=True):
+            if rows >= len(chunk):
+                rows -= len(chunk)
+                continue
+            yield chunk.iloc[rows:].reset_index(drop=True)
+            rows = 0
+
+
+def _arrow_batches(
+    input_path: Path,
+    chunk_size: int,
+    dialect: InputDialect,
+    newlines_in_values: bool
+) -> Iterator[pd.DataFrame]:
+    """Regroup the batches of Arrow's streaming reader into chunks of chunk_size rows"""
+    reader = pa_csv.open_csv(
+        str(input_path),
+        read_options=pa_csv.ReadOptions(
+            encoding=dialect.encoding, block_size=ARROW_BLOCK_SIZE, use_threads=True
+        ),
+        parse_options=pa_csv.ParseOptions(delimiter=dialect.delimiter, newlines_in_values=newlines_in_values),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in dialect.header},
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False
+        )
+    )
+
+    pending: List["pa.RecordBatch"] = []
+    pending_rows = 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_size:
+            table = pa.Table.from_batches(pending, schema=reader.schema)
+            yield table.slice(0, chunk_size).to_pandas()
+            rest = table.slice(chunk_size)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+
+    if pending_rows:
+        yield pa.Table.from_batches(pending, schema=reader.schema).to_pandas()
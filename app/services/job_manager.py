@@ -0,0 +1,217 @@
+import asyncio
+import itertools
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from loguru import logger
+from app.core.config import settings
+from app.models.csv_models import ProcessingStatus
+from app.services.csv_processor import CSVProcessor
+from app.services.metrics import EMAIL_TO_OUTPUT_SECONDS
+from app.services.sharding import ShardPool
+
+
+class ProcessingJob:
+    """State of one background CSV enrichment job"""
+
+    def __init__(
+        self,
+        job_id: str,
+        input_path: Path,
+        filename: str,
+        content_hash: Optional[str] = None,
+        force: bool = False,
+        received_at: Optional[float] = None,
+        priority: str = "normal",
+        supplier: Optional[str] = None,
+        full_catalog: bool = False
+    ):
+        self.job_id = job_id
+        self.input_path = input_path
+        self.filename = filename
+        self.content_hash = content_hash
+        self.force = force
+        # Unix time the source email arrived, for jobs submitted by the email monitor
+        self.received_at = received_at
+        self.priority = priority
+        # Supplier whose previous catalog the file is diffed against, and whether
+        # the file is its whole catalog (items missing from it were removed)
+        self.supplier = supplier
+        self.full_catalog = full_catalog
+        self.status = "queued"
+        self.message = "Job queued"
+        self.processed_rows = 0
+        self.total_rows: Optional[int] = None
+        self.output_path: Optional[Path] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_status(self) -> ProcessingStatus:
+        """Expose the job as a ProcessingStatus response"""
+        return ProcessingStatus(
+            job_id=self.job_id,
+            status=self.status,
+            message=self.message,
+            processed_rows=self.processed_rows,
+            total_rows=self.total_rows,
+            output_file=str(self.output_path) if self.output_path else None,
+            priority=self.priority,
+            supplier=self.supplier,
+            full_catalog=self.full_catalog
+        )
+
+
+class JobManager:
+    """
+    Queue of CSV enrichment jobs processed by a pool of background workers
+
+    Queued jobs start in priority order (highest JOB_PRIORITY_WEIGHTS weight
+    first, then first come first served); running jobs share the LLM
+    backends through the processor's fair queue. With a shard pool, jobs
+    larger than SHARD_ROWS rows are enriched shard by shard in worker
+    processes instead.
+    """
+
+    def __init__(
+        self,
+        processor: CSVProcessor,
+        workers: int,
+        retention_hours: int,
+        shard_pool: Optional[ShardPool] = None
+    ):
+        self.processor = processor
+        self.shard_pool = shard_pool
+        self.workers = max(1, workers)
+        self.retention_seconds = retention_hours * 3600
+        self.jobs: Dict[str, ProcessingJob] = {}
+        # (-priority weight, arrival, job), so urgent jobs start first
+        self._queue: "asyncio.PriorityQueue[Tuple[float, int, ProcessingJob]]" = asyncio.PriorityQueue()
+        self._arrivals = itertools.count()
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def start(self):
+        """Start the background workers"""
+        if self._worker_tasks:
+            return
+        # The queue waits on the loop it was first used in: move jobs still queued
+        # to a fresh one when the app starts again in another loop
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        self._queue = asyncio.PriorityQueue()
+        for entry in queued:
+            self._queue.put_nowait(entry)
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(index)) for index in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} job workers")
+
+    async def stop(self):
+        """Stop the background workers"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    @staticmethod
+    def new_job_id() -> str:
+        return uuid.uuid4().hex
+
+    async def submit(
+        self,
+        input_path: Path,
+        filename: str,
+        job_id: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        force: bool = False,
+        received_at: Optional[float] = None,
+        priority: Optional[str] = None,
+        supplier: Optional[str] = None,
+        full_catalog: bool = False
+    ) -> ProcessingJob:
+        """Queue a saved input file for enrichment and return its job"""
+        priority = self.processor.resolve_priority(priority)
+        self._prune()
+
+        job = ProcessingJob(
+            job_id or self.new_job_id(), input_path, filename, content_hash, force, received_at, priority, supplier,
+            full_catalog
+        )
+        self.jobs[job.job_id] = job
+        await self._queue.put((-settings.JOB_PRIORITY_WEIGHTS[priority], next(self._arrivals), job))
+
+        logger.info(f"Queued {priority} job {job.job_id} for {filename} (queue depth {self._queue.qsize()})")
+        return job
+
+    def get(self, job_id: str) -> Optional[ProcessingJob]:
+        return self.jobs.get(job_id)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def _worker(self, index: int):
+        """Process queued jobs one at a time"""
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: ProcessingJob):
+        """Run one job and record its outcome"""
+        job.status = "processing"
+        job.message = "Processing"
+        logger.info(f"Starting job {job.job_id} ({job.filename})")
+
+        try:
+            job.total_rows = await asyncio.to_thread(self.processor.count_rows, job.input_path)
+
+            def on_progress(processed_rows: int):
+                job.processed_rows = processed_rows
+
+            file_processor = self.processor
+            if self.shard_pool is not None and job.total_rows > self.shard_pool.shard_rows:
+                file_processor = self.shard_pool
+            
+            job.output_path = await file_processor.process_file(
+                job.input_path,
+                progress_callback=on_progress,
+                content_hash=job.content_hash,
+                force=job.force,
+                priority=job.priority,
+                supplier=job.supplier,
+                full_catalog=job.full_catalog
+            )
+            job.status = "completed"
+            job.message = "Processing completed"
+            logger.info(f"Job {job.job_id} completed: {job.output_path}")
+            
+            if job.received_at is not None:
+                EMAIL_TO_OUTPUT_SECONDS.observe(time.time() - job.received_at)
+
+        except Exception as e:
+            job.status = "failed"
+            job.message = f"Processing error: {str(e)}"
+            logger.error(f"Job {job.job_id} failed: {str(e)}")
+
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        """Forget finished jobs older than the retention period"""
+        if self.retention_seconds <= 0:
+            return
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.is_finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
@@ -0,0 +1,125 @@
+import atexit
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Multiprocess mode: every process (the API and its shard workers) writes its
+# samples to files in this directory and /metrics adds them up. It must be set
+# before prometheus_client is imported; spawned workers inherit it
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="csv-automation-metrics-")
+    atexit.register(shutil.rmtree, os.environ["PROMETHEUS_MULTIPROC_DIR"], True)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Content type of the Prometheus text exposition format (the response adds the charset)
+CONTENT_TYPE = CONTENT_TYPE_LATEST.replace("; charset=utf-8", "")
+
+# Latency buckets in seconds, from a fast JSON parse to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Email arrival to enriched output, in seconds
+EMAIL_LATENCY_BUCKETS = (30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 21600)
+
+NAMESPACE = "csv_automation"
+
+
+class StateGauge:
+    """
+    Gauge read from the API process's state at scrape time
+
+    Function gauges do not exist in multiprocess mode, so these are collected
+    by the scrape registry directly instead of through the shared files.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labelnames = list(labelnames)
+        self._function: Optional[Callable[[], Any]] = None
+
+    def set_function(self, function: Callable[[], Any]):
+        """Read the value at scrape time; labelled gauges return {label values tuple: value}"""
+        self._function = function
+
+    def describe(self) -> List[GaugeMetricFamily]:
+        # Registering must not call the function, which may not be set yet
+        return [GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)]
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        family = GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+        if self._function is not None:
+            values: Dict[Tuple[str, ...], float] = (
+                self._function() if self.labelnames else {(): self._function()}
+            )
+            for label_values, value in values.items():
+                family.add_metric([str(label) for label in label_values], value)
+        yield family
+
+
+CSV_READ_SECONDS = Histogram(
+    "csv_read_seconds", "Time to read and prepare one input chunk of CSV_CHUNK_SIZE rows",
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+CSV_WRITE_SECONDS = Histogram(
+    "csv_write_seconds", "Time to write one enriched row to the output CSV",
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+LLM_CALL_SECONDS = Histogram(
+    "llm_call_seconds", "Duration of LLM calls", ("kind", "backend"),
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+JSON_PARSE_SECONDS = Histogram(
+    "llm_json_parse_seconds", "Time to parse an LLM response as JSON", ("kind",),
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+ROWS = Counter(
+    "rows_enriched", "Output rows by enrichment source (fallback rows use default data)", ("source",),
+    namespace=NAMESPACE
+)
+LLM_TOKENS = Counter(
+    "llm_tokens", "Tokens reported by the LLM API", ("type", "backend"),
+    namespace=NAMESPACE
+)
+LLM_HTTP_ERRORS = Counter(
+    "llm_http_errors", "LLM HTTP attempts answered with 429 or timed out", ("reason",),
+    namespace=NAMESPACE
+)
+LLM_RETRIES = Counter(
+    "llm_retries", "LLM calls retried after a transient provider error", ("reason", "backend"),
+    namespace=NAMESPACE
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "llm_queue_wait_seconds", "Time an LLM call waited in the fair queue for a backend slot", ("priority",),
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+SIMILARITY_LOOKUP_SECONDS = Histogram(
+    "similarity_lookup_seconds", "Time spent in similarity index lookups, off the event loop", ("kind",),
+    namespace=NAMESPACE, buckets=LATENCY_BUCKETS
+)
+EMAIL_TO_OUTPUT_SECONDS = Histogram(
+    "email_to_output_seconds", "Time from email arrival to the enriched output of its CSV",
+    namespace=NAMESPACE, buckets=EMAIL_LATENCY_BUCKETS
+)
+
+# State of the API process (its job queue and its share of the LLM backends)
+LLM_IN_FLIGHT = StateGauge("llm_requests_in_flight", "LLM calls currently running", ("backend",))
+LLM_CONCURRENCY_LIMIT = StateGauge("llm_concurrency_limit", "Adaptive limit on concurrent LLM calls", ("backend",))
+LLM_CIRCUIT_OPEN = StateGauge(
+    "llm_circuit_open", "1 while calls to the backend are paused by its circuit breaker", ("backend",)
+)
+JOB_QUEUE_DEPTH = StateGauge("job_queue_depth", "Jobs waiting for a worker")
+
+# Counters and histograms of every process, plus the API process's state
+REGISTRY = CollectorRegistry()
+MultiProcessCollector(REGISTRY)
+for state_gauge in (LLM_IN_FLIGHT, LLM_CONCURRENCY_LIMIT, LLM_CIRCUIT_OPEN, JOB_QUEUE_DEPTH):
+    REGISTRY.register(state_gauge)
+
+
+def render() -> bytes:
+    """All metrics in the Prometheus text exposition format"""
+    return generate_latest(REGISTRY)
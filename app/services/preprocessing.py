@@ -0,0 +1,105 @@
+import math
+import re
+from typing import Any, Dict, List
+import numpy as np
+import pandas as pd
+
+
+# Input CSV column -> product field used by the enrichment pipeline
+INPUT_COLUMNS = {
+    "Referencia": "referencia",
+    "Descricao": "descricao",
+    "Quantidade Estoque": "quantidade",
+    "Preço de Venda": "preco_venda",
+    "Preço de Custo": "preco_custo",
+    "SKU": "sku",
+    "EAN": "ean",
+}
+
+PRICE_FIELDS = ("preco_venda", "preco_custo")
+
+# Dropped from prices before parsing
+PRICE_NOISE = re.compile(r"R\$|\s")
+
+# Prices whose last separator is a comma use it as the decimal separator and
+# dots for thousands (3,83 / 1.827,11); dots alone in groups of three are
+# thousands too (1.827), any other dot is decimal and commas thousands (1,827.11)
+DECIMAL_COMMA = re.compile(r",\d*$")
+THOUSANDS_DOTS = re.compile(r"^-?\d{1,3}(?:\.\d{3})+$")
+
+# Description starting with a part reference, followed by the actual description
+REFERENCE_PREFIX = re.compile(r"^[\d\w]+\s+(.+)$")
+
+# Derived product fields that do not depend on the AI (set by prepare_products)
+DERIVED_FIELDS = ("descricao_produto", "nome_produto", "descricao_br")
+
+
+def normalize_number(text: str) -> str:
+    """Price text without currency or spaces, with '.' as the only (decimal) separator"""
+    text = PRICE_NOISE.sub("", text)
+    if DECIMAL_COMMA.search(text):
+        return text.replace(".", "").replace(",", ".")
+    if THOUSANDS_DOTS.match(text):
+        return text.replace(".", "")
+    return text.replace(",", "")
+
+
+def clean_price(value: Any) -> str:
+    """Normalize a price to a two-decimal string; empty or invalid prices become 0.00"""
+    if value is None:
+        return "0.00"
+
+    cleaned = normalize_number(str(value))
+    try:
+        price = float(cleaned)
+    except ValueError:
+        return "0.00"
+
+    return f"{price:.2f}" if math.isfinite(price) else "0.00"
+
+
+def clean_price_column(prices: pd.Series) -> pd.Series:
+    """Column-wise clean_price"""
+    text = prices.astype(str).str.replace(PRICE_NOISE, "", regex=True)
+    cleaned = np.where(
+        text.str.contains(DECIMAL_COMMA),
+        text.str.replace(".", "", regex=False).str.replace(",", ".", regex=False),
+        np.where(
+            text.str.match(THOUSANDS_DOTS),
+            text.str.replace(".", "", regex=False),
+            text.str.replace(",", "", regex=False)
+        )
+    )
+    values = pd.to_numeric(pd.Series(cleaned, index=prices.index), errors="coerce").to_numpy(dtype=float)
+    values = np.where(np.isfinite(values), values, 0.0)
+    return pd.Series(np.char.mod("%.2f", values), index=prices.index, dtype=object)
+
+
+def strip_reference(description: str) -> str:
+    """Description without a leading part reference"""
+    match = REFERENCE_PREFIX.match(description)
+    return match.group(1) if match else description
+
+
+def prepare_products(chunk: pd.DataFrame) -> List[Dict[str, str]]:
+    """
+    Clean a chunk of input rows column-wise and derive the fields that do not depend on the AI
+
+    Returns:
+        One product dict per row: the input fields (stripped, prices
+        normalized) plus descricao_produto, nome_produto and descricao_br
+    """
+    columns = {}
+    for column, field in INPUT_COLUMNS.items():
+        values = chunk[column] if column in chunk else pd.Series("", index=chunk.index)
+        columns[field] = values.fillna("").astype(str).str.strip()
+    products = pd.DataFrame(columns, index=chunk.index)
+
+    for field in PRICE_FIELDS:
+        products[field] = clean_price_column(products[field])
+
+    products["descricao_produto"] = products["descricao"].str.replace(REFERENCE_PREFIX, r"\1", regex=True)
+    products["nome_produto"] = (products["descricao_produto"] + " Honda Genuíno").str[:60]
+    products["descricao_br"] = products["descricao"] + " SKU: LK " + products["sku"]
+
+    return products.to_dict("records")
@@ -0,0 +1,237 @@
+import re
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple
+
+
+# Well-known part families that can be enriched without a model call.
+# Keywords are matched as whole words against the normalized description
+# (no accents, upper case); multi-word keywords are matched as phrases.
+PART_FAMILY_RULES: List[Dict[str, Any]] = [
+    {
+        "family": "parafuso",
+        "keywords": ["PARAFUSO", "PARAFUSOS", "PARAF"],
+        "nome_categoria": "Parafusos Moto",
+        "ncm": "7318.15.00",
+        "descricao_ncm": "Parafusos e pinos ou pernos de ferro fundido, ferro ou aço",
+        "descricao_tecnica": "Parafuso em aço",
+        "peso": "0.02",
+        "altura": "1.0",
+        "comprimento": "5.0",
+        "largura": "1.0",
+    },
+    {
+        "family": "porca",
+        "keywords": ["PORCA", "PORCAS"],
+        "nome_categoria": "Porcas Moto",
+        "ncm": "7318.16.00",
+        "descricao_ncm": "Porcas de ferro fundido, ferro ou aço",
+        "descricao_tecnica": "Porca metálica",
+        "peso": "0.01",
+        "altura": "0.8",
+        "comprimento": "1.5",
+        "largura": "1.5",
+    },
+    {
+        "family": "arruela",
+        "keywords": ["ARRUELA", "ARRUELAS"],
+        "nome_categoria": "Fixação Moto",
+        "ncm": "7318.22.00",
+        "descricao_ncm": "Arruelas de ferro fundido, ferro ou aço",
+        "descricao_tecnica": "Arruela metálica",
+        "peso": "0.01",
+        "altura": "0.2",
+        "comprimento": "2.0",
+        "largura": "2.0",
+    },
+    {
+        "family": "rebite",
+        "keywords": ["REBITE", "REBITES"],
+        "nome_categoria": "Fixação Moto",
+        "ncm": "7318.23.00",
+        "descricao_ncm": "Rebites de ferro fundido, ferro ou aço",
+        "descricao_tecnica": "Rebite metálico",
+        "peso": "0.01",
+        "altura": "0.5",
+        "comprimento": "1.5",
+        "largura": "0.5",
+    },
+    {
+        "family": "contrapino",
+        "keywords": ["CONTRA PINO", "CONTRAPINO", "CUPILHA"],
+        "nome_categoria": "Fixação Moto",
+        "ncm": "7318.24.00",
+        "descricao_ncm": "Cavilhas e contrapinos de ferro fundido, ferro ou aço",
+        "descricao_tecnica": "Contrapino em aço",
+        "peso": "0.01",
+        "altura": "0.3",
+        "comprimento": "3.0",
+        "largura": "0.3",
+    },
+    {
+        "family": "valvula",
+        # Engine valves only: tire, fuel tap and brake valves have other NCMs
+        "keywords": [
+            "VALVULA ADMISSAO", "VALVULA ADM", "VALVULA DE ADMISSAO",
+            "VALVULA ESCAPE", "VALVULA ESC", "VALVULA DE ESCAPE",
+            "VALVULAS ADMISSAO", "VALVULAS ESCAPE",
+        ],
+        "nome_categoria": "Válvulas Motor Moto",
+        "ncm": "8409.91.90",
+        "descricao_ncm": "Partes de motores de pistão de ignição por centelha",
+        "descricao_tecnica": "Válvula de motor em aço",
+        "peso": "0.05",
+        "altura": "1.0",
+        "comprimento": "10.0",
+        "largura": "3.0",
+    },
+    {
+        "family": "espelho",
+        "keywords": ["ESPELHO", "ESPELHOS", "RETROVISOR"],
+        "nome_categoria": "Espelhos Retrovisores Moto",
+        "ncm": "7009.10.00",
+        "descricao_ncm": "Espelhos retrovisores para veículos",
+        "descricao_tecnica": "Espelho retrovisor com haste",
+        "peso": "0.30",
+        "altura": "10.0",
+        "comprimento": "25.0",
+        "largura": "12.0",
+    },
+    {
+        "family": "engrenagem",
+        "keywords": ["ENGRENAGEM", "ENGRENAGENS"],
+        "nome_categoria": "Transmissão Moto",
+        "ncm": "8483.40.10",
+        "descricao_ncm": "Engrenagens e rodas de fricção",
+        "descricao_tecnica": "Engrenagem metálica",
+        "peso": "0.15",
+        "altura": "2.0",
+        "comprimento": "6.0",
+        "largura": "6.0",
+    },
+    {
+        "family": "carenagem",
+        "keywords": ["CARENAGEM", "CARENAGENS"],
+        "nome_categoria": "Carroceria Moto",
+        "ncm": "8714.19.00",
+        "descricao_ncm": "Partes e acessórios de motocicletas",
+        "descricao_tecnica": "Carenagem plástica",
+        "peso": "0.50",
+        "altura": "10.0",
+        "comprimento": "40.0",
+        "largura": "20.0",
+    },
+]
+
+# Words that turn a single part into an assembly or set, which the rules cannot size
+AMBIGUOUS_KEYWORDS = ["KIT", "JOGO", "CONJUNTO", "CONJ", "JG"]
+
+# Confidence when the family keyword starts the description vs appears later on
+HEAD_MATCH_CONFIDENCE = 1.0
+TAIL_MATCH_CONFIDENCE = 0.5
+
+
+class KeywordTrie:
+    """Word-level trie for matching single- and multi-word keywords in token lists"""
+
+    def __init__(self):
+        self._root: Dict[str, Any] = {}
+
+    def add(self, keyword: str, value: Any):
+        """Register a keyword (one or more words) with its value"""
+        node = self._root
+        for token in keyword.split():
+            node = node.setdefault(token, {})
+        node["$"] = value
+
+    def match_at(self, tokens: List[str], start: int) -> Optional[Tuple[Any, int]]:
+        """Return the value and length of the longest keyword starting at `start`"""
+        node = self._root
+        best = None
+        for position in range(start, len(tokens)):
+            node = node.get(tokens[position])
+            if node is None:
+                break
+            if "$" in node:
+                best = (node["$"], position - start + 1)
+        return best
+
+    def find_all(self, tokens: List[str]) -> List[Tuple[int, Any]]:
+        """Return (position, value) for every keyword found in the tokens"""
+        matches = []
+        position = 0
+        while position < len(tokens):
+            match = self.match_at(tokens, position)
+            if match:
+                matches.append((position, match[0]))
+                position += match[1]
+            else:
+                position += 1
+        return matches
+
+
+class PartRuleEngine:
+    """Deterministic classifier for well-known part families"""
+
+    def __init__(self, min_confidence: float, rules: Optional[List[Dict[str, Any]]] = None):
+        self.min_confidence = min_confidence
+        self.rules = rules or PART_FAMILY_RULES
+
+        self._families = KeywordTrie()
+        for rule in self.rules:
+            for keyword in rule["keywords"]:
+                self._families.add(self._normalize(keyword), rule)
+
+        self._ambiguous = KeywordTrie()
+        for keyword in AMBIGUOUS_KEYWORDS:
+            self._ambiguous.add(keyword, True)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        """Remove accents and punctuation, upper-case the text"""
+        text = unicodedata.normalize("NFKD", str(text or ""))
+        text = "".join(char for char in text if not unicodedata.combining(char))
+        return re.sub(r"[^A-Z0-9]+", " ", text.upper()).strip()
+
+    def _tokenize(self, referencia: str, descricao: str) -> List[str]:
+        """Split the description into words, dropping a leading part reference"""
+        tokens = self._normalize(descricao).split()
+        reference_tokens = self._normalize(referencia).split()
+
+        if reference_tokens and tokens[:len(reference_tokens)] == reference_tokens:
+            tokens = tokens[len(reference_tokens):]
+        elif tokens and any(char.isdigit() for char in tokens[0]):
+            # Description starts with a code that differs from the reference
+            tokens = tokens[1:]
+
+        return tokens
+
+    def classify(self, referencia: str, descricao: str) -> Optional[Dict[str, Any]]:
+        """
+        Classify a part into a known family
+
+        Returns:
+            The matching rule plus a `confidence` score, or None when the
+            description matches no family or several different families
+        """
+        tokens = self._tokenize(referencia, descricao)
+        if not tokens:
+            return None
+
+        matches = self._families.find_all(tokens)
+        families = {rule["family"] for _, rule in matches}
+        if len(families) != 1:
+            return None
+
+        position, rule = matches[0]
+        confidence = HEAD_MATCH_CONFIDENCE if position == 0 else TAIL_MATCH_CONFIDENCE
+        if self._ambiguous.find_all(tokens):
+            confidence = min(confidence, TAIL_MATCH_CONFIDENCE)
+
+        return {**rule, "confidence": confidence}
+
+    def enrich(self, referencia: str, descricao: str) -> Optional[Dict[str, Any]]:
+        """Return the family's enrichment fields when the classification is confident enough"""
+        match = self.classify(referencia, descricao)
+        if match is None or match["confidence"] < self.min_confidence:
+            return None
+        return match
@@ -0,0 +1,475 @@
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, List, Optional, Tuple, Type, TypeVar
+from loguru import logger
+from app.services.metrics import LLM_QUEUE_WAIT_SECONDS, LLM_RETRIES
+
+T = TypeVar("T")
+
+
+class RateLimiter:
+    """Token bucket limiter for requests per minute and tokens per minute"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        # Buckets start full so the first burst is not delayed
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        """Refill both buckets according to the elapsed time"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+
+        if self.requests_per_minute > 0:
+            self._request_allowance = min(
+                float(self.requests_per_minute),
+                self._request_allowance + elapsed * self.requests_per_minute / 60.0
+            )
+        if self.tokens_per_minute > 0:
+            self._token_allowance = min(
+                float(self.tokens_per_minute),
+                self._token_allowance + elapsed * self.tokens_per_minute / 60.0
+            )
+
+    def _wait_time(self, tokens: int) -> float:
+        """Seconds until one request with the given token cost fits in the budget"""
+        wait = 0.0
+
+        if self.requests_per_minute > 0 and self._request_allowance < 1:
+            missing = 1 - self._request_allowance
+            wait = max(wait, missing * 60.0 / self.requests_per_minute)
+
+        if self.tokens_per_minute > 0 and self._token_allowance < tokens:
+            missing = tokens - self._token_allowance
+            wait = max(wait, missing * 60.0 / self.tokens_per_minute)
+
+        return wait
+
+    def _fit(self, tokens: int) -> int:
+        # A single request larger than the whole budget would never fit
+        if self.tokens_per_minute > 0:
+            return min(tokens, self.tokens_per_minute)
+        return tokens
+
+    def delay(self, tokens: int = 0) -> float:
+        """Seconds until a request costing `tokens` fits in the budget, without reserving it"""
+        self._refill()
+        return self._wait_time(self._fit(tokens))
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until a request costing `tokens` can be sent"""
+        tokens = self._fit(tokens)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests_per_minute > 0:
+                self._request_allowance -= 1
+            if self.tokens_per_minute > 0:
+                self._token_allowance -= tokens
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Delay requested by the provider in the Retry-After headers of a failed call, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on in-flight calls
+
+    The limit grows by one per window of successful calls and is halved when
+    the provider throttles, at most once per congestion event.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+
+    @property
+    def has_slot(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def acquire(self) -> float:
+        """Take a slot (callers check has_slot first); returns when the call started"""
+        self.in_flight += 1
+        return time.monotonic()
+
+    def release(self):
+        self.in_flight -= 1
+
+    def on_success(self):
+        self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def on_throttle(self, started_at: float) -> bool:
+        """Halve the limit; returns False for calls sent before the last decrease"""
+        if started_at < self._last_decrease:
+            return False
+        self.limit = max(float(self.min_limit), self.limit / 2)
+        self._last_decrease = time.monotonic()
+        return True
+
+
+class CircuitBreaker:
+    """
+    Pauses LLM calls after consecutive provider failures
+
+    While open, callers wait instead of failing. After the cooldown a single
+    probe call goes through: success closes the circuit, failure reopens it
+    with a doubled cooldown.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float, max_cooldown: float, name: str = "LLM backend"):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.failure_threshold
+
+    def ready_at(self, now: float) -> float:
+        """When the next call may go through (infinity while a probe is running)"""
+        if not self.is_open:
+            return now
+        if now < self.open_until:
+            return self.open_until
+        return math.inf if self._probing else now
+
+    def start_probe(self) -> bool:
+        """Mark the call about to go through as the probe; returns True if the circuit is open"""
+        if not self.is_open:
+            return False
+        self._probing = True
+        return True
+
+    def abandon_probe(self):
+        """Let another call probe when the probe was cancelled"""
+        self._probing = False
+
+    def record_success(self):
+        if self.is_open:
+            logger.info(f"{self.name} recovered, circuit closed")
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self._probing = False
+
+    def record_failure(self, probe: bool = False):
+        self.failures += 1
+        if probe:
+            # Still failing after the cooldown: pause longer
+            self._probing = False
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        elif self.failures != self.failure_threshold:
+            # Calls already in flight when the circuit opened do not extend the pause
+            return
+        self.open_until = time.monotonic() + self.cooldown
+        logger.warning(
+            f"{self.name} circuit open after {self.failures} consecutive failures, pausing calls for {self.cooldown:.0f}s"
+        )
+
+
+class Backend:
+    """
+    Scheduling state of one LLM backend (API key and/or endpoint)
+
+    Each backend has its own rate budget, adaptive concurrency, circuit
+    breaker and Retry-After pause, so one throttled key does not hold back
+    the others.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        min_concurrency: int = 1,
+        circuit_breaker: Optional[CircuitBreaker] = None
+    ):
+        self.name = name
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, min_concurrency)
+        self.circuit_breaker = circuit_breaker
+        # Retry-After from the provider holds back every call to this backend
+        self.resume_at = 0.0
+
+    @property
+    def load(self) -> float:
+        """Share of the current concurrency limit in use"""
+        return self.concurrency.in_flight / self.concurrency.limit
+
+    @property
+    def circuit_open(self) -> bool:
+        return self.circuit_breaker is not None and self.circuit_breaker.is_open
+
+    def ready_at(self, now: float) -> float:
+        """When the backend may take another call, concurrency aside"""
+        ready = max(now, self.resume_at)
+        if self.circuit_breaker:
+            ready = max(ready, self.circuit_breaker.ready_at(now))
+        return ready
+
+    def available(self, now: float) -> bool:
+        return self.ready_at(now) <= now and self.concurrency.has_slot
+
+    def on_success(self):
+        self.concurrency.on_success()
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+
+    def on_failure(self, started_at: float, probe: bool, retry_after: Optional[float]):
+        """Throttle the backend after a transient provider error"""
+        if self.concurrency.on_throttle(started_at):
+            logger.warning(f"{self.name} throttling, concurrency lowered to {int(self.concurrency.limit)}")
+        if self.circuit_breaker:
+            self.circuit_breaker.record_failure(probe)
+        if retry_after:
+            self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+
+
+class Flow:
+    """
+    One stream of calls sharing the backends fairly, usually one file being enriched
+
+    Under weighted fair queuing a flow gets a share of the calls proportional
+    to its weight, however many calls it has waiting.
+    """
+
+    def __init__(self, name: str, weight: float = 1.0, priority: str = "normal"):
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+        # Virtual finish tag of the flow's last queued call
+        self.last_finish = 0.0
+
+
+class EnrichmentScheduler:
+    """
+    Runs enrichment calls concurrently over a pool of LLM backends
+
+    Calls from all files wait in one weighted fair queue (self-clocked fair
+    queuing): each call is tagged with a virtual finish time advanced by its
+    estimated tokens over its flow's weight, and the smallest tag gets the
+    next free slot. A small file therefore finishes quickly even while a huge
+    one has hundreds of calls waiting. Each call goes to the least-loaded healthy backend that has a free slot,
+    preferring backends whose rate budget is not exhausted. Transient
+    provider errors are retried with jittered exponential backoff (honoring
+    Retry-After), on another backend when one is free; they also lower the
+    failing backend's concurrency and, when they keep coming, open its
+    circuit so its calls pause instead of failing.
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        retryable: Tuple[Type[BaseException], ...] = (),
+        max_retries: int = 0,
+        retry_base_delay: float = 1.0,
+        retry_max_delay: float = 60.0
+    ):
+        if not backends:
+            raise ValueError("EnrichmentScheduler needs at least one backend")
+        self.backends = backends
+        self.retryable = retryable
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        # Notified whenever a slot is released or a backend's health changes
+        self._condition = asyncio.Condition()
+        # Waiting calls as (virtual finish tag, arrival), smallest served first
+        self._queue: List[Tuple[float, int]] = []
+        self._arrivals = itertools.count()
+        # Finish tag of the last call served, the fair queue's virtual clock
+        self._virtual_time = 0.0
+        # Flow of calls that do not name one
+        self.default_flow = Flow("default")
+
+    @property
+    def in_flight(self) -> int:
+        return sum(backend.concurrency.in_flight for backend in self.backends)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    def _enqueue(self, flow: Flow, tokens: int) -> Tuple[float, int]:
+        """Tag a call of `flow` and put it in the fair queue"""
+        # A flow that was idle does not get credit for the time it did not use
+        start = max(self._virtual_time, flow.last_finish)
+        flow.last_finish = start + max(1, tokens) / flow.weight
+        entry = (flow.last_finish, next(self._arrivals))
+        heapq.heappush(self._queue, entry)
+        return entry
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Jittered exponential delay before retry `attempt`, never shorter than Retry-After"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.0)
+        return max(delay, retry_after or 0.0)
+
+    async def _acquire(
+        self,
+        tokens: int,
+        flow: Flow,
+        avoid: Optional[Backend] = None
+    ) -> Tuple[Backend, float, bool]:
+        """
+        Wait for the call's turn in the fair queue and for a backend that can take it
+
+        Returns the backend, when the call started and whether the call is
+        the probe of the backend's open circuit. `avoid` (the backend a retry
+        just failed on) is only picked when no other backend is available.
+        """
+        async with self._condition:
+            entry = self._enqueue(flow, tokens)
+            queued_at = time.monotonic()
+            try:
+                while True:
+                    now = time.monotonic()
+                    available = [backend for backend in self.backends if backend.available(now)]
+                    if available and self._queue[0] == entry:
+                        heapq.heappop(self._queue)
+                        self._virtual_time = entry[0]
+                        # The next call in line may fit in another free slot
+                        self._condition.notify_all()
+                        LLM_QUEUE_WAIT_SECONDS.labels(priority=flow.priority).observe(now - queued_at)
+
+                        backend = min(available, key=lambda backend: (
+                            backend is avoid,
+                            backend.rate_limiter.delay(tokens) > 0,
+                            backend.load
+                        ))
+                        probe = backend.circuit_breaker.start_probe() if backend.circuit_breaker else False
+                        return backend, backend.concurrency.acquire(), probe
+
+                    # Sleep until a paused backend resumes, or until a slot is released
+                    resume = [backend.ready_at(now) for backend in self.backends]
+                    resume = [ready for ready in resume if now < ready < math.inf]
+                    timeout = min(resume) - now if resume else None
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                # Cancelled while waiting: leave the queue to the calls behind
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._condition.notify_all()
+                raise
+
+    async def _release(self, backend: Backend):
+        async with self._condition:
+            backend.concurrency.release()
+            self._condition.notify_all()
+
+    async def run(
+        self,
+        func: Callable[[str], Awaitable[T]],
+        tokens: int = 0,
+        flow: Optional[Flow] = None
+    ) -> T:
+        """
+        Run one enrichment call once its turn comes and a backend slot and rate budget are available
+
+        Args:
+            func: Coroutine factory performing the call on the backend whose name it receives
+            tokens: Estimated tokens (prompt + completion) consumed by the call
+            flow: Flow the call belongs to (its file), default_flow if omitted
+
+        Returns:
+            Whatever the coroutine returns
+
+        Raises:
+            The last retryable error once max_retries is exhausted; other
+            errors are raised right away
+        """
+        flow = flow or self.default_flow
+        attempt = 0
+        backend = None
+        while True:
+            backend, started_at, probe = await self._acquire(tokens, flow, avoid=backend)
+            try:
+                await backend.rate_limiter.acquire(tokens)
+                result = await func(backend.name)
+            except self.retryable as e:
+                error = e
+                retry_after = retry_after_seconds(e)
+                backend.on_failure(started_at, probe, retry_after)
+            except BaseException:
+                # Cancelled, or an error that says nothing about the provider's health
+                if probe:
+                    backend.circuit_breaker.abandon_probe()
+                raise
+            else:
+                backend.on_success()
+                return result
+            finally:
+                # After the circuit update, so calls waiting on a probe see its outcome
+                await self._release(backend)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+
+            LLM_RETRIES.labels(reason=type(error).__name__, backend=backend.name).inc()
+            now = time.monotonic()
+            if any(other is not backend and other.available(now) for other in self.backends):
+                logger.warning(
+                    f"LLM call failed on {backend.name} ({type(error).__name__}: {str(error)}); "
+                    f"retry {attempt}/{self.max_retries} on another backend"
+                )
+                continue
+
+            delay = self.backoff_delay(attempt, retry_after)
+            logger.warning(
+                f"LLM call failed on {backend.name} ({type(error).__name__}: {str(error)}); "
+                f"retry {attempt}/{self.max_retries} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
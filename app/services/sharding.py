@@ -0,0 +1,564 @@
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from app.core.config import settings
+from app.services.csv_processor import CSVProcessor, REPORT_COLUMNS
+from app.services.ingestion import read_chunks, sniff_dialect
+from app.services.upload_storage import hash_file
+
+# Seconds between checks of the shard states
+POLL_INTERVAL = 1.0
+
+MANIFEST_NAME = "manifest.json"
+
+# Processor and event loop of a pool worker process, created by _init_worker
+_worker_processor: Optional[CSVProcessor] = None
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def llm_share(workers: int) -> float:
+    """
+    Fraction of each LLM backend's budget for the API process and for each shard worker
+
+    The budget is split across the workers plus the API process, so sharded
+    and regular jobs together stay within AI_REQUESTS_PER_MINUTE,
+    AI_TOKENS_PER_MINUTE and AI_MAX_CONCURRENT_REQUESTS.
+    """
+    return 1 / (max(1, workers) + 1)
+
+
+def _init_worker(llm_share: float):
+    """Create the worker process's CSVProcessor and the event loop it keeps for every shard"""
+    global _worker_processor, _worker_loop
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+    _worker_processor = CSVProcessor(llm_share=llm_share)
+    # Shards are tracked by their done markers, not the processed-file index
+    _worker_processor.processed_files = None
+
+
+def _process_shard(
+    shard_path: str,
+    priority: Optional[str],
+    supplier: Optional[str] = None,
+    catalog_run: Optional[str] = None,
+    force: bool = False
+) -> str:
+    """Enrich one shard in a worker process and mark it done; returns the shard output path"""
+    path = Path(shard_path)
+    try:
+        output_path = _worker_loop.run_until_complete(
+            _worker_processor.process_file(
+                path, force=force, priority=priority, supplier=supplier, catalog_run=catalog_run
+            )
+        )
+    except Exception as e:
+        # Provider exceptions do not always pickle back to the parent process
+        raise RuntimeError(f"{type(e).__name__}: {str(e)}") from None
+
+    _write_json(path.with_suffix(".done"), {"output": Path(output_path).name, "finished_at": time.time()})
+    return str(output_path)
+
+
+def _write_json(path: Path, data: Dict[str, Any]):
+    """Write a small JSON file atomically"""
+    partial_path = path.with_name(f"{path.name}.tmp")
+    partial_path.write_text(json.dumps(data), encoding="utf-8")
+    partial_path.replace(path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ShardPool:
+    """
+    Enriches large files as row-range shards in a pool of worker processes
+
+    The input is split into shards of SHARD_ROWS rows under
+    `<CSV_STORAGE_PATH>/shards/<content hash>/`, each enriched by
+    CSVProcessor.process_file in a worker process (its own event loop, with
+    1/(SHARD_WORKERS + 1) of each LLM backend's budget, the API process
+    keeping the rest), and the shard outputs and reports are concatenated in
+    input order. Shard LLM calls are queued in their worker process, so the
+    job's priority only weighs against other shards of that worker, not
+    against the jobs of the API process.
+
+    Each worker is a CSVProcessor of its own, so these are per process:
+    the LLM agent and its adaptive limits and circuit breakers (over its
+    share of the budget), the fair queue, and the similarity index, rebuilt
+    from the cache when the worker starts. The SQLite stores are shared,
+    their writers waiting on each other's locks. Counters and histograms of
+    the workers are added up in /metrics (multiprocess mode); the in-flight,
+    concurrency limit, circuit and queue depth gauges show the API process
+    only.
+
+    Only one job at a time works on a given content: a second job for the
+    same bytes (force, or deduplication off) waits for the first to finish,
+    since both would use, and the first to finish remove, the same work
+    directory.
+
+    Shard state lives in files next to the shards, so it survives restarts
+    and can be shared by several replicas mounting the same storage:
+    `.lock` claims a shard (renewed while it runs, taken over once stale),
+    `.done` marks it finished and `.attempts` counts its failures. A failed
+    shard is retried up to SHARD_MAX_ATTEMPTS times; finished shards are
+    never redone, also when the file is submitted again after a failure.
+    """
+
+    def __init__(
+        self,
+        processor: CSVProcessor,
+        workers: int,
+        shard_rows: int,
+        max_attempts: int,
+        lease_seconds: int,
+        helper: bool = False
+    ):
+        self.processor = processor
+        self.workers = max(1, workers)
+        self.shard_rows = shard_rows
+        self.max_attempts = max(1, max_attempts)
+        self.lease_seconds = lease_seconds
+        self.helper = helper
+        self.root = Path(settings.CSV_STORAGE_PATH) / "shards"
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}"
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Shard path -> future of the worker enriching it in this process
+        self._running: Dict[Path, asyncio.Future] = {}
+        self._helper_task: Optional[asyncio.Task] = None
+        # Content hash -> lock held by the job working on it, and jobs waiting for it
+        self._content_locks: Dict[str, asyncio.Lock] = {}
+        self._content_waiters: Dict[str, int] = {}
+
+    def start(self):
+        """Remove stale work directories and, if enabled, start helping other replicas"""
+        self.cleanup()
+        if self.helper and self._helper_task is None:
+            self._helper_task = asyncio.create_task(self._help())
+            logger.info(f"Helping with shards in {self.root} using {self.workers} processes")
+
+    async def stop(self):
+        if self._helper_task is not None:
+            self._helper_task.cancel()
+            await asyncio.gather(self._helper_task, return_exceptions=True)
+            self._helper_task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def cleanup(self, older_than_hours: Optional[float] = None) -> int:
+        """Remove work directories of files nobody finished within the retention period"""
+        hours = settings.CHECKPOINT_RETENTION_HOURS if older_than_hours is None else older_than_hours
+        if not self.root.exists():
+            return 0
+        cutoff = time.time() - hours * 3600
+        removed = 0
+        for work_dir in self.root.iterdir():
+            if work_dir.stat().st_mtime >= cutoff:
+                continue
+            if work_dir.is_dir():
+                shutil.rmtree(work_dir, ignore_errors=True)
+                removed += 1
+            elif work_dir.suffix == ".lock":
+                # Claim of a job whose process died
+                work_dir.unlink(missing_ok=True)
+        if removed:
+            logger.info(f"Removed {removed} stale shard directories")
+        return removed
+
+    async def process_file(
+        self,
+        input_path: Path,
+        progress_callback: Optional[Callable[[int], None]] = None,
+        content_hash: Optional[str] = None,
+        force: bool = False,
+        priority: Optional[str] = None,
+        supplier: Optional[str] = None,
+        full_catalog: bool = False
+    ) -> Path:
+        """
+        Process a CSV file like CSVProcessor.process_file, shard by shard in worker processes
+
+        The shards of a supplier upload share one catalog run, held by this
+        process until they are merged, so the items removed from a full
+        catalog are only determined once all of them were recorded.
+
+        Raises:
+            RuntimeError: when shards still fail after SHARD_MAX_ATTEMPTS;
+                resubmitting the file only retries those shards
+        """
+        try:
+            content_hash = content_hash or await asyncio.to_thread(hash_file, input_path)
+            async with self._hold_content(content_hash), self.processor.hold_catalog(supplier):
+                return await self._process_content(
+                    input_path, content_hash, progress_callback, force, priority, supplier, full_catalog
+                )
+        except Exception as e:
+            logger.error(f"Error processing file {input_path} in shards: {str(e)}")
+            raise
+
+    @asynccontextmanager
+    async def _hold_content(self, content_hash: str) -> AsyncIterator[None]:
+        """Work on a content's shards exclusively, in this process and among replicas"""
+        lock = self._content_locks.setdefault(content_hash, asyncio.Lock())
+        self._content_waiters[content_hash] = self._content_waiters.get(content_hash, 0) + 1
+        try:
+            async with lock:
+                # <content hash>.lock next to the work directory, claimed like a shard
+                claim_path = self.root / content_hash[:32]
+                self.root.mkdir(parents=True, exist_ok=True)
+                while not self._claim(claim_path):
+                    await asyncio.sleep(POLL_INTERVAL)
+                renewer = asyncio.create_task(self._keep_claim(claim_path))
+                try:
+                    yield
+                finally:
+                    renewer.cancel()
+                    self._release(claim_path)
+        finally:
+            self._content_waiters[content_hash] -= 1
+            if not self._content_waiters[content_hash]:
+                del self._content_waiters[content_hash]
+                del self._content_locks[content_hash]
+
+    async def _keep_claim(self, path: Path):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            self._renew(path)
+
+    async def _process_content(
+        self,
+        input_path: Path,
+        content_hash: str,
+        progress_callback: Optional[Callable[[int], None]],
+        force: bool,
+        priority: Optional[str],
+        supplier: Optional[str],
+        full_catalog: bool
+    ) -> Path:
+        """process_file once the content is held: reuse, resume or split, then run and merge the shards"""
+        processor = self.processor
+        if processor.processed_files is not None and not force:
+            processed = processor.find_processed(content_hash)
+            if processed:
+                logger.info(
+                    f"{input_path.name} was already processed as {processed['input_name']}, "
+                    f"reusing {processed['output_path']}"
+                )
+                if progress_callback:
+                    progress_callback(processed["row_count"])
+                return processed["output_path"]
+
+        # Same content, same work directory: a resubmitted file resumes its shards,
+        # unless forced to start over
+        work_dir = self.root / content_hash[:32]
+        if force:
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
+        manifest = await asyncio.to_thread(self._split, input_path, work_dir, priority, supplier, force)
+        shards = manifest["shards"]
+        logger.info(
+            f"Processing {input_path.name} as {len(shards)} shards of up to "
+            f"{manifest['shard_rows']} rows in {self.workers} processes"
+        )
+
+        # A new submission gives shards that failed before their attempts back
+        for attempts_path in work_dir.glob("*.attempts"):
+            attempts_path.unlink(missing_ok=True)
+
+        while True:
+            self._collect()
+            self._start_shards(work_dir, manifest)
+            pending = [
+                shard for shard in shards
+                if not self._is_done(work_dir / shard["name"]) and not self._is_failed(work_dir / shard["name"])
+            ]
+            if progress_callback:
+                progress_callback(await asyncio.to_thread(self._progress, work_dir, manifest))
+            if not pending:
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+
+        failed = [shard["name"] for shard in shards if not self._is_done(work_dir / shard["name"])]
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} of {len(shards)} shards failed after {self.max_attempts} attempts "
+                f"({', '.join(failed)}); resubmit the file to retry only those shards"
+            )
+
+        output_path, written_rows, fallback_rows = await asyncio.to_thread(self._merge, input_path, work_dir, manifest)
+        if progress_callback:
+            progress_callback(written_rows)
+        logger.info(f"Successfully merged {len(shards)} shards into {output_path}")
+
+        if manifest.get("supplier") and full_catalog and processor.catalogs is not None:
+            await asyncio.to_thread(
+                processor.finish_catalog, manifest["supplier"], manifest["catalog_run"], output_path
+            )
+
+        # Outputs with fallback rows are enriched again when the file is resent
+        if processor.processed_files is not None and not fallback_rows:
+            processor.processed_files.record(content_hash, input_path.name, output_path, written_rows)
+
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return output_path
+
+    def _split(
+        self,
+        input_path: Path,
+        work_dir: Path,
+        priority: Optional[str],
+        supplier: Optional[str],
+        force: bool = False
+    ) -> Dict[str, Any]:
+        """Split the input into shard CSVs (header + row range) unless an earlier run already did"""
+        manifest_path = work_dir / MANIFEST_NAME
+        if manifest_path.exists():
+            logger.info(f"Resuming shards of {input_path.name} from {work_dir}")
+            return json.loads(manifest_path.read_text(encoding="utf-8"))
+
+        work_dir.mkdir(parents=True, exist_ok=True)
+        shards: List[Dict[str, Any]] = []
+        # Read by the same parser as the shards themselves (blank lines skipped,
+        # quoted descriptions spanning lines kept), so shard sizes and row numbers
+        # match what is enriched. Shards are written as UTF-8 with ',' whatever
+        # the input's dialect
+        dialect = sniff_dialect(input_path)
+        if not dialect.header:
+            raise ValueError("Empty CSV file")
+        for chunk in read_chunks(input_path, self.shard_rows, dialect):
+            if chunk.empty:
+                continue
+            name = f"shard_{len(shards):05d}.csv"
+            chunk.to_csv(work_dir / name, index=False, encoding="utf-8", lineterminator="\n")
+            shards.append({"name": name, "rows": len(chunk)})
+
+        if not shards:
+            raise ValueError("No data rows to process")
+
+        # Written last: other replicas only pick up fully split files
+        manifest = {
+            "input_name": input_path.name,
+            "priority": priority,
+            "supplier": supplier,
+            # Kept across resubmissions: shards finished before still count as seen
+            "catalog_run": CSVProcessor.new_catalog_run(),
+            # Shards of a forced run ignore rows journaled by earlier runs of the same shard content
+            "force": force,
+            "shard_rows": self.shard_rows,
+            "rows": sum(shard["rows"] for shard in shards),
+            "shards": shards,
+        }
+        _write_json(manifest_path, manifest)
+        return manifest
+
+    def _merge(self, input_path: Path, work_dir: Path, manifest: Dict[str, Any]) -> Tuple[Path, int, int]:
+        """Concatenate the shard outputs and reports in input order; returns the output, its rows and fallback rows"""
+        output_path = input_path.parent / f"enriched_{input_path.name}"
+        partial_path = output_path.with_name(f"{output_path.name}.part")
+        report_path = self.processor.report_path(output_path)
+        partial_report_path = report_path.with_name(f"{report_path.name}.part")
+        written_rows = 0
+        fallback_rows = 0
+
+        with open(partial_path, "wb") as output_file, \
+                open(partial_report_path, "w", encoding="utf-8", newline="") as report_file:
+            report_writer = csv.writer(report_file, delimiter=';', lineterminator='\n')
+            report_writer.writerow(REPORT_COLUMNS)
+
+            for index, shard in enumerate(manifest["shards"]):
+                shard_output = work_dir / f"enriched_{shard['name']}"
+                with open(shard_output, "rb") as shard_file:
+                    header = shard_file.readline()
+                    if index == 0:
+                        output_file.write(header)
+                    shutil.copyfileobj(shard_file, output_file)
+
+                # Report rows are renumbered to their place in the whole file
+                shard_rows = 0
+                with open(self.processor.report_path(shard_output), "r", encoding="utf-8", newline="") as shard_report:
+                    reader = csv.reader(shard_report, delimiter=';')
+                    next(reader, None)
+                    for row in reader:
+                        shard_rows += 1
+                        fallback_rows += row[2] == "fallback"
+                        report_writer.writerow([written_rows + shard_rows] + row[1:])
+                written_rows += shard_rows
+
+        partial_path.replace(output_path)
+        partial_report_path.replace(report_path)
+        return output_path, written_rows, fallback_rows
+
+    def _progress(self, work_dir: Path, manifest: Dict[str, Any]) -> int:
+        """Rows written so far: finished shards plus the partial outputs of running ones"""
+        rows = 0
+        for shard in manifest["shards"]:
+            path = work_dir / shard["name"]
+            if self._is_done(path):
+                rows += shard["rows"]
+                continue
+            partial_path = work_dir / f"enriched_{shard['name']}.part"
+            try:
+                with open(partial_path, "rb") as partial_file:
+                    lines = sum(block.count(b"\n") for block in iter(lambda: partial_file.read(1 << 20), b""))
+            except FileNotFoundError:
+                continue
+            rows += min(shard["rows"], max(0, lines - 1))
+        return rows
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking would copy the API's event loop, threads and open connections
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(llm_share(self.workers),)
+            )
+        return self._executor
+
+    def _reset_pool(self):
+        """Drop a pool whose worker process died; the next shard starts a new one"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _start_shards(self, work_dir: Path, manifest: Dict[str, Any]):
+        """Claim pending shards of a work directory for the free worker processes"""
+        loop = asyncio.get_running_loop()
+        for shard in manifest["shards"]:
+            if len(self._running) >= self.workers:
+                return
+            path = work_dir / shard["name"]
+            if path in self._running or self._is_done(path) or self._is_failed(path):
+                continue
+            if not self._claim(path):
+                continue
+            try:
+                self._running[path] = loop.run_in_executor(
+                    self._pool(), _process_shard, str(path), manifest.get("priority"),
+                    manifest.get("supplier"), manifest.get("catalog_run"), manifest.get("force", False)
+                )
+            except BrokenProcessPool:
+                self._reset_pool()
+                self._release(path)
+                return
+            except Exception:
+                self._release(path)
+                raise
+            logger.info(f"Started {path.parent.name}/{path.name} ({shard['rows']} rows)")
+
+    def _collect(self):
+        """Renew the claims of running shards and record the outcome of finished ones"""
+        for path, future in list(self._running.items()):
+            if not future.done():
+                self._renew(path)
+                continue
+            del self._running[path]
+            try:
+                future.result()
+                logger.info(f"Finished {path.parent.name}/{path.name}")
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._reset_pool()
+                attempts = self._record_failure(path, e)
+                log = logger.error if attempts >= self.max_attempts else logger.warning
+                log(f"Shard {path.parent.name}/{path.name} failed (attempt {attempts}/{self.max_attempts}): {str(e)}")
+            finally:
+                self._release(path)
+
+    async def _help(self):
+        """Work on the shards of files submitted to any replica sharing CSV_STORAGE_PATH"""
+        while True:
+            try:
+                self._collect()
+                for manifest_path in sorted(self.root.glob(f"*/{MANIFEST_NAME}")):
+                    if len(self._running) >= self.workers:
+                        break
+                    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+                    self._start_shards(manifest_path.parent, manifest)
+            except Exception as e:
+                # Work directories disappear once their owner merged them
+                logger.debug(f"Shard helper pass skipped: {str(e)}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def _is_done(self, path: Path) -> bool:
+        return path.with_suffix(".done").exists()
+
+    def _is_failed(self, path: Path) -> bool:
+        return path not in self._running and self._attempts(path) >= self.max_attempts
+
+    def _attempts(self, path: Path) -> int:
+        try:
+            return json.loads(path.with_suffix(".attempts").read_text(encoding="utf-8"))["attempts"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    def _record_failure(self, path: Path, error: Exception) -> int:
+        attempts = self._attempts(path) + 1
+        _write_json(path.with_suffix(".attempts"), {"attempts": attempts, "error": str(error)})
+        return attempts
+
+    def _claim(self, path: Path) -> bool:
+        """Take a shard unless another live process is enriching it"""
+        lock_path = path.with_suffix(".lock")
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._is_stale(path, lock_path):
+                return False
+            # Its process died: take the shard over (at worst two processes
+            # race for it and both enrich it; outputs are replaced atomically)
+            lock_path.unlink(missing_ok=True)
+            try:
+                lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(lock, "w") as lock_file:
+            lock_file.write(self.owner)
+        return True
+
+    def _is_stale(self, path: Path, lock_path: Path) -> bool:
+        """Whether a claim was left by a process that is gone"""
+        try:
+            age = time.time() - lock_path.stat().st_mtime
+            owner = lock_path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return True
+        if age > self.lease_seconds:
+            return True
+
+        host, _, pid = owner.partition(":")
+        if host != self.host or not pid.isdigit():
+            # Another replica: only the lease tells
+            return False
+        if int(pid) == os.getpid():
+            return path not in self._running
+        return not _pid_alive(int(pid))
+
+    def _renew(self, path: Path):
+        try:
+            os.utime(path.with_suffix(".lock"))
+        except FileNotFoundError:
+            pass
+
+    def _release(self, path: Path):
+        path.with_suffix(".lock").unlink(missing_ok=True)
@@ -0,0 +1,197 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+from app.services.enrichment_cache import EnrichmentCache
+from app.services.rule_engine import AMBIGUOUS_KEYWORDS
+
+# Character n-gram size
+NGRAM_SIZE = 3
+
+# n-grams found in more than this fraction of the parts (e.g. " PE") only
+# rank candidates that rarer n-grams already found, once the query's
+# MIN_CANDIDATE_NGRAMS rarest n-grams were looked up
+COMMON_NGRAM_FRACTION = 0.05
+COMMON_NGRAM_MIN_PARTS = 50
+MIN_CANDIDATE_NGRAMS = 5
+
+# Candidates from the rare n-grams that get an exact cosine score
+CANDIDATES = 20
+
+# Re-weight stored vectors once the index grew by this factor since the last pass
+REWEIGHT_GROWTH = 2.0
+
+# Leading characters of a part reference that name its family (Honda 95014-73100 -> 95014)
+REFERENCE_FAMILY_CHARS = 5
+
+PUNCTUATION = re.compile(r"[^A-Z0-9/ ]+")
+REFERENCE_NOISE = re.compile(r"[^A-Z0-9]+")
+
+
+class SimilarPart:
+    """One indexed part: its normalized description, head word, reference family, AI fields and TF-IDF vector"""
+
+    __slots__ = ("text", "head", "family", "fields", "counts", "vector")
+
+    def __init__(self, text: str, family: str, fields: Dict[str, Any], counts: Counter):
+        self.text = text
+        self.head = text.split(" ", 1)[0]
+        self.family = family
+        self.fields = fields
+        self.counts = counts
+        self.vector: Dict[str, float] = {}
+
+
+class SimilarityIndex:
+    """
+    In-memory character n-gram TF-IDF index of enriched parts
+
+    Parts are added one at a time as they are enriched. Stored vectors keep
+    the IDF of when they were weighted and are re-weighted whenever the
+    index doubled in size; queries always use the current IDF. Beyond
+    max_entries the least recently added parts are dropped.
+
+    Thread-safe, so lookups can run off the event loop while parts are added.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._parts: "OrderedDict[str, SimilarPart]" = OrderedDict()
+        # n-gram -> part text -> weight of the n-gram in the part's vector
+        self._postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._weighted_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._parts)
+
+    @staticmethod
+    def normalize(descricao: str) -> str:
+        """Description without accents, punctuation or a leading part reference"""
+        tokens = PUNCTUATION.sub(" ", EnrichmentCache.normalize(descricao)).split()
+        if len(tokens) > 1 and any(char.isdigit() for char in tokens[0]):
+            tokens = tokens[1:]
+        return " ".join(tokens)
+
+    @staticmethod
+    def reference_family(referencia: str) -> str:
+        """Family prefix of a part reference, empty when the reference is too short to tell"""
+        reference = REFERENCE_NOISE.sub("", EnrichmentCache.normalize(referencia))
+        return reference[:REFERENCE_FAMILY_CHARS] if len(reference) > REFERENCE_FAMILY_CHARS else ""
+
+    @staticmethod
+    def _ngrams(text: str) -> Counter:
+        padded = f" {text} "
+        return Counter(padded[start:start + NGRAM_SIZE] for start in range(len(padded) - NGRAM_SIZE + 1))
+
+    def _idf(self, ngram: str) -> float:
+        df = len(self._postings.get(ngram, ()))
+        return math.log((1 + len(self._parts)) / (1 + df)) + 1
+
+    def _vector(self, counts: Counter) -> Dict[str, float]:
+        """L2-normalized sublinear TF-IDF vector"""
+        vector = {ngram: (1 + math.log(count)) * self._idf(ngram) for ngram, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        if not norm:
+            return {}
+        return {ngram: weight / norm for ngram, weight in vector.items()}
+
+    def add(self, descricao: str, fields: Dict[str, Any], referencia: str = ""):
+        """Index an enriched part; a description already indexed takes the new fields"""
+        text = self.normalize(descricao)
+        if not text:
+            return
+
+        with self._lock:
+            self._remove(text)
+            part = SimilarPart(text, self.reference_family(referencia), fields, self._ngrams(text))
+            self._parts[text] = part
+            for ngram in part.counts:
+                self._postings[ngram][text] = 0.0
+            self._weigh(part)
+
+            while self.max_entries > 0 and len(self._parts) > self.max_entries:
+                self._remove(next(iter(self._parts)))
+
+            if len(self._parts) >= max(2 * COMMON_NGRAM_MIN_PARTS, self._weighted_size * REWEIGHT_GROWTH):
+                self._reweight()
+
+    def _weigh(self, part: SimilarPart):
+        part.vector = self._vector(part.counts)
+        for ngram, weight in part.vector.items():
+            self._postings[ngram][part.text] = weight
+
+    def _reweight(self):
+        """Bring every stored vector to the current IDF"""
+        for part in self._parts.values():
+            self._weigh(part)
+        self._weighted_size = len(self._parts)
+
+    def _remove(self, text: str):
+        part = self._parts.pop(text, None)
+        if part is None:
+            return
+        for ngram in part.counts:
+            posting = self._postings.get(ngram)
+            if posting is None:
+                continue
+            posting.pop(text, None)
+            if not posting:
+                del self._postings[ngram]
+
+    def nearest(self, descricao: str, limit: int, min_score: float = 0.0) -> List[Tuple[float, SimilarPart]]:
+        """Most similar indexed parts by cosine similarity, best first"""
+        text = self.normalize(descricao)
+        if not text or limit <= 0:
+            return []
+        with self._lock:
+            return self._nearest(text, limit, min_score)
+
+    def _nearest(self, text: str, limit: int, min_score: float) -> List[Tuple[float, SimilarPart]]:
+        if not self._parts:
+            return []
+
+        query = self._vector(self._ngrams(text))
+        common = max(COMMON_NGRAM_MIN_PARTS, int(COMMON_NGRAM_FRACTION * len(self._parts)))
+
+        postings = sorted(
+            ((ngram, self._postings[ngram]) for ngram in query if ngram in self._postings),
+            key=lambda item: len(item[1])
+        )
+        partial: Dict[str, float] = defaultdict(float)
+        for looked_up, (ngram, posting) in enumerate(postings):
+            if looked_up >= MIN_CANDIDATE_NGRAMS and len(posting) > common:
+                break
+            weight = query[ngram]
+            for candidate, candidate_weight in posting.items():
+                partial[candidate] += weight * candidate_weight
+
+        scored = []
+        for candidate in heapq.nlargest(max(CANDIDATES, limit), partial, key=partial.get):
+            part = self._parts[candidate]
+            score = sum(weight * part.vector.get(ngram, 0.0) for ngram, weight in query.items())
+            if score >= min_score:
+                scored.append((min(score, 1.0), part))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored[:limit]
+
+    def reusable(self, descricao: str, referencia: str, min_score: float) -> Optional[Tuple[float, SimilarPart]]:
+        """
+        The most similar part whose AI fields can stand for this one, or None
+
+        Descriptions name the part with their first word (TAMPA TANQUE is not
+        a TANQUE), so the match must share it and the reference family, and
+        kits or sets, whose contents vary with the model, are never reused.
+        """
+        text = self.normalize(descricao)
+        family = self.reference_family(referencia)
+        if not text or not family or text.split(" ", 1)[0] in AMBIGUOUS_KEYWORDS:
+            return None
+
+        for score, part in self.nearest(descricao, CANDIDATES, min_score):
+            if part.head == text.split(" ", 1)[0] and part.family == family:
+                return score, part
+        return None
@@ -0,0 +1,196 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from loguru import logger
+from app.services.enrichment_cache import EnrichmentCache
+
+# Output column -> product field patched into a stored row when only stock or prices changed
+PATCH_COLUMNS = {
+    "Quantidade (Padrão)": "quantidade",
+    "EAN": "ean",
+    "Preço (Padrão (BRL))": "preco_venda",
+    "Preço de Compra": "preco_custo",
+    "Custo (médio)": "preco_custo",
+}
+
+# Keys per SELECT ... IN, below SQLite's bound parameter limit
+LOOKUP_BATCH = 500
+
+
+class SupplierCatalog:
+    """
+    SQLite store of each supplier's last processed catalog, keyed by SKU and reference
+
+    Every row of an upload is recorded with the run that saw it and its
+    enriched output row. Items of the supplier that the finished run did
+    not see were removed from the catalog.
+    """
+
+    def __init__(self, db_path: Path, prompt_version: str):
+        self.db_path = Path(db_path)
+        self.prompt_version = prompt_version
+        self._lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Shard worker processes write to the same database
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS catalog_items (
+                supplier TEXT NOT NULL,
+                item_key TEXT NOT NULL,
+                part_key TEXT NOT NULL,
+                sku TEXT NOT NULL,
+                referencia TEXT NOT NULL,
+                descricao TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                data TEXT,
+                run_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (supplier, item_key)
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_catalog_items_run ON catalog_items (supplier, run_id)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def normalize_supplier(supplier: str) -> str:
+        return str(supplier or "").strip().lower()
+
+    @staticmethod
+    def item_key(product: Dict[str, str]) -> str:
+        """Identity of a catalog item: normalized SKU and reference"""
+        return "|".join(
+            EnrichmentCache.normalize(str(product.get(field) or "").strip())
+            for field in ("sku", "referencia")
+        )
+
+    def lookup(self, supplier: str, item_keys: Iterable[str]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+        """
+        Stored items of a supplier among the given keys
+
+        Returns:
+            item key -> (part key, enriched output row) for items enriched
+            under the current prompt version
+        """
+        supplier = self.normalize_supplier(supplier)
+        keys = list(dict.fromkeys(item_keys))
+        found = {}
+
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start:start + LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT item_key, part_key, data FROM catalog_items "
+                    f"WHERE supplier = ? AND prompt_version = ? AND data IS NOT NULL "
+                    f"AND item_key IN ({', '.join('?' * len(batch))})",
+                    (supplier, self.prompt_version, *batch)
+                ).fetchall()
+                for item_key, part_key, data in rows:
+                    found[item_key] = (part_key, json.loads(data))
+
+        return found
+
+    def record(self, supplier: str, run_id: str, items: List[Tuple[Dict[str, str], str, Optional[Dict[str, Any]]]]):
+        """
+        Store the rows of an upload as the supplier's current items
+
+        Args:
+            items: (product, part key, enriched output row) per row; rows
+                without output (fallbacks) are kept as seen but enriched
+                again on the next upload
+        """
+        supplier = self.normalize_supplier(supplier)
+        now = time.time()
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO catalog_items "
+                "(supplier, item_key, part_key, sku, referencia, descricao, prompt_version, data, run_id, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        supplier,
+                        self.item_key(product),
+                        part_key,
+                        product.get("sku", ""),
+                        product.get("referencia", ""),
+                        product.get("descricao", ""),
+                        self.prompt_version,
+                        json.dumps(data, ensure_ascii=False) if data is not None else None,
+                        run_id,
+                        now
+                    )
+                    for product, part_key, data in items
+                ]
+            )
+            self._conn.commit()
+
+    def finish(self, supplier: str, run_id: str) -> List[Dict[str, str]]:
+        """
+        Close a completed upload: drop and return the items it no longer lists
+
+        Returns:
+            SKU, reference and description of each removed item
+        """
+        supplier = self.normalize_supplier(supplier)
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sku, referencia, descricao FROM catalog_items "
+                "WHERE supplier = ? AND run_id != ? ORDER BY sku, referencia",
+                (supplier, run_id)
+            ).fetchall()
+            self._conn.execute(
+                "DELETE FROM catalog_items WHERE supplier = ? AND run_id != ?", (supplier, run_id)
+            )
+            self._conn.commit()
+
+        return [{"sku": sku, "referencia": referencia, "descricao": descricao} for sku, referencia, descricao in rows]
+
+    def remove(self, supplier: Optional[str] = None) -> int:
+        """Forget one supplier's catalog (or all of them) so its next upload is enriched in full"""
+        with self._lock:
+            if supplier is None:
+                cursor = self._conn.execute("DELETE FROM catalog_items")
+            else:
+                cursor = self._conn.execute(
+                    "DELETE FROM catalog_items WHERE supplier = ?", (self.normalize_supplier(supplier),)
+                )
+            self._conn.commit()
+            removed = cursor.rowcount
+
+        logger.info(f"Removed {removed} supplier catalog items")
+        return removed
+
+    def list_suppliers(self) -> List[Dict[str, Any]]:
+        """Stored catalogs: item count and time of the last upload per supplier"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT supplier, COUNT(*), MAX(updated_at) FROM catalog_items "
+                "GROUP BY supplier ORDER BY MAX(updated_at) DESC"
+            ).fetchall()
+
+        return [
+            {"supplier": supplier, "items": items, "updated_at": updated_at}
+            for supplier, items, updated_at in rows
+        ]
+
+
+def patch_row(data: Dict[str, Any], product: Dict[str, str]) -> Tuple[Dict[str, Any], bool]:
+    """
+    A stored output row with the stock, EAN and prices of a new upload
+
+    Returns:
+        (patched row, whether any column changed)
+    """
+    patched = dict(data)
+    for column, field in PATCH_COLUMNS.items():
+        patched[column] = product.get(field, "")
+    changed = any(str(data.get(column, "")) != patched[column] for column in PATCH_COLUMNS)
+    return patched, changed
@@ -0,0 +1,125 @@
+import hashlib
+from pathlib import Path
+from typing import Optional, Tuple
+import aiofiles
+from fastapi import UploadFile
+from loguru import logger
+
+# Bytes read from an upload (or a file being hashed) at a time
+CHUNK_SIZE = 1024 * 1024
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# Multipart boundaries and part headers around the file in a request body
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class FileTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured size limit"""
+
+
+class ContentHasher:
+    """
+    Incremental SHA-256 over normalized CSV bytes
+
+    A leading UTF-8 BOM is ignored and CRLF line endings count as LF, so the
+    same catalog saved by different tools hashes the same.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._head = b""
+        self._bom_checked = False
+        self._pending_cr = False
+
+    def update(self, data: bytes):
+        if not self._bom_checked:
+            # Hold bytes back until there are enough to recognize a BOM
+            self._head += data
+            if len(self._head) < len(UTF8_BOM):
+                return
+            data = self._head[len(UTF8_BOM):] if self._head.startswith(UTF8_BOM) else self._head
+            self._head = b""
+            self._bom_checked = True
+
+        if self._pending_cr:
+            data = b"\r" + data
+            self._pending_cr = False
+        if data.endswith(b"\r"):
+            # A CR at the chunk boundary may be the first half of a CRLF
+            data = data[:-1]
+            self._pending_cr = True
+
+        self._digest.update(data.replace(b"\r\n", b"\n"))
+
+    def hexdigest(self) -> str:
+        digest = self._digest.copy()
+        tail = self._head + (b"\r" if self._pending_cr else b"")
+        digest.update(tail.replace(b"\r\n", b"\n"))
+        return digest.hexdigest()
+
+
+def exceeds_upload_limit(content_length: Optional[str], max_bytes: int) -> bool:
+    """Whether a request's declared Content-Length is over the upload limit plus multipart overhead"""
+    if not max_bytes or not content_length or not content_length.isdigit():
+        return False
+    return int(content_length) > max_bytes + MULTIPART_OVERHEAD
+
+
+def hash_file(path: Path) -> str:
+    """Normalized content hash of a file on disk, read in fixed-size chunks"""
+    hasher = ContentHasher()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+async def save_upload(file: UploadFile, destination: Path, max_bytes: int) -> Tuple[int, str]:
+    """
+    Stream an upload to disk in fixed-size chunks
+
+    The upload is written to `<destination>.part` and renamed once complete,
+    so a rejected or failed upload never leaves a partial file at destination.
+
+    Args:
+        file: Uploaded file
+        destination: Path the upload is written to
+        max_bytes: Size limit; 0 disables it
+
+    Returns:
+        Tuple of (size in bytes, normalized content hash)
+
+    Raises:
+        FileTooLargeError: as soon as the upload goes over max_bytes; the
+            partially written file is removed
+    """
+    hasher = ContentHasher()
+    size = 0
+    partial_path = destination.with_name(f"{destination.name}.part")
+
+    try:
+        async with aiofiles.open(partial_path, "wb") as buffer:
+            while True:
+                block = await file.read(CHUNK_SIZE)
+                if not block:
+                    break
+
+                size += len(block)
+                if max_bytes and size > max_bytes:
+                    raise FileTooLargeError(
+                        f"File exceeds the maximum size of {max_bytes // (1024 * 1024)} MB"
+                    )
+
+                hasher.update(block)
+                await buffer.write(block)
+    except FileTooLargeError:
+        partial_path.unlink(missing_ok=True)
+        logger.warning(f"Rejected upload {file.filename}: larger than {max_bytes} bytes")
+        raise
+    except Exception:
+        partial_path.unlink(missing_ok=True)
+        raise
+
+    partial_path.replace(destination)
+    return size, hasher.hexdigest()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline do pipeline de enriquecimento
+
+Gera catálogos Honda sintéticos, sobe o scripts/fake_llm_server.py e roda o
+CSVProcessor.process_file contra ele (sem chamar a OpenAI). Cada tamanho roda
+num processo separado para medir o pico de memória isoladamente.
+
+Métricas por tamanho: linhas/s, MB/s de entrada, latência por linha
+p50/p95/p99 (do início do chunk até a linha ser gravada), pico de RSS, taxa de
+fallback, chamadas ao LLM, tempo gasto no índice de similaridade e o maior
+atraso do event loop (lookups síncronos travam streams, /jobs e /metrics). Com --ingest-only mede só a leitura do CSV
+(detecção de encoding/separador, parser e prepare_products), sem servidor.
+
+Uso:
+    python scripts/benchmark.py --rows 1000 10000 100000 --no-rate-limit
+    python scripts/benchmark.py --rows 10000 --rate-429 0.05 --malformed-rate 0.02 --output bench.json
+    python scripts/benchmark.py --rows 10000 --baseline bench.json  # falha se linhas/s cair mais de 10%
+    python scripts/benchmark.py --rows 1000000 --ingest-only --engine pandas --encoding latin-1 --delimiter ";"
+
+As demais configurações (AI_BATCH_SIZE, AI_MAX_CONCURRENT_REQUESTS, ...) vêm do
+ambiente/.env, como na aplicação.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Part names used for synthetic descriptions; the first ones hit the rule engine
+PART_NAMES = [
+    "PARAFUSO FLANGE 6X12", "PORCA SEXTAVADA 8MM", "ARRUELA PLANA 10MM", "REBITE 4X8",
+    "ESPELHO RETROVISOR ESQ", "ENGRENAGEM PARTIDA", "VALVULA ADMISSAO",
+    "MOLA VARETA FREIO", "CABO EMBREAGEM", "PASTILHA FREIO DIANT", "JUNTA CABECOTE",
+    "RETENTOR BENGALA", "KIT RELACAO", "FILTRO AR", "VELA IGNICAO", "LAMPADA FAROL 12V",
+    "PARA-LAMA TRASEIRO", "MANETE FREIO", "PEDAL CAMBIO", "TAMPA TANQUE", "BOBINA IGNICAO",
+    "ROLAMENTO RODA 6301", "CORRENTE COMANDO", "TENSOR CORRENTE", "DIAFRAGMA CARBURADOR",
+]
+MODELS = ["CG 160", "BIZ 125", "CB 300", "XRE 300", "POP 110", "NXR 160", "PCX 150", ""]
+
+INPUT_HEADER = ["Referencia", "Descricao", "Quantidade Estoque", "Preço de Venda", "Preço de Custo", "SKU", "EAN"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline enrichment benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="Catalog sizes (1k-1M)")
+    parser.add_argument("--unique-ratio", type=float, default=0.8, help="Distinct parts / rows in a catalog")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", type=Path, default=None, help="Keep catalogs and outputs here")
+    parser.add_argument("--port", type=int, default=0, help="Fake server port (0 picks a free one)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Disable AI_REQUESTS/TOKENS_PER_MINUTE")
+    parser.add_argument("--cache", action="store_true", help="Keep the enrichment cache enabled")
+    parser.add_argument("--output", type=Path, default=None, help="Write results as JSON")
+    parser.add_argument("--baseline", type=Path, default=None, help="Results JSON to compare rows/s against")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Allowed rows/s drop vs baseline")
+    parser.add_argument("--encoding", default="utf-8", help="Encoding of the generated catalogs (e.g. latin-1, utf-8-sig)")
+    parser.add_argument("--delimiter", default=",", help="Separator of the generated catalogs")
+    parser.add_argument("--engine", choices=["auto", "pyarrow", "pandas"], default=None, help="CSV_ENGINE for the runs")
+    parser.add_argument("--ingest-only", action="store_true", help="Only time reading and preparing the catalogs")
+
+    # Forwarded to scripts/fake_llm_server.py
+    parser.add_argument("--latency-ms", type=float, default=400.0)
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--ms-per-token", type=float, default=2.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+
+    # Internal: run one catalog in this process and print the result as JSON
+    parser.add_argument("--worker", type=Path, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-ingest", type=Path, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def brl(value: float) -> str:
+    """Format a price the way supplier catalogs do, e.g. R$ 1.827,11"""
+    text = f"{value:,.2f}"
+    return "R$ " + text.replace(",", "_").replace(".", ",").replace("_", ".")
+
+
+def write_catalog(path: Path, rows: int, unique_ratio: float, seed: int, encoding: str = "utf-8", delimiter: str = ","):
+    """Write a synthetic supplier catalog with the input CSV layout"""
+    rng = random.Random(seed)
+    unique_parts = max(1, int(rows * unique_ratio))
+    alphabet = "0123456789ABCDEFGHJKLMNPRSTUVWXYZ"
+
+    with open(path, "w", encoding=encoding, newline="") as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(INPUT_HEADER)
+        for index in range(rows):
+            part = rng.randrange(unique_parts) if index >= unique_parts else index
+            part_rng = random.Random(seed * 1_000_003 + part)
+            referencia = "".join(part_rng.choice(alphabet) for _ in range(part_rng.choice((10, 11))))
+            descricao = f"{referencia} {part_rng.choice(PART_NAMES)} {part_rng.choice(MODELS)}".strip()
+            custo = part_rng.uniform(1, 1500)
+            writer.writerow([
+                referencia,
+                descricao,
+                rng.randint(0, 50),
+                brl(custo * 1.5),
+                brl(custo),
+                f"SYN{index:07d}",
+                f"789{rng.randrange(10 ** 10):010d}",
+            ])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    """Start the fake LLM server and wait until it answers"""
+    command = [
+        sys.executable, str(ROOT / "scripts" / "fake_llm_server.py"),
+        "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+        "--latency-dist", args.latency_dist,
+        "--latency-sigma", str(args.latency_sigma),
+        "--ms-per-token", str(args.ms_per_token),
+        "--rate-429", str(args.rate_429),
+        "--malformed-rate", str(args.malformed_rate),
+        "--seed", str(args.seed),
+    ]
+    server = subprocess.Popen(command)
+
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError("Fake LLM server did not start")
+
+
+def percentile(values, q: float) -> float:
+    import numpy as np
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+def input_mb(input_path: Path) -> float:
+    return input_path.stat().st_size / (1024 * 1024)
+
+
+def run_ingest_worker(input_path: Path) -> dict:
+    """Read and prepare one catalog the way CSVProcessor does, without enriching it"""
+    from app.core.config import settings
+    from app.services.ingestion import read_chunks, sniff_dialect, use_arrow
+    from app.services.preprocessing import prepare_products
+
+    started = time.perf_counter()
+    dialect = sniff_dialect(input_path)
+    total_rows = 0
+    for chunk in read_chunks(input_path, settings.CSV_CHUNK_SIZE, dialect):
+        total_rows += len(prepare_products(chunk))
+    elapsed = time.perf_counter() - started
+
+    size_mb = input_mb(input_path)
+    return {
+        "rows": total_rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(total_rows / elapsed, 1) if elapsed else 0.0,
+        "input_mb": round(size_mb, 2),
+        "mb_per_second": round(size_mb / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "engine": "pyarrow" if use_arrow() else "pandas",
+        "encoding": dialect.encoding,
+        "delimiter": dialect.delimiter,
+    }
+
+
+def run_worker(input_path: Path) -> dict:
+    """Process one catalog with CSVProcessor and measure it (runs in its own process)"""
+    from loguru import logger
+    import app.services.csv_processor as csv_processor_module
+    from app.services.csv_processor import CSVProcessor
+    from app.services.metrics import SIMILARITY_LOOKUP_SECONDS
+
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    # Keep each run's path counters
+    runs = []
+
+    class RecordingFileRun(csv_processor_module.FileRun):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            runs.append(self)
+
+    csv_processor_module.FileRun = RecordingFileRun
+
+    processor = CSVProcessor()
+    latencies = []
+
+    # Per-row latency: from the moment its chunk starts enriching until the row is written
+    start_chunk = processor._start_chunk
+    iter_chunk_rows = processor._iter_chunk_rows
+
+    async def timed_start_chunk(products, first_row, run):
+        work = await start_chunk(products, first_row, run)
+        work.started_at = time.perf_counter()
+        return work
+
+    async def timed_iter_chunk_rows(work, run):
+        async for enriched_data in iter_chunk_rows(work, run):
+            latencies.append(time.perf_counter() - work.started_at)
+            yield enriched_data
+
+    processor._start_chunk = timed_start_chunk
+    processor._iter_chunk_rows = timed_iter_chunk_rows
+
+    # Event loop lag: how late a 10 ms sleep wakes up while the file is processed
+    lags = []
+
+    async def watch_loop():
+        while True:
+            slept = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - slept - 0.01)
+
+    async def process():
+        watcher = asyncio.create_task(watch_loop())
+        try:
+            return await processor.process_file(input_path)
+        finally:
+            watcher.cancel()
+
+    started = time.perf_counter()
+    output_path = asyncio.run(process())
+    elapsed = time.perf_counter() - started
+    similarity_seconds = sum(
+        sample.value for family in SIMILARITY_LOOKUP_SECONDS.collect()
+        for sample in family.samples if sample.name.endswith("_sum")
+    )
+
+    path_counts = runs[-1].path_counts if runs else {}
+    total_rows = len(latencies)
+    size_mb = input_mb(input_path)
+    return {
+        "rows": total_rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(total_rows / elapsed, 1) if elapsed else 0.0,
+        "input_mb": round(size_mb, 2),
+        "mb_per_second": round(size_mb / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "similarity_seconds": round(similarity_seconds, 3),
+        "loop_lag_max_ms": round(max(lags, default=0.0) * 1000, 1),
+        "fallback_rate": round(path_counts.get("fallback", 0) / total_rows, 4) if total_rows else 0.0,
+        "path_counts": path_counts,
+        "output": str(output_path),
+    }
+
+
+def print_table(results):
+    header = (
+        f"{'rows':>9} {'rows/s':>9} {'MB/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'RSS MB':>8} {'fallback':>9} {'LLM calls':>10} {'sim s':>7} {'lag ms':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['rows']:>9} {result['rows_per_second']:>9} {result['mb_per_second']:>7} "
+            f"{result['latency_p50_ms']:>9} {result['latency_p95_ms']:>9} {result['latency_p99_ms']:>9} "
+            f"{result['peak_rss_mb']:>8} {result['fallback_rate']:>9.2%} {result['llm_calls']:>10} "
+            f"{result['similarity_seconds']:>7} {result['loop_lag_max_ms']:>7}"
+        )
+
+
+def print_ingest_table(results):
+    header = f"{'rows':>9} {'MB':>8} {'seconds':>8} {'rows/s':>10} {'MB/s':>7} {'RSS MB':>8} {'engine':>8} {'encoding':>10}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['rows']:>9} {result['input_mb']:>8} {result['seconds']:>8} {result['rows_per_second']:>10} "
+            f"{result['mb_per_second']:>7} {result['peak_rss_mb']:>8} {result['engine']:>8} {result['encoding']:>10}"
+        )
+
+
+def check_baseline(results, baseline_path: Path, max_regression: float) -> bool:
+    """Compare rows/s per catalog size with an earlier results file"""
+    baseline = {result["rows"]: result for result in json.loads(baseline_path.read_text())["results"]}
+    ok = True
+    for result in results:
+        previous = baseline.get(result["rows"])
+        if not previous or not previous["rows_per_second"]:
+            continue
+        change = result["rows_per_second"] / previous["rows_per_second"] - 1
+        status = "OK" if change >= -max_regression else "REGRESSION"
+        ok = ok and status == "OK"
+        print(f"{result['rows']:>9} rows: {previous['rows_per_second']} -> {result['rows_per_second']} rows/s ({change:+.1%}) {status}")
+    return ok
+
+
+def main():
+    args = parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker)))
+        return
+    if args.worker_ingest:
+        print(json.dumps(run_ingest_worker(args.worker_ingest)))
+        return
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="csv-benchmark-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    port = args.port or free_port()
+
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "CSV_STORAGE_PATH": str(workdir),
+        "DEDUP_ENABLED": "false",
+        "PYTHONPATH": str(ROOT),
+    }
+    if not args.cache:
+        env["CACHE_ENABLED"] = "false"
+    if args.no_rate_limit:
+        env["AI_REQUESTS_PER_MINUTE"] = "0"
+        env["AI_TOKENS_PER_MINUTE"] = "0"
+    if args.engine:
+        env["CSV_ENGINE"] = args.engine
+
+    server = None if args.ingest_only else start_fake_server(args, port)
+    results = []
+    try:
+        for rows in args.rows:
+            input_path = workdir / f"catalog_{rows}.csv"
+            print(f"Generating {rows} rows -> {input_path}", file=sys.stderr)
+            write_catalog(input_path, rows, args.unique_ratio, args.seed, args.encoding, args.delimiter)
+
+            if args.ingest_only:
+                worker = subprocess.run(
+                    [sys.executable, __file__, "--worker-ingest", str(input_path)],
+                    env=env, cwd=str(ROOT), stdout=subprocess.PIPE, check=True
+                )
+                results.append(json.loads(worker.stdout.decode().strip().splitlines()[-1]))
+                continue
+
+            calls_before = httpx.get(f"http://127.0.0.1:{port}/stats").json()["calls"]
+            worker = subprocess.run(
+                [sys.executable, __file__, "--worker", str(input_path)],
+                env=env, cwd=str(ROOT), stdout=subprocess.PIPE, check=True
+            )
+            result = json.loads(worker.stdout.decode().strip().splitlines()[-1])
+            result["llm_calls"] = httpx.get(f"http://127.0.0.1:{port}/stats").json()["calls"] - calls_before
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.ingest_only:
+        print_ingest_table(results)
+    else:
+        print_table(results)
+
+    if args.output:
+        args.output.write_text(json.dumps({"args": {k: str(v) for k, v in vars(args).items()}, "results": results}, indent=2))
+        print(f"Results written to {args.output}")
+
+    if args.baseline and not check_baseline(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
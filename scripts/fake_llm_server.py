@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Servidor local compatível com a API de chat da OpenAI, para benchmarks sem custo
+
+Responde a POST /v1/chat/completions com JSON no formato que o
+AIProductEnrichmentAgent espera (prompt simples ou em lote), com latência,
+taxa de 429 e taxa de respostas malformadas configuráveis.
+
+Uso:
+    python scripts/fake_llm_server.py --port 8199 --latency-ms 400 --rate-429 0.02 --malformed-rate 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8199/v1 OPENAI_API_KEY=fake python -m app.main
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Same rough ratio the agent uses for budgeting
+CHARS_PER_TOKEN = 4
+
+# Keys of the JSON structure requested in the prompt ("estrutura exata")
+RESPONSE_KEY = re.compile(r'"(\w+)"\s*:\s*"')
+BATCH_PRODUCTS = re.compile(r"\[\n(\{.*?\})\n\]", re.DOTALL)
+SINGLE_FIELDS = {
+    "sku": re.compile(r"SKU: (.*)"),
+    "referencia": re.compile(r"Referência: (.*)"),
+    "descricao": re.compile(r"Descrição: (.*)"),
+}
+
+SAMPLE_VALUES = {
+    "nome_categoria": "Peças Moto",
+    "peso": "0.25",
+    "altura": "5.0",
+    "comprimento": "12.0",
+    "largura": "6.0",
+    "ncm": "8714.19.00",
+    "descricao_ncm": "Partes e acessórios de motocicletas",
+    "aplicacao": "Honda CG 160 Titan, Fan e Start 2016-2024",
+    "descricao_tecnica": "Peça original Honda fabricada conforme especificação de fábrica",
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8199)
+    parser.add_argument("--latency-ms", type=float, default=400.0, help="Median base latency per call")
+    parser.add_argument(
+        "--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal",
+        help="fixed: always --latency-ms; uniform: ±--latency-jitter; lognormal: sigma --latency-sigma"
+    )
+    parser.add_argument("--latency-jitter", type=float, default=0.5, help="Uniform spread as a fraction of the median")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal sigma")
+    parser.add_argument("--ms-per-token", type=float, default=2.0, help="Extra latency per completion token")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms header of 429 responses")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of calls returning broken JSON")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+def sample_latency(config: argparse.Namespace) -> float:
+    """Base latency in seconds drawn from the configured distribution"""
+    median = config.latency_ms / 1000
+    if config.latency_dist == "fixed":
+        return median
+    if config.latency_dist == "uniform":
+        return max(0.0, random.uniform(median * (1 - config.latency_jitter), median * (1 + config.latency_jitter)))
+    return random.lognormvariate(0, config.latency_sigma) * median
+
+
+def fake_item(product: Dict[str, Any], keys: List[str]) -> Dict[str, str]:
+    """One enriched product with every requested key"""
+    sku = str(product.get("sku", ""))
+    item = {}
+    for key in keys:
+        if key == "sku":
+            item[key] = sku
+        else:
+            item[key] = SAMPLE_VALUES.get(key, "Texto gerado pelo servidor de teste")
+    return item
+
+
+def build_content(prompt: str) -> str:
+    """JSON answer for a single or batched enrichment prompt"""
+    structure = prompt.split("estrutura exata", 1)[-1]
+    keys = list(dict.fromkeys(RESPONSE_KEY.findall(structure)))
+
+    batch = BATCH_PRODUCTS.search(prompt)
+    if batch:
+        products = json.loads(f"[{batch.group(1)}]")
+        return json.dumps([fake_item(product, keys) for product in products], ensure_ascii=False)
+
+    product = {}
+    for field, pattern in SINGLE_FIELDS.items():
+        match = pattern.search(prompt)
+        product[field] = match.group(1).strip() if match else ""
+    return json.dumps(fake_item(product, [key for key in keys if key != "sku"]), ensure_ascii=False)
+
+
+def create_app(config: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="Fake LLM server")
+    stats = {"calls": 0, "rate_limited": 0, "malformed": 0}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["calls"] += 1
+
+        if random.random() < config.rate_429:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after-ms": str(config.retry_after_ms)},
+                content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            )
+
+        messages = body.get("messages", [])
+        prompt = messages[-1].get("content", "") if messages else ""
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+
+        content = build_content(prompt)
+        if random.random() < config.malformed_rate:
+            stats["malformed"] += 1
+            content = "Claro! Aqui estão os dados: " + content[: len(content) // 2]
+
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        await asyncio.sleep(sample_latency(config) + completion_tokens * config.ms_per_token / 1000)
+
+        prompt_tokens = prompt_chars // CHARS_PER_TOKEN
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    return app
+
+
+def main():
+    config = parse_args()
+    if config.seed is not None:
+        random.seed(config.seed)
+    uvicorn.run(create_app(config), host=config.host, port=config.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+# Settings are read once at import: point them at a throwaway storage before any app module loads
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["CSV_STORAGE_PATH"] = tempfile.mkdtemp(prefix="gerador-cvs-tests-")
+
+# Complete AI fields, as a model answer would carry them
+AI_DATA = {
+    "nome_categoria": "Freios Moto",
+    "peso": "0.05",
+    "altura": "1.0",
+    "comprimento": "8.0",
+    "largura": "1.0",
+    "ncm": "8714.10.00",
+    "aplicacao": "CG 160 2016-2024",
+    "descricao_tecnica": "Mola de aço da vareta do freio traseiro",
+    "descricao_ncm": "Partes e acessórios de motocicletas",
+}
+
+
+class FakeLLM:
+    """Stands in for every backend chain: answers each prompt like the model would"""
+
+    def __init__(self):
+        # Inputs of every call, in order
+        self.calls = []
+        # SKUs left out of batched answers
+        self.drop = set()
+        # Raised by the next calls, one per call
+        self.errors = []
+
+    async def ainvoke(self, inputs):
+        self.calls.append(inputs)
+        if self.errors:
+            raise self.errors.pop(0)
+        if "produtos" in inputs:
+            products = json.loads(inputs["produtos"])
+            return json.dumps([
+                {"sku": product["sku"], **AI_DATA} for product in products if product["sku"] not in self.drop
+            ])
+        return "```json\n" + json.dumps(AI_DATA) + "\n```"
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """A CSV_STORAGE_PATH of its own, so caches and journals do not leak between tests"""
+    from app.core.config import settings
+    monkeypatch.setattr(settings, "CSV_STORAGE_PATH", str(tmp_path / "data"))
+    return tmp_path / "data"
+
+
+@pytest.fixture
+def fake_llm():
+    return FakeLLM()
+
+
+def install_fake_llm(agent, fake_llm, monkeypatch):
+    for backend in agent.backends.values():
+        monkeypatch.setattr(backend, "chain", fake_llm)
+        monkeypatch.setattr(backend, "batch_chain", fake_llm)
+
+
+@pytest.fixture
+def agent(storage, fake_llm, monkeypatch):
+    from app.services.ai_agent import AIProductEnrichmentAgent
+    agent = AIProductEnrichmentAgent()
+    install_fake_llm(agent, fake_llm, monkeypatch)
+    return agent
+
+
+@pytest.fixture
+def processor(storage, fake_llm, monkeypatch):
+    from app.services.csv_processor import CSVProcessor
+    processor = CSVProcessor()
+    install_fake_llm(processor.ai_agent, fake_llm, monkeypatch)
+    return processor
+
+
+@pytest.fixture
+def client(fake_llm, monkeypatch):
+    """The API with its background workers running and the fake model behind it"""
+    from fastapi.testclient import TestClient
+    from app import main
+    install_fake_llm(main.csv_processor.ai_agent, fake_llm, monkeypatch)
+    with TestClient(main.app) as client:
+        yield client
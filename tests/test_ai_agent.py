@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+from app.core.config import settings
+from conftest import AI_DATA
+
+
+def product(sku, descricao="9501473100 MOLA VARETA FREIO", referencia="9501473100"):
+    return {
+        "referencia": referencia,
+        "descricao": descricao,
+        "quantidade": "2",
+        "preco_venda": "R$ 3,83",
+        "preco_custo": "R$ 2,55",
+        "sku": sku,
+        "ean": "7897925504835",
+    }
+
+
+@pytest.mark.asyncio
+async def test_batch_results_are_matched_back_by_sku(agent, fake_llm):
+    products = [product("S1"), product("S2", "9410112000 ARRUELA PLANA 12MM", "9410112000"), product("S3")]
+    fake_llm.drop = {"S2"}
+
+    results = await agent.enrich_products_batch(products)
+
+    assert len(fake_llm.calls) == 1
+    sent = [json.loads(line.rstrip(",")) for line in fake_llm.calls[0]["produtos"].splitlines()[1:-1]]
+    assert [item["sku"] for item in sent] == ["S1", "S2", "S3"]
+    # Stock, prices and EAN are copied to the output, never sent
+    assert all(set(item) == {"sku", "referencia", "descricao"} for item in sent)
+    # Dropped by the model: None, so the caller retries it alone
+    assert results[1] is None
+    assert [results[0]["SKU"], results[2]["SKU"]] == ["S1", "S3"]
+    assert results[0]["NCM"] == AI_DATA["ncm"]
+    assert results[0]["Preço (Padrão (BRL))"] == "3.83"
+
+
+@pytest.mark.parametrize("answer", [
+    '```json\n[{"sku": "S1", %s}]\n```',
+    '{"produtos": [{"sku": "S1", %s}]}',
+])
+def test_batch_response_wrappers(agent, answer):
+    fields = json.dumps(AI_DATA)[1:-1]
+
+    items = agent._parse_ai_batch_response(answer % fields)
+
+    assert [item["sku"] for item in items] == ["S1"]
+    assert agent._is_complete(items[0])
+
+
+def test_unparseable_batch_response(agent):
+    assert agent._parse_ai_batch_response("Desculpe, não entendi") == []
+
+
+def test_plan_batches_by_size_text_and_sku(agent, monkeypatch):
+    agent.max_batch_size = 3
+    monkeypatch.setattr(settings, "AI_BATCH_MAX_INPUT_CHARS", 100_000)
+    products = [product(f"S{index}") for index in range(7)]
+    assert agent.plan_batches(products) == [[0, 1, 2], [3, 4, 5], [6]]
+
+    # Results are matched by SKU, so a repeated SKU starts a new batch
+    products = [product("S1"), product("S2"), product("S1")]
+    assert agent.plan_batches(products) == [[0, 1], [2]]
+
+    # Long descriptions close batches early
+    monkeypatch.setattr(settings, "AI_BATCH_MAX_INPUT_CHARS", len(agent._batch_product_json(product("S1"))) * 2)
+    products = [product(f"S{index}") for index in range(4)]
+    assert agent.plan_batches(products) == [[0, 1], [2, 3]]
+
+
+@pytest.mark.asyncio
+async def test_calls_go_to_the_named_backend(storage, monkeypatch):
+    from app.core.config import LLMBackendSettings
+    from app.services.ai_agent import AIProductEnrichmentAgent
+    from conftest import FakeLLM
+
+    monkeypatch.setattr(settings, "AI_BACKENDS", [
+        LLMBackendSettings(name="key-a"),
+        LLMBackendSettings(name="local", base_url="http://localhost:8011/v1", model="qwen"),
+    ])
+    agent = AIProductEnrichmentAgent()
+    models = {name: FakeLLM() for name in agent.backends}
+    for name, backend in agent.backends.items():
+        monkeypatch.setattr(backend, "chain", models[name])
+        monkeypatch.setattr(backend, "batch_chain", models[name])
+
+    await agent.enrich_product(product("S1"), use_cache=False, backend="local")
+    await agent.enrich_products_batch([product("S2"), product("S3")], backend="local")
+    await agent.enrich_product(product("S4"), use_cache=False)
+
+    assert list(agent.backends) == ["key-a", "local"]
+    assert [len(models["key-a"].calls), len(models["local"].calls)] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_single_prompt_sends_only_the_part_fields(agent, fake_llm):
+    result = await agent.enrich_product(product("S1"), use_cache=False)
+
+    assert set(fake_llm.calls[0]) == {"sku", "referencia", "descricao", "exemplos"}
+    assert result.source == "llm"
+    assert result.data["EAN"] == "7897925504835"
+    assert result.data["Preço de Compra"] == "2.55"
+
+
+def test_prompts_ask_only_for_the_part_fields(agent):
+    for prompt in (agent._create_prompt_template(), agent._create_batch_prompt_template()):
+        assert set(prompt.input_variables) <= {"sku", "referencia", "descricao", "produtos", "exemplos"}
+
+
+def test_stock_and_prices_do_not_change_planning_or_keys(agent, monkeypatch):
+    monkeypatch.setattr(settings, "AI_BATCH_MAX_INPUT_CHARS", len(agent._batch_product_json(product("S1"))) * 2)
+    plain = [product(f"S{index}") for index in range(4)]
+    priced = [dict(item, quantidade="1" * 500, preco_venda="9" * 500, ean="7" * 500) for item in plain]
+
+    assert agent.plan_batches(priced) == agent.plan_batches(plain)
+    assert agent.estimate_batch_tokens(priced) == agent.estimate_batch_tokens(plain)
+    assert agent.estimate_tokens(priced[0]) == agent.estimate_tokens(plain[0])
+    assert agent.part_key(priced[0]) == agent.part_key(plain[0])
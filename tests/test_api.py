@@ -0,0 +1,93 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from app import main
+from app.core.config import settings
+
+EXAMPLE_INPUT = Path(__file__).resolve().parent.parent / "examples" / "input" / "Carga CMNS.csv"
+
+
+def upload(client, filename, url, **params):
+    with open(EXAMPLE_INPUT, "rb") as input_file:
+        return client.post(url, files={"file": (filename, input_file, "text/csv")}, params=params)
+
+
+def test_stream_csv(client):
+    response = upload(client, "carga.csv", "/process-csv/stream", force=True)
+
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == 'attachment; filename="enriched_carga.csv"'
+    lines = response.text.splitlines()
+    assert lines[0].startswith("ID_produto;ID_OEM;")
+    assert len(lines) == 18
+    assert lines[1].startswith("CMNS0483KLE;9501473100;")
+
+
+def test_stream_ndjson(client):
+    response = upload(client, "carga.csv", "/process-csv/stream", format="ndjson", force=True)
+
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[0]["event"] == "header"
+    assert events[0]["total_rows"] == 17
+    assert [event["row"] for event in events[1:-1]] == list(range(1, 18))
+    assert events[-1] == {"event": "done", "processed_rows": 17, "total_rows": 17}
+
+
+@pytest.mark.parametrize("params", [{"format": "xml"}, {"priority": "asap"}])
+def test_stream_rejects_bad_parameters(client, params):
+    assert upload(client, "carga.csv", "/process-csv/stream", **params).status_code == 400
+
+
+def test_stream_rejects_other_files(client):
+    assert upload(client, "carga.xlsx", "/process-csv/stream").status_code == 400
+
+
+@pytest.mark.parametrize("url", ["/process-csv", "/process-csv/stream", "/jobs"])
+def test_oversized_upload_is_refused_from_content_length(client, url, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_FILE_SIZE_MB", 1)
+    storage = Path(settings.CSV_STORAGE_PATH)
+    before = set(storage.iterdir())
+
+    response = client.post(
+        url,
+        content=b"x" * 10,
+        headers={"content-type": "multipart/form-data; boundary=x", "content-length": str(2 * 1024 * 1024)}
+    )
+
+    assert response.status_code == 413
+    assert "1 MB" in response.json()["detail"]
+    # Refused before the body was read: nothing was written
+    assert set(storage.iterdir()) == before
+
+
+def test_upload_without_content_length_is_cut_off(client, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_FILE_SIZE_MB", 1)
+    storage = Path(settings.CSV_STORAGE_PATH)
+
+    def body():
+        yield b'--x\r\nContent-Disposition: form-data; name="file"; filename="big.csv"\r\n\r\n'
+        for _ in range(3):
+            yield b"x" * (1024 * 1024)
+        yield b"\r\n--x--\r\n"
+
+    response = client.post("/jobs", content=body(), headers={"content-type": "multipart/form-data; boundary=x"})
+
+    assert response.status_code == 413
+    assert not list(storage.glob("input_*_big.csv*"))
+
+
+def test_uploads_of_the_same_name_get_their_own_paths(client):
+    first = upload(client, "carga.csv", "/jobs").json()
+    second = upload(client, "carga.csv", "/jobs").json()
+
+    assert first["job_id"] != second["job_id"]
+    paths = {main.job_manager.get(job["job_id"]).input_path for job in (first, second)}
+    assert len(paths) == 2
+    assert all(path.name.endswith("_carga.csv") for path in paths)
+
+
+def test_upload_path_is_unique():
+    assert main.upload_path("a.csv") != main.upload_path("a.csv")
+    assert main.upload_path("a.csv", "job1").name == "input_job1_a.csv"
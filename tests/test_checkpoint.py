@@ -0,0 +1,150 @@
+import csv
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from app.services.checkpoint import CheckpointJournal
+from app.services.upload_storage import hash_file
+
+EXAMPLE_INPUT = Path(__file__).resolve().parent.parent / "examples" / "input" / "Carga CMNS.csv"
+
+
+def asked_skus(fake_llm):
+    """SKUs of every product sent to the model"""
+    skus = set()
+    for call in fake_llm.calls:
+        if "produtos" in call:
+            skus.update(product["sku"] for product in json.loads(call["produtos"]))
+        else:
+            skus.add(call["sku"])
+    return skus
+
+
+def test_journal_resumes_after_restart(tmp_path):
+    db_path = tmp_path / "checkpoints.sqlite3"
+    journal = CheckpointJournal(db_path, retention_hours=24, prompt_version="v1")
+    assert journal.start_run("file-a", "a.csv") == 0
+    journal.record("file-a", [(0, {"SKU": "A0"}), (1, {"SKU": "A1"})])
+    journal.record("file-a", [(5, {"SKU": "A5"}), (1, {"SKU": "A1 again"})])
+    journal.record("file-b", [(0, {"SKU": "B0"})])
+
+    # The process died; a new one opens the same journal
+    resumed = CheckpointJournal(db_path, retention_hours=24, prompt_version="v1")
+
+    assert resumed.start_run("file-a", "a.csv") == 3
+    assert resumed.load("file-a", 0, 5) == {0: {"SKU": "A0"}, 1: {"SKU": "A1 again"}}
+    assert resumed.load("file-a", 5, 5) == {5: {"SKU": "A5"}}
+    assert resumed.load("file-b", 0, 5) == {0: {"SKU": "B0"}}
+
+
+def test_completed_runs_drop_their_rows(tmp_path):
+    journal = CheckpointJournal(tmp_path / "checkpoints.sqlite3", retention_hours=24, prompt_version="v1")
+    journal.start_run("file-a", "a.csv")
+    journal.record("file-a", [(0, {"SKU": "A0"})])
+    journal.complete("file-a")
+
+    # Processing the file again enriches it again
+    run, = journal.list_runs()
+    assert run["completed_at"] is not None
+    assert run["journaled_rows"] == 0
+    assert journal.start_run("file-a", "a.csv") == 0
+
+    assert journal.cleanup() == 0
+    assert journal.cleanup(older_than_hours=0) == 1
+    assert journal.list_runs() == []
+
+
+def test_restart_drops_journaled_rows(tmp_path):
+    journal = CheckpointJournal(tmp_path / "checkpoints.sqlite3", retention_hours=24, prompt_version="v1")
+    journal.start_run("file-a", "a.csv")
+    journal.record("file-a", [(0, {"SKU": "A0"})])
+
+    assert journal.start_run("file-a", "a.csv", restart=True) == 0
+    assert journal.load("file-a", 0, 1) == {}
+
+
+def test_file_key_changes_with_the_prompt_version(tmp_path):
+    db_path = tmp_path / "checkpoints.sqlite3"
+    journal = CheckpointJournal(db_path, retention_hours=24, prompt_version="v1")
+    newer = CheckpointJournal(db_path, retention_hours=24, prompt_version="v2")
+    journal.record(journal.file_key("abc"), [(0, {"SKU": "A0"})])
+
+    assert newer.load(newer.file_key("abc"), 0, 1) == {}
+
+
+@pytest.mark.asyncio
+async def test_interrupted_run_resumes_from_the_journal(processor, fake_llm, tmp_path):
+    input_path = tmp_path / "input.csv"
+    shutil.copyfile(EXAMPLE_INPUT, input_path)
+    rows = processor.count_rows(input_path)
+    content_hash = hash_file(input_path)
+    file_key = processor.checkpoints.file_key(content_hash)
+    processor.checkpoints.record(file_key, [(index, {"SKU": f"journaled-{index}"}) for index in range(rows)])
+
+    results = [result async for result in processor.iter_enrichment_results(input_path, content_hash=content_hash)]
+
+    # Every row was journaled by the interrupted run: none is enriched again, order is kept
+    assert [result.source for result in results] == ["resumed"] * rows
+    assert [result.data["SKU"] for result in results] == [f"journaled-{index}" for index in range(rows)]
+    assert fake_llm.calls == []
+
+
+@pytest.mark.asyncio
+async def test_resumed_run_only_enriches_unfinished_rows(processor, fake_llm, tmp_path, monkeypatch):
+    input_path = tmp_path / "input.csv"
+    shutil.copyfile(EXAMPLE_INPUT, input_path)
+    content_hash = hash_file(input_path)
+    file_key = processor.checkpoints.file_key(content_hash)
+    processor.checkpoints.record(file_key, [(index, {"SKU": f"journaled-{index}"}) for index in range(5)])
+    journaled = []
+    record = processor.checkpoints.record
+
+    def spy(key, rows):
+        journaled.extend(rows)
+        record(key, rows)
+    monkeypatch.setattr(processor.checkpoints, "record", spy)
+
+    results = [result async for result in processor.iter_enrichment_results(input_path, content_hash=content_hash)]
+
+    assert [result.source for result in results[:5]] == ["resumed"] * 5
+    assert "resumed" not in {result.source for result in results[5:]}
+    with open(input_path, encoding="utf-8", newline="") as input_file:
+        skus = [row["SKU"] for row in csv.DictReader(input_file)]
+    assert not asked_skus(fake_llm) & set(skus[:5])
+    # Rows enriched by the model are journaled for the next restart
+    llm_rows = [index for index, result in enumerate(results) if result.source in ("llm", "dedup")]
+    assert llm_rows
+    assert {row_index for row_index, _ in journaled} == set(llm_rows)
+    # Completed: processing the file again enriches it again
+    assert processor.checkpoints.load(file_key, 0, len(results)) == {}
+
+
+
+@pytest.mark.asyncio
+async def test_forced_run_ignores_the_journal(processor, fake_llm, tmp_path):
+    input_path = tmp_path / "input.csv"
+    shutil.copyfile(EXAMPLE_INPUT, input_path)
+    content_hash = hash_file(input_path)
+    processor.checkpoints.record(processor.checkpoints.file_key(content_hash), [(0, {"SKU": "journaled-0"})])
+
+    output_path = await processor.process_file(input_path, content_hash=content_hash, force=True)
+
+    with open(output_path, encoding="utf-8", newline="") as output_file:
+        first_row = next(csv.DictReader(output_file, delimiter=";"))
+    assert first_row["SKU"] != "journaled-0"
+    with open(processor.report_path(output_path), encoding="utf-8", newline="") as report_file:
+        assert "resumed" not in {row["source"] for row in csv.DictReader(report_file, delimiter=";")}
+
+
+@pytest.mark.asyncio
+async def test_journal_of_another_prompt_version_is_not_resumed(processor, fake_llm, tmp_path):
+    input_path = tmp_path / "input.csv"
+    shutil.copyfile(EXAMPLE_INPUT, input_path)
+    content_hash = hash_file(input_path)
+    processor.checkpoints.record(f"{content_hash}:old-prompt", [(0, {"SKU": "journaled-0"})])
+
+    results = [result async for result in processor.iter_enrichment_results(input_path, content_hash=content_hash)]
+
+    assert results[0].source != "resumed"
@@ -0,0 +1,122 @@
+import csv
+import re
+import threading
+
+import pytest
+
+HEADER = ["Referencia", "Descricao", "Quantidade Estoque", "Preço de Venda", "Preço de Custo", "SKU", "EAN"]
+
+
+def write_input(path, rows):
+    """Input CSV with one (referencia, descricao, sku) per row"""
+    with open(path, "w", encoding="utf-8", newline="") as input_file:
+        writer = csv.writer(input_file)
+        writer.writerow(HEADER)
+        for referencia, descricao, sku in rows:
+            writer.writerow([referencia, f"{referencia} {descricao}", "1", "R$ 3,83", "R$ 2,55", sku, ""])
+    return path
+
+
+async def enrich(processor, input_path):
+    return [result async for result in processor.iter_enrichment_results(input_path)]
+
+
+def sku_label(result):
+    return re.search(r"Código SKU: (.*?) Código do Fabricante", result.data["Descrição adicional 2 (BR)"]).group(1)
+
+
+@pytest.mark.asyncio
+async def test_repeated_parts_are_enriched_once(processor, fake_llm, tmp_path):
+    input_path = write_input(tmp_path / "input.csv", [
+        ("9501473100", "MOLA VARETA FREIO", "S1"),
+        ("17910KWB600", "CABO ACELERADOR", "S2"),
+        ("9501473100", "MOLA VARETA FREIO", "S3"),
+        ("9501473100", "MOLA  VARETA FREIO", "S4 B"),
+    ])
+
+    results = await enrich(processor, input_path)
+
+    assert [result.source for result in results] == ["llm", "llm", "dedup", "dedup"]
+    assert len(fake_llm.calls) == 1
+    # Copies carry their own SKU, in the output and in description 2
+    assert [result.data["SKU"] for result in results] == ["S1", "S2", "S3", "S4 B"]
+    assert [sku_label(result) for result in results] == ["S1", "S2", "S3", "S4 B"]
+
+
+@pytest.mark.asyncio
+async def test_repeats_of_parts_that_fell_back_are_retried_in_one_batch(processor, fake_llm, tmp_path):
+    input_path = write_input(tmp_path / "input.csv", [
+        ("9501473100", "MOLA VARETA FREIO", "S1"),
+        ("17910KWB600", "CABO ACELERADOR", "S2"),
+        ("9501473100", "MOLA VARETA FREIO", "S3"),
+        ("17910KWB600", "CABO ACELERADOR", "S4"),
+        ("9501473100", "MOLA VARETA FREIO", "S5"),
+    ])
+    # The batch, then each of its rows alone
+    fake_llm.errors = [ValueError("model unavailable")] * 3
+
+    results = await enrich(processor, input_path)
+
+    assert [result.source for result in results] == ["fallback", "fallback", "llm", "llm", "dedup"]
+    assert '"sku": "S3"' in fake_llm.calls[3]["produtos"] and '"sku": "S4"' in fake_llm.calls[3]["produtos"]
+    assert len(fake_llm.calls) == 4
+
+
+@pytest.mark.parametrize("previous_sku, sku", [
+    ("S1", "S22"),
+    ("", "S22"),
+    ("S22", ""),
+    ("CMNS 0483", "S1"),
+])
+def test_copied_description_2_points_at_the_row_sku(processor, previous_sku, sku):
+    agent = processor.ai_agent
+    part_row = agent._convert_to_csv_format(
+        {"peso": "0.05"}, {"sku": previous_sku, "referencia": "9501473100", "descricao": "9501473100 MOLA"}
+    )
+    part_row["Descrição adicional 2 (BR)"] = part_row["Descrição adicional 2 (BR)"].replace(
+        re.search(r"Data: \S+", part_row["Descrição adicional 2 (BR)"]).group(0), "Data: 2020-01-01"
+    )
+
+    copy = agent.enrich_from_part({"sku": sku, "referencia": "9501473100", "descricao": "9501473100 MOLA"}, part_row)
+
+    description = copy["Descrição adicional 2 (BR)"]
+    assert f"Código SKU: {sku} Código do Fabricante/Referência: 9501473100".replace("  ", " ") in description
+    assert "Data: 2020-01-01" not in description
+    assert copy["Peso"] == "0.05"
+
+
+@pytest.mark.asyncio
+async def test_parts_enriched_by_an_earlier_file_come_from_the_cache(processor, fake_llm, tmp_path):
+    rows = [("9501473100", "MOLA VARETA FREIO", "S1"), ("17910KWB600", "CABO ACELERADOR", "S2")]
+    await enrich(processor, write_input(tmp_path / "first.csv", rows))
+    calls = len(fake_llm.calls)
+
+    results = await enrich(processor, write_input(tmp_path / "second.csv", rows + [("0001", "PECA NOVA", "S3")]))
+
+    assert [result.source for result in results] == ["cache", "cache", "llm"]
+    assert [result.data["SKU"] for result in results] == ["S1", "S2", "S3"]
+    assert len(fake_llm.calls) == calls + 1
+
+
+@pytest.mark.asyncio
+async def test_chunk_lookups_run_in_one_thread_off_the_event_loop(processor, monkeypatch, tmp_path):
+    input_path = write_input(tmp_path / "carga.csv", [("111", "MOLA VARETA FREIO", "S1")])
+    threads = {}
+
+    def spy(name, lookup):
+        def wrapper(*args, **kwargs):
+            threads[name] = threading.get_ident()
+            return lookup(*args, **kwargs)
+        monkeypatch.setattr(lookup.__self__, lookup.__name__, wrapper)
+
+    spy("journal", processor.checkpoints.load)
+    spy("catalog", processor.catalogs.lookup)
+    spy("cache", processor.ai_agent.cache.get_many)
+    spy("similar", processor.ai_agent.similar.reusable)
+
+    results = [result async for result in processor.iter_enrichment_results(input_path, supplier="honda")]
+
+    assert [result.source for result in results] == ["llm"]
+    assert set(threads) == {"journal", "catalog", "cache", "similar"}
+    assert len(set(threads.values())) == 1
+    assert threading.get_ident() not in threads.values()
@@ -0,0 +1,312 @@
+import asyncio
+import base64
+import re
+from datetime import datetime
+
+import httpx
+import pytest
+from imapclient import IMAPClient
+from imapclient.response_parser import parse_fetch_response
+from imapclient.response_types import Address, Envelope
+
+from app.core.config import settings
+from app.services import email_monitor
+from app.services.email_monitor import EmailMonitor
+
+CSV = "Referencia,Descricao\n9501473100,MOLA VARETA FREIO ÇÃ\n".encode("utf-8")
+
+# One text part and one base64 CSV attachment
+STRUCTURE = (
+    b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+    b'("TEXT" "CSV" ("NAME" "carga.csv") NIL NIL "BASE64" %d 2 NIL ("ATTACHMENT" ("FILENAME" "carga.csv")) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "x") NIL NIL NIL)'
+)
+
+
+def bodystructure(raw):
+    return parse_fetch_response([b"1 (UID 1 BODYSTRUCTURE " + raw + b")"], uid_is_key=True)[1][b"BODYSTRUCTURE"]
+
+
+class FakeMailbox:
+    """IMAPClient stand-in serving messages from memory"""
+
+    Error = IMAPClient.Error
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        # uid -> (sender mailbox, BODYSTRUCTURE, {part number: encoded body})
+        self.messages = {}
+        self.seen = set()
+        self.fetches = []
+
+    def add(self, uid, parts=None, raw_structure=None, sender=b"pedidos"):
+        body = base64.encodebytes(CSV)
+        self.messages[uid] = (sender, bodystructure(raw_structure or STRUCTURE % len(body)), parts or {"2": body})
+
+    # IMAPClient API used by EmailMonitor
+    def login(self, username, password):
+        pass
+
+    def select_folder(self, folder):
+        return {b"UIDVALIDITY": self.uidvalidity, b"UIDNEXT": max(self.messages, default=0) + 1}
+
+    def has_capability(self, capability):
+        return True
+
+    def logout(self):
+        pass
+
+    def search(self, criteria):
+        if criteria == ["UNSEEN"]:
+            return [uid for uid in self.messages if uid not in self.seen]
+        first = int(criteria[1].split(":")[0])
+        # Like a real server, "N:*" matches the newest message even below N
+        return [uid for uid in self.messages if uid >= first] or [max(self.messages)]
+
+    def fetch(self, uids, items):
+        uid, = uids
+        self.fetches.append(items)
+        sender, structure, parts = self.messages[uid]
+        section = re.fullmatch(r"BODY\.PEEK\[(.+)\]<(\d+)\.(\d+)>", items[0])
+        if section:
+            part, offset, size = section.group(1), int(section.group(2)), int(section.group(3))
+            return {uid: {f"BODY[{part}]<{offset}>".encode(): parts[part][offset:offset + size]}}
+        envelope = Envelope(
+            None, b"Carga semanal", (Address(b"Fornecedor", None, sender, b"honda.com.br"),),
+            None, None, None, None, None, None, None
+        )
+        return {uid: {b"ENVELOPE": envelope, b"BODYSTRUCTURE": structure, b"INTERNALDATE": datetime(2024, 5, 1, 10)}}
+
+    def add_flags(self, uids, flags):
+        self.seen.update(uids)
+
+
+@pytest.fixture
+def mailbox():
+    return FakeMailbox()
+
+
+@pytest.fixture
+def monitor(storage, mailbox, monkeypatch):
+    monkeypatch.setattr(email_monitor, "IMAPClient", lambda *args, **kwargs: mailbox)
+    monitor = EmailMonitor()
+    monitor.upload_queue = asyncio.Queue()
+    return monitor
+
+
+def queued(monitor):
+    items = []
+    while not monitor.upload_queue.empty():
+        items.append(monitor.upload_queue.get_nowait())
+    return items
+
+
+@pytest.mark.asyncio
+async def test_first_run_takes_unread_emails_then_only_newer_uids(monitor, mailbox):
+    for uid in (3, 4, 6):
+        mailbox.add(uid)
+    mailbox.seen.add(6)
+    monitor.connect()
+
+    await monitor.check_for_new_emails()
+    assert [path.name for path, _, _ in queued(monitor)] == ["3_2_carga.csv", "4_2_carga.csv"]
+    # Read emails already in the mailbox are never fetched
+    assert monitor.last_uid == 6
+
+    await monitor.check_for_new_emails()
+    assert queued(monitor) == []
+
+    mailbox.add(7)
+    await monitor.check_for_new_emails()
+    assert [path.name for path, _, _ in queued(monitor)] == ["7_2_carga.csv"]
+    assert monitor.load_state()["last_uid"] == 7
+
+
+@pytest.mark.asyncio
+async def test_only_registered_senders_are_diffed_as_suppliers(monitor, mailbox, monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_SUPPLIERS", {"Catalogo@Honda.com.br": "honda"})
+    mailbox.add(3, sender=b"catalogo")
+    mailbox.add(4, sender=b"pedidos")
+    monitor.connect()
+
+    await monitor.check_for_new_emails()
+
+    assert [supplier for _, _, supplier in queued(monitor)] == ["honda", None]
+
+
+@pytest.mark.asyncio
+async def test_restart_resumes_from_the_saved_uid(monitor, mailbox, storage):
+    mailbox.add(3)
+    monitor.connect()
+    await monitor.check_for_new_emails()
+    queued(monitor)
+    mailbox.add(4)
+
+    restarted = EmailMonitor()
+    restarted.upload_queue = asyncio.Queue()
+    restarted.connect()
+    await restarted.check_for_new_emails()
+
+    assert [path.name for path, _, _ in queued(restarted)] == ["4_2_carga.csv"]
+
+
+def test_uidvalidity_change_starts_over(monitor, mailbox):
+    mailbox.add(3)
+    monitor.connect()
+    monitor.last_uid = 3
+    monitor.save_state()
+
+    mailbox.uidvalidity = 2
+    monitor.connect()
+
+    assert monitor.last_uid == 0
+
+
+def test_reconnect_delay_backs_off_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_RECONNECT_MAX_DELAY", 60)
+
+    assert 2.5 <= EmailMonitor.reconnect_delay(1) <= 5
+    assert 20 <= EmailMonitor.reconnect_delay(4) <= 40
+    assert 30 <= EmailMonitor.reconnect_delay(20) <= 60
+
+
+# A forwarded email carrying the CSV, plus an inline CSV and a PDF that are not supplier files
+NESTED_STRUCTURE = (
+    b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+    b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 500 (NIL "Fwd" NIL NIL NIL NIL NIL NIL NIL NIL)'
+    b' (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL NIL)'
+    b'("APPLICATION" "OCTET-STREAM" ("NAME" "precos.CSV") NIL NIL "QUOTED-PRINTABLE" 40 NIL ("ATTACHMENT" NIL) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "y") NIL NIL NIL) 20 NIL NIL NIL NIL)'
+    b'("TEXT" "CSV" NIL NIL NIL "7BIT" 40 2 NIL ("INLINE" ("FILENAME" "inline.csv")) NIL NIL)'
+    b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 40 NIL ("ATTACHMENT" ("FILENAME" "nota.pdf")) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "x") NIL NIL NIL)'
+)
+
+
+def test_find_csv_parts(monitor):
+    parts = monitor.find_csv_parts(bodystructure(NESTED_STRUCTURE))
+
+    assert parts == [{"part": "2.2", "filename": "precos.CSV", "encoding": "QUOTED-PRINTABLE", "size": 40}]
+
+
+@pytest.mark.parametrize("disposition, filename", [
+    (b'("ATTACHMENT" ("FILENAME*" "utf-8\'\'pre%C3%A7os%202024.csv"))', "preços 2024.csv"),
+    (b'("ATTACHMENT" ("FILENAME" "=?utf-8?B?cHJlw6dvcy5jc3Y=?="))', "preços.csv"),
+    (b'("ATTACHMENT" ("FILENAME" "../../etc/carga.csv"))', "carga.csv"),
+])
+def test_attachment_filenames(monitor, disposition, filename):
+    raw = b'("TEXT" "CSV" NIL NIL NIL "BASE64" 40 2 NIL ' + disposition + b' NIL NIL)'
+
+    part, = monitor.find_csv_parts(bodystructure(raw))
+
+    assert part["filename"] == filename
+
+
+@pytest.mark.parametrize("encoding, encoded", [
+    ("base64", base64.encodebytes(CSV)),
+    ("quoted-printable", b"Referencia,Descricao\r\n9501473100,MOLA VARETA=\r\n FREIO =C3=87=C3=83\r\n"),
+    ("7bit", CSV),
+])
+def test_download_decodes_in_partial_fetches(monitor, mailbox, monkeypatch, encoding, encoded):
+    monkeypatch.setattr(email_monitor, "ATTACHMENT_FETCH_SIZE", 7)
+    mailbox.add(9, parts={"2": encoded})
+    monitor.connect()
+
+    path = monitor.download_attachment(9, {"part": "2", "filename": "carga.csv", "encoding": encoding, "size": 0})
+
+    assert path.read_bytes().replace(b"\r\n", b"\n") == CSV
+    assert len(mailbox.fetches) == len(encoded) // 7 + 1
+
+
+def test_only_the_csv_parts_are_downloaded(monitor, mailbox):
+    mailbox.add(5)
+    monitor.connect()
+
+    (path, received_at, _), = monitor.fetch_csv_attachments(5)
+
+    assert path.read_bytes() == CSV
+    assert received_at == datetime(2024, 5, 1, 10).timestamp()
+    assert mailbox.fetches[0] == ["ENVELOPE", "BODYSTRUCTURE", "INTERNALDATE"]
+    assert mailbox.fetches[1:] == [[f"BODY.PEEK[2]<0.{email_monitor.ATTACHMENT_FETCH_SIZE}>"]]
+    # Peeking leaves it unread: it is flagged explicitly
+    assert 5 in mailbox.seen
+
+
+TWO_CSV_STRUCTURE = (
+    b'(("TEXT" "CSV" NIL NIL NIL "BASE64" 40 2 NIL ("ATTACHMENT" ("FILENAME" "carga.csv")) NIL NIL)'
+    b'("TEXT" "CSV" NIL NIL NIL "BASE64" 40 2 NIL ("ATTACHMENT" ("FILENAME" "carga.csv")) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "x") NIL NIL NIL)'
+)
+
+
+def test_same_named_attachments_are_kept_apart(monitor, mailbox):
+    body = base64.encodebytes(CSV)
+    mailbox.add(5, parts={"1": body, "2": body}, raw_structure=TWO_CSV_STRUCTURE)
+    mailbox.add(6)
+    monitor.connect()
+
+    paths = [path for uid in (5, 6) for path, _, _ in monitor.fetch_csv_attachments(uid)]
+
+    assert [path.name for path in paths] == ["5_1_carga.csv", "5_2_carga.csv", "6_2_carga.csv"]
+    assert all(path.read_bytes() == CSV for path in paths)
+
+
+@pytest.mark.asyncio
+async def test_fetching_waits_for_a_full_upload_queue(monitor, mailbox):
+    for uid in (3, 4):
+        mailbox.add(uid)
+    monitor.connect()
+    monitor.upload_queue = asyncio.Queue(maxsize=1)
+
+    fetching = asyncio.create_task(monitor.check_for_new_emails())
+    await asyncio.sleep(0.05)
+    assert not fetching.done()
+
+    monitor.upload_queue.get_nowait()
+    await asyncio.wait_for(fetching, 1)
+    assert monitor.upload_queue.get_nowait()[0].name == "4_2_carga.csv"
+
+
+class FakeAPI:
+    """The processing API's job endpoints, answering after every upload has been received"""
+
+    def __init__(self, uploads):
+        self.uploads = uploads
+        self.submitted = []
+        self.all_received = asyncio.Event()
+
+    async def handle(self, request):
+        if request.method == "POST":
+            self.submitted.append((request.url.params.get("priority"), request.headers.get("x-email-received-at")))
+            job_id = f"job{len(self.submitted)}"
+            if len(self.submitted) == self.uploads:
+                self.all_received.set()
+            # Holds the upload until every worker has sent one: they run concurrently
+            await asyncio.wait_for(self.all_received.wait(), 1)
+            return httpx.Response(202, json={"job_id": job_id})
+        job_id = request.url.path.split("/")[2]
+        if request.url.path.endswith("/result"):
+            return httpx.Response(200, content=f"enriched by {job_id}".encode())
+        return httpx.Response(200, json={"status": "completed", "processed_rows": 1, "total_rows": 1})
+
+
+@pytest.mark.asyncio
+async def test_upload_workers_send_attachments_concurrently(monitor, storage, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_POLL_INTERVAL", 0)
+    api = FakeAPI(uploads=2)
+    monitor.http_client = httpx.AsyncClient(transport=httpx.MockTransport(api.handle))
+    paths = []
+    for name in ("a.csv", "b.csv"):
+        paths.append(storage / name)
+        paths[-1].write_bytes(CSV)
+        await monitor.upload_queue.put((paths[-1], 1714557600.0, None))
+
+    workers = [asyncio.create_task(monitor.upload_worker(index)) for index in range(2)]
+    await asyncio.wait_for(monitor.upload_queue.join(), 2)
+    for worker in workers:
+        worker.cancel()
+    await monitor.http_client.aclose()
+
+    assert api.submitted == [(settings.EMAIL_JOB_PRIORITY, "1714557600.0")] * 2
+    assert sorted((storage / f"enriched_{path.name}").read_text() for path in paths) == \
+        ["enriched by job1", "enriched by job2"]
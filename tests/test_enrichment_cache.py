@@ -0,0 +1,32 @@
+import time
+
+from app.services.enrichment_cache import EnrichmentCache
+
+
+def make_cache(tmp_path, ttl_days=30):
+    return EnrichmentCache(tmp_path / "cache.sqlite3", prompt_version="v1", ttl_days=ttl_days, max_entries=100)
+
+
+def test_get_many_keeps_the_order_of_the_parts(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.set("9501473100", "MOLA VARETA FREIO", {"ncm": "8714.10.00"})
+    cache.set("9410112000", "ARRUELA PLANA", {"ncm": "7318.22.00"})
+
+    found = cache.get_many([
+        ("9410112000", "arruela  plana"),
+        ("0000000000", "PNEU"),
+        ("9501473100", "MOLA VARETA FREIO"),
+        ("9410112000", "ARRUELA PLANA"),
+    ])
+
+    assert found == [{"ncm": "7318.22.00"}, None, {"ncm": "8714.10.00"}, {"ncm": "7318.22.00"}]
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.get_many([]) == []
+
+
+def test_get_many_skips_expired_entries(tmp_path):
+    cache = make_cache(tmp_path, ttl_days=1)
+    cache.set("9501473100", "MOLA VARETA FREIO", {"ncm": "8714.10.00"})
+    cache._conn.execute("UPDATE enrichment_cache SET created_at = ?", (time.time() - 2 * 24 * 3600,))
+
+    assert cache.get_many([("9501473100", "MOLA VARETA FREIO")]) == [None]
@@ -0,0 +1,115 @@
+import pytest
+
+from app.core.config import settings
+from app.services import ingestion
+from app.services.ingestion import read_chunks, sniff_dialect
+
+HEADER = ["Referencia", "Descricao", "Quantidade Estoque", "Preço de Venda", "Preço de Custo", "SKU", "EAN"]
+ROW = ["9501473100", "9501473100 MOLA VARETA FREIO", "2", "R$ 3,83", "R$ 2,55", "CMNS0483KLE", ""]
+
+
+def write_csv(path, delimiter, encoding, rows=(ROW,)):
+    lines = [delimiter.join(HEADER)] + [delimiter.join(row) for row in rows]
+    path.write_bytes(("\r\n".join(lines) + "\r\n").encode(encoding))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def sniffed_settings(monkeypatch):
+    monkeypatch.setattr(settings, "CSV_ENCODING", "")
+    monkeypatch.setattr(settings, "CSV_DELIMITER", "")
+
+
+@pytest.mark.parametrize("delimiter, encoding, expected_encoding", [
+    (",", "utf-8", "utf-8"),
+    (";", "cp1252", "cp1252"),
+    ("\t", "utf-8-sig", "utf-8-sig"),
+    ("|", "utf-16", "utf-16"),
+])
+def test_sniff_dialect(tmp_path, delimiter, encoding, expected_encoding):
+    path = write_csv(tmp_path / "input.csv", delimiter, encoding)
+
+    dialect = sniff_dialect(path)
+
+    assert dialect.encoding == expected_encoding
+    assert dialect.delimiter == delimiter
+    assert dialect.header == HEADER
+
+
+def test_sniff_dialect_prefers_known_columns(tmp_path):
+    # Commas inside the header columns do not outvote the real separator
+    path = tmp_path / "input.csv"
+    path.write_text("Referencia;Descricao;Obs, extra, livre;SKU\n1;A;x, y, z;S1\n", encoding="utf-8")
+
+    assert sniff_dialect(path).delimiter == ";"
+
+
+def test_sniff_dialect_cut_inside_a_character(tmp_path, monkeypatch):
+    # A multi-byte character cut by the sample limit is still UTF-8
+    path = write_csv(tmp_path / "input.csv", ",", "utf-8")
+    cut = path.read_bytes().index("ç".encode("utf-8")) + 1
+    monkeypatch.setattr(settings, "CSV_SNIFF_BYTES", cut)
+
+    assert sniff_dialect(path).encoding == "utf-8"
+
+
+def test_sniff_dialect_uses_configured_values(tmp_path, monkeypatch):
+    path = write_csv(tmp_path / "input.csv", ",", "utf-8")
+    monkeypatch.setattr(settings, "CSV_ENCODING", "latin-1")
+    monkeypatch.setattr(settings, "CSV_DELIMITER", ";")
+
+    dialect = sniff_dialect(path)
+
+    assert (dialect.encoding, dialect.delimiter) == ("latin-1", ";")
+
+
+@pytest.mark.parametrize("engine", ["pandas", "pyarrow"])
+def test_read_chunks_keeps_text(tmp_path, monkeypatch, engine):
+    if engine == "pyarrow" and ingestion.pa_csv is None:
+        pytest.skip("pyarrow is not installed")
+    monkeypatch.setattr(settings, "CSV_ENGINE", engine)
+    rows = [ROW, ROW[:5] + ["CMNS0484KLE", "7897925504842"], ROW[:5] + ["CMNS0485KLE", "0789"]]
+    path = write_csv(tmp_path / "input.csv", ";", "cp1252", rows)
+
+    chunks = list(read_chunks(path, chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert list(chunks[0].columns) == HEADER
+    assert [ean for chunk in chunks for ean in chunk["EAN"]] == ["", "7897925504842", "0789"]
+    assert chunks[0]["Preço de Venda"].iloc[0] == "R$ 3,83"
+
+
+def test_sniff_dialect_detects_quoted_line_breaks(tmp_path):
+    path = write_csv(tmp_path / "input.csv", ";", "utf-8")
+    assert not sniff_dialect(path).quoted_newlines
+
+    multiline = ROW[:1] + ['"MOLA VARETA\r\nFREIO"'] + ROW[2:]
+    path = write_csv(tmp_path / "multiline.csv", ";", "utf-8", [ROW, multiline])
+    assert sniff_dialect(path).quoted_newlines
+
+
+def test_arrow_reads_again_on_a_line_break_past_the_sample(tmp_path, monkeypatch):
+    if ingestion.pa_csv is None:
+        pytest.skip("pyarrow is not installed")
+    monkeypatch.setattr(settings, "CSV_ENGINE", "pyarrow")
+    # Small blocks, so a block boundary falls inside a quoted value
+    monkeypatch.setattr(ingestion, "ARROW_BLOCK_SIZE", 4096)
+    rows = [ROW[:5] + [f"SKU{index}", ""] for index in range(30)]
+    rows += [ROW[:1] + [f'"MOLA {index}\nFREIO"'] + ROW[2:5] + [f"SKU{30 + index}", ""] for index in range(570)]
+    path = write_csv(tmp_path / "input.csv", ";", "utf-8", rows)
+    monkeypatch.setattr(settings, "CSV_SNIFF_BYTES", 1024)
+    assert not sniff_dialect(path).quoted_newlines
+    reads = []
+    arrow_batches = ingestion._arrow_batches
+
+    def spy(input_path, chunk_size, dialect, newlines_in_values):
+        reads.append(newlines_in_values)
+        return arrow_batches(input_path, chunk_size, dialect, newlines_in_values)
+    monkeypatch.setattr(ingestion, "_arrow_batches", spy)
+
+    chunks = list(read_chunks(path, chunk_size=100))
+
+    assert reads == [False, True]
+    skus = [sku for chunk in chunks for sku in chunk["SKU"]]
+    assert skus == [f"SKU{index}" for index in range(600)]
+    assert chunks[-1]["Descricao"].iloc[-1] == "MOLA 569\nFREIO"
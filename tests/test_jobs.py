@@ -0,0 +1,92 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from app.services.job_manager import JobManager
+
+EXAMPLE_INPUT = Path(__file__).resolve().parent.parent / "examples" / "input" / "Carga CMNS.csv"
+
+
+async def wait_finished(manager, jobs, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not all(job.is_finished for job in jobs):
+        assert time.monotonic() < deadline, [job.status for job in jobs]
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_queued_jobs_start_by_priority(processor, tmp_path, monkeypatch):
+    started = []
+
+    async def process_file(input_path, progress_callback=None, **options):
+        started.append((input_path.name, options["priority"]))
+        progress_callback(2)
+        return input_path.with_name(f"enriched_{input_path.name}")
+
+    monkeypatch.setattr(processor, "process_file", process_file)
+    monkeypatch.setattr(processor, "count_rows", lambda input_path: 2)
+    manager = JobManager(processor, workers=1, retention_hours=1)
+    jobs = [
+        await manager.submit(tmp_path / f"{name}.csv", f"{name}.csv", priority=priority)
+        for name, priority in [("a", "bulk"), ("b", "normal"), ("c", "urgent"), ("d", "bulk")]
+    ]
+    assert manager.queue_depth == 4
+
+    manager.start()
+    await wait_finished(manager, jobs)
+    await manager.stop()
+
+    # Urgent first, then first come first served within a priority
+    assert started == [("c.csv", "urgent"), ("b.csv", "normal"), ("a.csv", "bulk"), ("d.csv", "bulk")]
+    status = jobs[0].to_status()
+    assert (status.status, status.processed_rows, status.total_rows) == ("completed", 2, 2)
+    assert status.output_file == str(tmp_path / "enriched_a.csv")
+
+
+@pytest.mark.asyncio
+async def test_failed_job_reports_the_error(processor, tmp_path, monkeypatch):
+    async def process_file(input_path, **options):
+        raise ValueError("No enriched data to write")
+
+    monkeypatch.setattr(processor, "process_file", process_file)
+    monkeypatch.setattr(processor, "count_rows", lambda input_path: 2)
+    manager = JobManager(processor, workers=1, retention_hours=1)
+    manager.start()
+    job = await manager.submit(tmp_path / "empty.csv", "empty.csv")
+    await wait_finished(manager, [job])
+    await manager.stop()
+
+    assert job.status == "failed"
+    assert "No enriched data to write" in job.message
+
+
+@pytest.mark.asyncio
+async def test_unknown_priority_is_rejected(processor, tmp_path):
+    manager = JobManager(processor, workers=1, retention_hours=1)
+
+    with pytest.raises(ValueError):
+        await manager.submit(tmp_path / "a.csv", "a.csv", priority="asap")
+
+
+def test_job_api_round_trip(client):
+    with open(EXAMPLE_INPUT, "rb") as input_file:
+        response = client.post("/jobs", files={"file": ("carga.csv", input_file, "text/csv")}, params={"force": True})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    deadline = time.monotonic() + 10
+    while (status := client.get(f"/jobs/{job_id}").json())["status"] not in ("completed", "failed"):
+        assert time.monotonic() < deadline, status
+        time.sleep(0.02)
+
+    assert status["status"] == "completed", status["message"]
+    assert status["processed_rows"] == status["total_rows"] == 17
+    result = client.get(f"/jobs/{job_id}/result")
+    assert result.status_code == 200
+    assert len(result.text.splitlines()) == 18
+    report = client.get(f"/jobs/{job_id}/report").text.splitlines()
+    assert report[0] == "row;SKU;source;reason"
+    assert len(report) == 18
+    assert client.get("/jobs/unknown").status_code == 404
@@ -0,0 +1,33 @@
+import multiprocessing
+
+
+def count_rows_in_worker(rows):
+    from app.services.metrics import ROWS
+    ROWS.labels(source="worker-test").inc(rows)
+
+
+def sample(text, name):
+    return next(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(name))
+
+
+def test_metrics_of_worker_processes_are_added_up():
+    from app.services.metrics import ROWS, render
+    ROWS.labels(source="worker-test").inc(2)
+
+    # Shard workers are spawned processes
+    worker = multiprocessing.get_context("spawn").Process(target=count_rows_in_worker, args=(3,))
+    worker.start()
+    worker.join(timeout=60)
+
+    assert worker.exitcode == 0
+    assert sample(render().decode(), 'csv_automation_rows_enriched_total{source="worker-test"}') == 5
+
+
+def test_metrics_endpoint_reads_the_api_state(client):
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert sample(response.text, "csv_automation_job_queue_depth") == 0
+    assert sample(response.text, 'csv_automation_llm_concurrency_limit{backend="default"}') >= 1
+    assert sample(response.text, 'csv_automation_llm_requests_in_flight{backend="default"}') == 0
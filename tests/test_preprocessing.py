@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+from app.services.preprocessing import clean_price, clean_price_column, prepare_products
+
+PRICES = [
+    "R$ 1.827,11",
+    "R$ 3,83",
+    "3,83",
+    "1.827",
+    "1.827.000",
+    "1,827.11",
+    "12.5",
+    "-1.234,5",
+    "R$ 10",
+    " 7 ",
+    "",
+    "abc",
+    "1e3",
+    "nan",
+    "inf",
+]
+
+
+@pytest.mark.parametrize("value", PRICES)
+def test_clean_price_column_matches_clean_price(value):
+    assert clean_price_column(pd.Series([value])).tolist() == [clean_price(value)]
+
+
+def test_clean_price_column_keeps_index():
+    prices = pd.Series(["3,83", "R$ 10"], index=[7, 8])
+    assert clean_price_column(prices).to_dict() == {7: "3.83", 8: "10.00"}
+
+
+def test_prepare_products():
+    chunk = pd.DataFrame({
+        "Referencia": ["9501473100"],
+        "Descricao": ["9501473100 MOLA VARETA FREIO "],
+        "Preço de Venda": ["R$ 3,83"],
+        "SKU": ["CMNS0483KLE"],
+    })
+
+    product, = prepare_products(chunk)
+
+    assert product["preco_venda"] == "3.83"
+    # Missing columns are empty, missing prices 0.00
+    assert product["ean"] == ""
+    assert product["preco_custo"] == "0.00"
+    assert product["descricao_produto"] == "MOLA VARETA FREIO"
+    assert product["descricao_br"] == "9501473100 MOLA VARETA FREIO SKU: LK CMNS0483KLE"
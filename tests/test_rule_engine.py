@@ -0,0 +1,37 @@
+import pytest
+
+from app.services.rule_engine import PartRuleEngine
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return PartRuleEngine(min_confidence=0.9)
+
+
+@pytest.mark.parametrize("referencia, descricao", [
+    ("14711KVS900", "14711KVS900 VALVULA ADMISSAO"),
+    ("14721KVS900", "14721KVS900 VALVULA DE ESCAPE"),
+])
+def test_engine_valves_match(engine, referencia, descricao):
+    assert engine.enrich(referencia, descricao) is not None
+
+
+@pytest.mark.parametrize("descricao", ["VALVULA PNEU", "VALVULA TORNEIRA COMBUSTIVEL", "VALVULA FREIO"])
+def test_other_valves_are_left_to_the_llm(engine, descricao):
+    assert engine.enrich("", descricao) is None
+
+
+def test_head_word_match_skips_the_reference(engine):
+    match = engine.enrich("90105KWB600", "90105KWB600 PARAFUSO FLANGE 6X12")
+
+    assert match["family"] == "parafuso"
+    assert match["confidence"] == 1.0
+
+
+@pytest.mark.parametrize("descricao", [
+    "TAMPA PARAFUSO",  # the family only names a detail of another part
+    "KIT PARAFUSOS CARENAGEM",  # kit contents vary
+    "PARAFUSO PORCA ESPECIAL",  # two families
+])
+def test_unsure_matches_are_left_to_the_llm(engine, descricao):
+    assert engine.enrich("", descricao) is None
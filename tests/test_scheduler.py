@@ -0,0 +1,285 @@
+import asyncio
+import math
+
+import pytest
+
+from app.services.scheduler import AdaptiveConcurrency, Backend, CircuitBreaker, EnrichmentScheduler, Flow, RateLimiter
+
+
+class Throttled(Exception):
+    pass
+
+
+def make_scheduler(*backends, **options):
+    options = {"retryable": (Throttled,), "retry_base_delay": 0.001, "retry_max_delay": 0.001, **options}
+    return EnrichmentScheduler(backends=list(backends) or [Backend("primary", max_concurrency=1)], **options)
+
+
+def test_rate_limiter_starts_full_then_waits_for_refill():
+    limiter = RateLimiter(requests_per_minute=1, tokens_per_minute=0)
+    assert limiter.delay() == 0
+
+    asyncio.run(limiter.acquire())
+
+    assert limiter.delay() == pytest.approx(60, abs=0.1)
+
+
+def test_rate_limiter_token_budget():
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=600)
+    # Larger than the whole budget: capped so it still fits once
+    assert limiter.delay(10_000) == 0
+
+    asyncio.run(limiter.acquire(600))
+
+    assert limiter.delay(60) == pytest.approx(6, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_respects_concurrency_limit():
+    scheduler = make_scheduler(Backend("primary", max_concurrency=3))
+    running = 0
+    peak = 0
+
+    async def call(backend_name):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return backend_name
+
+    results = await asyncio.gather(*(scheduler.run(call) for _ in range(10)))
+
+    assert results == ["primary"] * 10
+    assert peak == 3
+    assert scheduler.in_flight == 0
+
+
+def test_adaptive_concurrency_halves_once_per_congestion_event():
+    concurrency = AdaptiveConcurrency(max_limit=8, min_limit=1)
+    started_before = concurrency.acquire()
+
+    assert concurrency.on_throttle(concurrency.acquire())
+    assert concurrency.limit == 4
+    # Sent before the decrease: part of the same congestion event
+    assert not concurrency.on_throttle(started_before)
+    assert concurrency.limit == 4
+
+
+def test_adaptive_concurrency_floor_and_additive_increase():
+    concurrency = AdaptiveConcurrency(max_limit=4, min_limit=2)
+    for _ in range(5):
+        concurrency.on_throttle(concurrency.acquire())
+    assert concurrency.limit == 2
+
+    # About one more slot per window of `limit` successful calls
+    concurrency.on_success()
+    concurrency.on_success()
+    assert int(concurrency.limit) == 2
+    concurrency.on_success()
+    assert int(concurrency.limit) == 3
+
+    for _ in range(20):
+        concurrency.on_success()
+    assert concurrency.limit == 4
+
+
+def test_circuit_breaker_opens_and_doubles_cooldown_on_failed_probe():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10, max_cooldown=25)
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert breaker.ready_at(breaker.open_until - 5) == breaker.open_until
+
+    # Cooldown over: one probe goes through, the others wait for it
+    after = breaker.open_until + 1
+    assert breaker.ready_at(after) == after
+    assert breaker.start_probe()
+    assert breaker.ready_at(after) == math.inf
+
+    breaker.record_failure(probe=True)
+    assert breaker.cooldown == 20
+    assert breaker.start_probe()
+    breaker.record_failure(probe=True)
+    assert breaker.cooldown == 25
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.cooldown == 10
+
+
+@pytest.mark.asyncio
+async def test_scheduler_retries_retryable_errors():
+    scheduler = make_scheduler(max_retries=2)
+    calls = []
+
+    async def call(backend_name):
+        calls.append(backend_name)
+        if len(calls) < 3:
+            raise Throttled()
+        return "ok"
+
+    assert await scheduler.run(call) == "ok"
+    assert calls == ["primary"] * 3
+    assert scheduler.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_raises_after_max_retries():
+    scheduler = make_scheduler(max_retries=1)
+    calls = []
+
+    async def call(backend_name):
+        calls.append(backend_name)
+        raise Throttled()
+
+    with pytest.raises(Throttled):
+        await scheduler.run(call)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_scheduler_does_not_retry_other_errors():
+    scheduler = make_scheduler(max_retries=3)
+    calls = []
+
+    async def call(backend_name):
+        calls.append(backend_name)
+        raise ValueError("bad response")
+
+    with pytest.raises(ValueError):
+        await scheduler.run(call)
+    assert len(calls) == 1
+
+
+def test_backoff_delay_is_jittered_capped_and_honors_retry_after():
+    scheduler = make_scheduler(retry_base_delay=1, retry_max_delay=8)
+
+    assert 2 <= scheduler.backoff_delay(3) <= 4
+    assert 4 <= scheduler.backoff_delay(10) <= 8
+    assert scheduler.backoff_delay(1, retry_after=30) == 30
+
+
+@pytest.mark.asyncio
+async def test_calls_go_to_the_least_loaded_backend():
+    scheduler = make_scheduler(Backend("a", max_concurrency=2), Backend("b", max_concurrency=2))
+    gate = asyncio.Event()
+
+    async def hold(backend_name):
+        await gate.wait()
+        return backend_name
+
+    tasks = [asyncio.create_task(scheduler.run(hold)) for _ in range(4)]
+    while scheduler.in_flight < 4:
+        await asyncio.sleep(0)
+    gate.set()
+
+    assert sorted(await asyncio.gather(*tasks)) == ["a", "a", "b", "b"]
+
+
+@pytest.mark.asyncio
+async def test_retry_fails_over_to_another_backend():
+    scheduler = make_scheduler(Backend("a", max_concurrency=1), Backend("b", max_concurrency=1), max_retries=1)
+    calls = []
+
+    async def call(backend_name):
+        calls.append(backend_name)
+        if backend_name == "a":
+            raise Throttled()
+        return backend_name
+
+    assert await scheduler.run(call) == "b"
+    assert calls == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_paused_and_open_backends_are_skipped():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=60, max_cooldown=60)
+    paused, broken, healthy = (
+        Backend("paused", max_concurrency=1),
+        Backend("broken", max_concurrency=1, circuit_breaker=breaker),
+        Backend("healthy", max_concurrency=1),
+    )
+    scheduler = make_scheduler(paused, broken, healthy)
+    # Retry-After from the provider, and a circuit opened by failures
+    paused.resume_at = math.inf
+    breaker.record_failure()
+
+    async def call(backend_name):
+        return backend_name
+
+    assert [await scheduler.run(call) for _ in range(3)] == ["healthy"] * 3
+
+
+@pytest.mark.asyncio
+async def test_backend_with_exhausted_rate_budget_is_avoided():
+    limited = Backend("limited", max_concurrency=1, requests_per_minute=1)
+    scheduler = make_scheduler(limited, Backend("other", max_concurrency=1))
+
+    async def call(backend_name):
+        return backend_name
+
+    # Both idle: the first in AI_BACKENDS order, then the one with budget left
+    assert [await scheduler.run(call) for _ in range(3)] == ["limited", "other", "other"]
+
+
+async def run_in_queue(scheduler, calls):
+    """Queue (name, flow) calls behind a held slot, release it and return the order they ran in"""
+    gate = asyncio.Event()
+    order = []
+
+    async def hold(backend_name):
+        await gate.wait()
+
+    def call(name):
+        async def run(backend_name):
+            order.append(name)
+        return run
+
+    blocker = asyncio.create_task(scheduler.run(hold, tokens=100))
+    await asyncio.sleep(0)
+    tasks = [asyncio.create_task(scheduler.run(call(name), tokens=100, flow=flow)) for name, flow in calls]
+    while scheduler.waiting < len(calls):
+        await asyncio.sleep(0)
+
+    gate.set()
+    await asyncio.gather(blocker, *tasks)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_scheduler_shares_calls_by_flow_weight():
+    scheduler = make_scheduler()
+    urgent = Flow("urgent", weight=8)
+    bulk = Flow("bulk", weight=1)
+
+    # The big file queued all its calls first
+    order = await run_in_queue(scheduler, [("bulk", bulk)] * 8 + [("urgent", urgent)] * 8)
+
+    assert order[:8].count("urgent") >= 7
+    assert order[-7:] == ["bulk"] * 7
+
+
+@pytest.mark.asyncio
+async def test_equal_flows_alternate():
+    scheduler = make_scheduler()
+    big, small = Flow("big"), Flow("small")
+
+    order = await run_in_queue(scheduler, [("big", big)] * 6 + [("small", small)] * 3)
+
+    assert order[:6] == ["big", "small"] * 3
+
+
+@pytest.mark.asyncio
+async def test_idle_flow_gets_no_credit():
+    scheduler = make_scheduler()
+    busy, idle = Flow("busy"), Flow("idle")
+    # The busy flow had the backend to itself for a while
+    await run_in_queue(scheduler, [("busy", busy)] * 10)
+
+    # The idle flow starts from the current virtual time: it shares, it does not catch up
+    order = await run_in_queue(scheduler, [("busy", busy)] * 4 + [("idle", idle)] * 4)
+
+    assert order[:4].count("idle") == 2
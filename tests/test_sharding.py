@@ -0,0 +1,105 @@
+import csv
+
+from app.services.csv_processor import REPORT_COLUMNS
+from app.services.sharding import ShardPool, llm_share
+
+HEADER = "SKU;Descrição\n"
+
+
+def write_shard(work_dir, processor, name, rows):
+    output = work_dir / f"enriched_{name}"
+    output.write_text(HEADER + "".join(f"{sku};{descricao}\n" for sku, descricao, _ in rows), encoding="utf-8")
+    with open(processor.report_path(output), "w", encoding="utf-8", newline="") as report_file:
+        writer = csv.writer(report_file, delimiter=";", lineterminator="\n")
+        writer.writerow(REPORT_COLUMNS)
+        for index, (sku, _, source) in enumerate(rows, 1):
+            writer.writerow([index, sku, source, "LLM unavailable" if source == "fallback" else ""])
+
+
+def test_merge_concatenates_shards_in_manifest_order(processor, tmp_path):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    input_path = tmp_path / "input_123_carga.csv"
+    # Shards finish in any order; the manifest holds the input order
+    write_shard(work_dir, processor, "shard_00002.csv", [("S5", "PNEU", "llm")])
+    write_shard(work_dir, processor, "shard_00000.csv", [("S1", "MOLA", "rules"), ("S2", "ARRUELA", "fallback")])
+    write_shard(work_dir, processor, "shard_00001.csv", [("S3", "PORCA", "cache"), ("S4", "FILTRO", "fallback")])
+    manifest = {"shards": [{"name": f"shard_{index:05d}.csv", "rows": 0} for index in range(3)]}
+    pool = ShardPool(processor, workers=2, shard_rows=2, max_attempts=1, lease_seconds=60)
+
+    output_path, rows, fallback_rows = pool._merge(input_path, work_dir, manifest)
+
+    assert output_path == tmp_path / "enriched_input_123_carga.csv"
+    assert (rows, fallback_rows) == (5, 2)
+    assert output_path.read_text(encoding="utf-8") == (
+        HEADER + "S1;MOLA\nS2;ARRUELA\nS3;PORCA\nS4;FILTRO\nS5;PNEU\n"
+    )
+    with open(processor.report_path(output_path), encoding="utf-8", newline="") as report_file:
+        report = list(csv.reader(report_file, delimiter=";"))
+    assert report[0] == REPORT_COLUMNS
+    assert [row[:3] for row in report[1:]] == [
+        ["1", "S1", "rules"], ["2", "S2", "fallback"], ["3", "S3", "cache"], ["4", "S4", "fallback"], ["5", "S5", "llm"]
+    ]
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_llm_share_leaves_a_share_to_the_parent():
+    assert llm_share(1) == 0.5
+    assert llm_share(3) == 0.25
+    assert llm_share(0) == 0.5
+
+
+def test_parent_and_workers_stay_within_the_backend_limits(storage):
+    from app.core.config import settings
+    from app.services.csv_processor import CSVProcessor
+
+    workers = 3
+    # The API process and each worker build their own scheduler over one share
+    processes = [CSVProcessor(llm_share=llm_share(workers)) for _ in range(workers + 1)]
+
+    for index, backend in enumerate(settings.llm_backends()):
+        limits = [process.scheduler.backends[index] for process in processes]
+        assert sum(limit.concurrency.max_limit for limit in limits) <= backend.max_concurrent_requests
+        assert sum(limit.rate_limiter.requests_per_minute for limit in limits) <= backend.requests_per_minute
+        assert sum(limit.rate_limiter.tokens_per_minute for limit in limits) <= backend.tokens_per_minute
+
+
+INPUT = (
+    "Referencia,Descricao,SKU\n"
+    "R1,MOLA,S1\n"
+    "\n"
+    'R2,"ARRUELA\nLISA",S2\n'
+    "R3,PORCA,S3\n"
+    "\n"
+    "R4,FILTRO,S4\n"
+    "R5,PNEU,S5\n"
+)
+
+
+def test_split_counts_rows_as_they_are_enriched(processor, tmp_path):
+    input_path = tmp_path / "input_123_carga.csv"
+    input_path.write_text(INPUT, encoding="utf-8")
+    pool = ShardPool(processor, workers=2, shard_rows=2, max_attempts=1, lease_seconds=60)
+
+    manifest = pool._split(input_path, tmp_path / "work", priority=None, supplier=None)
+
+    # Blank lines are skipped and the quoted line break stays in its row
+    assert processor.count_rows(input_path) == 5
+    assert [shard["rows"] for shard in manifest["shards"]] == [2, 2, 1]
+    shard_rows = [
+        product
+        for shard in manifest["shards"]
+        for products in processor._read_chunks(tmp_path / "work" / shard["name"])
+        for product in products
+    ]
+    assert [(row["sku"], row["descricao"]) for row in shard_rows] == [
+        ("S1", "MOLA"), ("S2", "ARRUELA\nLISA"), ("S3", "PORCA"), ("S4", "FILTRO"), ("S5", "PNEU")
+    ]
+
+
+def test_count_rows_of_an_empty_input(processor, tmp_path):
+    input_path = tmp_path / "input_123_vazio.csv"
+    input_path.write_text("", encoding="utf-8")
+    assert processor.count_rows(input_path) == 0
+    input_path.write_text("Referencia,Descricao,SKU\n", encoding="utf-8")
+    assert processor.count_rows(input_path) == 0
@@ -0,0 +1,37 @@
+from app.services.similarity_index import SimilarityIndex
+
+
+def make_index():
+    index = SimilarityIndex(max_entries=100)
+    index.add("TANQUE COMBUSTIVEL", {"categoria": "Tanque"}, referencia="17510KVS900")
+    index.add("PORCA 12MM", {"categoria": "Porca"}, referencia="94050-12000")
+    index.add("KIT RELACAO", {"categoria": "Kit"}, referencia="06406KVS900")
+    return index
+
+
+def test_reusable_needs_the_same_head_word_and_reference_family():
+    index = make_index()
+
+    score, part = index.reusable("TANQUE COMBUSTIVEL", "17510KWB900", min_score=0.9)
+    assert part.fields == {"categoria": "Tanque"}
+    assert score >= 0.9
+
+    # Another part that mentions the tank, or a tank of another family
+    assert index.reusable("TAMPA TANQUE COMBUSTIVEL", "17620KVS900", min_score=0.5) is None
+    assert index.reusable("TANQUE COMBUSTIVEL", "99999KVS900", min_score=0.9) is None
+
+
+def test_reusable_skips_short_references_and_kits():
+    index = make_index()
+
+    assert index.reusable("PORCA 12MM", "9405", min_score=0.9) is None
+    assert index.reusable("KIT RELACAO", "06406KVS900", min_score=0.9) is None
+
+
+def test_nearest_ranks_by_score():
+    index = make_index()
+
+    scores = [score for score, _ in index.nearest("TANQUE COMBUSTIVEL", limit=3)]
+
+    assert scores == sorted(scores, reverse=True)
+    assert index.nearest("TANQUE COMBUSTIVEL", limit=1)[0][1].head == "TANQUE"
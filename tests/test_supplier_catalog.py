@@ -0,0 +1,169 @@
+import asyncio
+import csv
+from datetime import datetime
+
+import pytest
+
+from app.services.supplier_catalog import SupplierCatalog, patch_row
+
+
+def product(sku, referencia, descricao="MOLA VARETA FREIO", quantidade="2", preco_venda="3.83"):
+    return {
+        "sku": sku,
+        "referencia": referencia,
+        "descricao": descricao,
+        "quantidade": quantidade,
+        "ean": "7897925504835",
+        "preco_venda": preco_venda,
+        "preco_custo": "2.55",
+    }
+
+
+def output_row(item):
+    return {
+        "SKU": item["sku"],
+        "Descrição": item["descricao"],
+        "Quantidade (Padrão)": item["quantidade"],
+        "EAN": item["ean"],
+        "Preço (Padrão (BRL))": item["preco_venda"],
+        "Preço de Compra": item["preco_custo"],
+        "Custo (médio)": item["preco_custo"],
+    }
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return SupplierCatalog(tmp_path / "catalogs.sqlite3", prompt_version="v1")
+
+
+def test_item_key_normalizes_sku_and_reference():
+    assert SupplierCatalog.item_key({"sku": " cmns0483kle ", "referencia": "9501473100"}) == \
+        SupplierCatalog.item_key({"sku": "CMNS0483KLE", "referencia": "9501473100 "})
+
+
+def test_lookup_returns_enriched_items_of_the_supplier(catalog):
+    kept, fell_back = product("A1", "111"), product("A2", "222")
+    catalog.record("Honda SP", "run-1", [(kept, "111|MOLA", output_row(kept)), (fell_back, "222|MOLA", None)])
+    catalog.finish("Honda SP", "run-1")
+
+    found = catalog.lookup(" honda sp", [SupplierCatalog.item_key(kept), SupplierCatalog.item_key(fell_back)])
+
+    # Fallback rows are remembered as seen but enriched again
+    assert found == {SupplierCatalog.item_key(kept): ("111|MOLA", output_row(kept))}
+    assert catalog.lookup("Other supplier", [SupplierCatalog.item_key(kept)]) == {}
+
+
+def test_lookup_ignores_other_prompt_versions(catalog, tmp_path):
+    item = product("A1", "111")
+    catalog.record("honda", "run-1", [(item, "111|MOLA", output_row(item))])
+
+    newer = SupplierCatalog(tmp_path / "catalogs.sqlite3", prompt_version="v2")
+
+    assert newer.lookup("honda", [SupplierCatalog.item_key(item)]) == {}
+
+
+def test_finish_returns_items_missing_from_the_new_upload(catalog):
+    first = [product("A1", "111"), product("A2", "222"), product("A3", "333")]
+    catalog.record("honda", "run-1", [(item, item["referencia"], output_row(item)) for item in first])
+    assert catalog.finish("honda", "run-1") == []
+
+    second = [product("A1", "111"), product("A3", "333", quantidade="9")]
+    catalog.record("honda", "run-2", [(item, item["referencia"], output_row(item)) for item in second])
+    removed = catalog.finish("honda", "run-2")
+
+    assert removed == [{"sku": "A2", "referencia": "222", "descricao": "MOLA VARETA FREIO"}]
+    keys = [SupplierCatalog.item_key(item) for item in first]
+    assert set(catalog.lookup("honda", keys)) == {keys[0], keys[2]}
+    assert catalog.list_suppliers()[0]["items"] == 2
+
+
+def test_patch_row_takes_stock_and_prices_of_the_upload():
+    previous = output_row(product("A1", "111"))
+
+    same, changed = patch_row(previous, product("A1", "111"))
+    assert not changed
+    assert same == previous
+
+    patched, changed = patch_row(previous, product("A1", "111", quantidade="7", preco_venda="4.10"))
+    assert changed
+    assert patched["Quantidade (Padrão)"] == "7"
+    assert patched["Preço (Padrão (BRL))"] == "4.10"
+    assert patched["Descrição"] == previous["Descrição"]
+    assert previous["Quantidade (Padrão)"] == "2"
+
+
+def test_diff_catalog_item(processor):
+    item = product("A1", "111", descricao="111 MOLA VARETA FREIO")
+    items = {SupplierCatalog.item_key(item): (processor.ai_agent.part_key(item), output_row(item))}
+
+    assert processor._diff_catalog_item(item, items)[1] == "unchanged"
+    assert processor._diff_catalog_item(dict(item, quantidade="5"), items)[1] == "patched"
+    # A new description is a different part: enriched again
+    assert processor._diff_catalog_item(dict(item, descricao="111 MOLA FREIO"), items) == (None, "")
+    assert processor._diff_catalog_item(dict(item, sku="A2"), items) == (None, "")
+
+
+def test_reused_rows_are_rebased_to_the_upload(processor):
+    item = product("A1", "111", descricao="111 MOLA VARETA FREIO")
+    stored = dict(
+        output_row(item),
+        **{"Descrição adicional 2 (BR)": "Data: 2024-01-02 Código SKU: A1 Código do Fabricante: 111"}
+    )
+    items = {SupplierCatalog.item_key(item): (processor.ai_agent.part_key(item), stored)}
+
+    # Same item, its SKU written in another case
+    enriched_data, source = processor._diff_catalog_item(dict(item, sku="a1"), items)
+
+    assert source == "unchanged"
+    assert enriched_data["SKU"] == "a1"
+    assert enriched_data["Descrição adicional 2 (BR)"] == (
+        f"Data: {datetime.now():%Y-%m-%d} Código SKU: a1 Código do Fabricante: 111"
+    )
+
+
+def write_catalog(path, items):
+    with open(path, "w", encoding="utf-8", newline="") as input_file:
+        writer = csv.writer(input_file)
+        writer.writerow(["Referencia", "Descricao", "SKU"])
+        for sku, referencia in items:
+            writer.writerow([referencia, f"{referencia} MOLA VARETA FREIO", sku])
+    return path
+
+
+@pytest.mark.asyncio
+async def test_only_full_catalog_uploads_remove_missing_items(processor, tmp_path):
+    await processor.process_file(
+        write_catalog(tmp_path / "full.csv", [("A1", "111"), ("A2", "222")]), supplier="honda", full_catalog=True
+    )
+
+    # A partial upload updates the items it lists and keeps the others
+    output_path = await processor.process_file(
+        write_catalog(tmp_path / "partial.csv", [("A3", "333")]), supplier="honda"
+    )
+    assert not processor.removed_path(output_path).exists()
+    assert processor.catalogs.list_suppliers()[0]["items"] == 3
+
+    output_path = await processor.process_file(
+        write_catalog(tmp_path / "next.csv", [("A1", "111"), ("A3", "333")]), supplier="honda", full_catalog=True
+    )
+    with open(processor.removed_path(output_path), encoding="utf-8", newline="") as removed_file:
+        assert [row[0] for row in csv.reader(removed_file, delimiter=";")] == ["SKU", "A2"]
+    assert processor.catalogs.list_suppliers()[0]["items"] == 2
+
+
+@pytest.mark.asyncio
+async def test_uploads_of_a_supplier_hold_its_catalog_in_turn(processor):
+    events = []
+
+    async def upload(name, supplier):
+        async with processor.hold_catalog(supplier):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    await asyncio.gather(upload("first", "Honda"), upload("second", " honda"), upload("other", "yamaha"))
+
+    assert events.index("second start") > events.index("first end")
+    assert events.index("other start") < events.index("first end")
+    # Locks are dropped once no upload waits for them
+    assert processor._catalog_locks == {}
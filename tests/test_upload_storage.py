@@ -0,0 +1,66 @@
+import io
+
+import pytest
+from fastapi import UploadFile
+
+from app.services.upload_storage import (
+    MULTIPART_OVERHEAD,
+    ContentHasher,
+    FileTooLargeError,
+    exceeds_upload_limit,
+    hash_file,
+    save_upload,
+)
+
+CSV = "Referencia,Descricao\n9501473100,MOLA VARETA FREIO\n".encode("utf-8")
+
+
+@pytest.mark.parametrize("content_length, exceeds", [
+    (None, False),
+    ("", False),
+    ("abc", False),
+    (str(1000 + MULTIPART_OVERHEAD), False),
+    (str(1001 + MULTIPART_OVERHEAD), True),
+])
+def test_exceeds_upload_limit(content_length, exceeds):
+    assert exceeds_upload_limit(content_length, 1000) is exceeds
+
+
+def test_no_limit():
+    assert not exceeds_upload_limit("10000000000", 0)
+
+
+@pytest.mark.asyncio
+async def test_save_upload_renames_once_complete(tmp_path):
+    destination = tmp_path / "input.csv"
+
+    size, content_hash = await save_upload(UploadFile(io.BytesIO(CSV), filename="input.csv"), destination, 1000)
+
+    assert size == len(CSV)
+    assert destination.read_bytes() == CSV
+    assert content_hash == hash_file(destination)
+    assert list(tmp_path.iterdir()) == [destination]
+
+
+@pytest.mark.asyncio
+async def test_save_upload_cuts_off_oversized_uploads(tmp_path):
+    destination = tmp_path / "input.csv"
+
+    with pytest.raises(FileTooLargeError):
+        await save_upload(UploadFile(io.BytesIO(CSV * 100), filename="input.csv"), destination, 1000)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_content_hash_ignores_bom_and_line_endings():
+    crlf = ContentHasher()
+    # A CRLF split across two reads is still one line ending
+    for block in (b"\xef\xbb", b"\xbf" + CSV.replace(b"\n", b"\r\n")[:20] + b"\r", b"\n" + CSV.replace(b"\n", b"\r\n")[22:]):
+        crlf.update(block)
+    plain = ContentHasher()
+    plain.update(CSV)
+
+    assert crlf.hexdigest() == plain.hexdigest()
+    other = ContentHasher()
+    other.update(CSV.replace(b"MOLA", b"PINO"))
+    assert other.hexdigest() != plain.hexdigest()